@@ -0,0 +1,264 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogindex
+
+Indexed catalogs shared by the admin tools (munkiimport, iconimporter and
+manifestutil).
+
+A catalog index holds a catalog's items along with tables for finding them
+by installer item hash, receipt, application, configuration profile and
+installer item name, plus the latest version of each item. An index is
+built once per process, so munkiimport can import several items without
+rebuilding it. It is also stored under ~/Library/Caches, keyed by the sha256
+of the catalog it was built from, so the next run (of any of the tools) only
+parses the catalog again if it has changed.
+
+This module must not depend on PyObjC.
+"""
+
+# std libs
+import cPickle
+import hashlib
+import os
+import plistlib
+
+from xml.parsers.expat import ExpatError
+
+# our libs
+from .. import catalogdb
+from .. import munkirepo
+from ..versionutils import nameAndVersion, version_key
+
+
+# bump this if the structure of a catalog index changes
+INDEX_FORMAT_VERSION = 1
+INDEX_CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.catalogindex')
+
+# indexes built or loaded by this process, by (repo URL, catalog name)
+_INDEXES = {}
+
+
+class CatalogIndexError(Exception):
+    '''Error to raise when a catalog can't be indexed'''
+    pass
+
+
+class CatalogReadError(CatalogIndexError):
+    '''Error to raise when a catalog can't be retrieved from the repo'''
+    pass
+
+
+class CatalogDecodeError(CatalogIndexError):
+    '''Error to raise when a catalog can't be parsed'''
+    pass
+
+
+def make_index(catalogitems, warning_fn=None):
+    """Takes an array of catalog items and builds the tables the admin tools
+    use to find items. Returns a dict we can use like a database.
+    warning_fn, if given, is called with a message for each malformed
+    item."""
+    pkgid_table = {}
+    app_table = {}
+    installer_item_table = {}
+    hash_table = {}
+    profile_table = {}
+    latest_table = {}
+    names = set()
+
+    itemindex = -1
+    for item in catalogitems:
+        itemindex = itemindex + 1
+        name = item.get('name', 'NO NAME')
+        vers = item.get('version', 'NO VERSION')
+
+        if name == 'NO NAME' or vers == 'NO VERSION':
+            if warning_fn:
+                warning_fn('WARNING: Bad pkginfo: %s' % item)
+        else:
+            # keep the first of the items with the newest version
+            latest = latest_table.get(name)
+            if latest is None or (
+                    version_key(vers) >
+                    version_key(catalogitems[latest]['version'])):
+                latest_table[name] = itemindex
+        if name != 'NO NAME' and not item.get('update_for'):
+            names.add(name)
+
+        # add to hash table
+        if 'installer_item_hash' in item:
+            if not item['installer_item_hash'] in hash_table:
+                hash_table[item['installer_item_hash']] = []
+            hash_table[item['installer_item_hash']].append(itemindex)
+
+        # add to installer item table
+        if 'installer_item_location' in item:
+            installer_item_name = os.path.basename(
+                item['installer_item_location'])
+            (name, ext) = os.path.splitext(installer_item_name)
+            if '-' in name:
+                (name, vers) = nameAndVersion(name)
+            installer_item_name = name + ext
+            if not installer_item_name in installer_item_table:
+                installer_item_table[installer_item_name] = {}
+            if not vers in installer_item_table[installer_item_name]:
+                installer_item_table[installer_item_name][vers] = []
+            installer_item_table[installer_item_name][vers].append(itemindex)
+
+        # add to table of receipts
+        for receipt in item.get('receipts', []):
+            try:
+                if 'packageid' in receipt and 'version' in receipt:
+                    pkgid = receipt['packageid']
+                    pkgvers = receipt['version']
+                    if not pkgid in pkgid_table:
+                        pkgid_table[pkgid] = {}
+                    if not pkgvers in pkgid_table[pkgid]:
+                        pkgid_table[pkgid][pkgvers] = []
+                    pkgid_table[pkgid][pkgvers].append(itemindex)
+            except TypeError:
+                if warning_fn:
+                    warning_fn('Bad receipt data for %s-%s: %s'
+                               % (name, vers, receipt))
+
+        # add to table of installed applications
+        for install in item.get('installs', []):
+            try:
+                if install.get('type') == 'application':
+                    if 'path' in install:
+                        if not install['path'] in app_table:
+                            app_table[install['path']] = {}
+                        if not vers in app_table[install['path']]:
+                            app_table[install['path']][vers] = []
+                        app_table[install['path']][vers].append(itemindex)
+            except (AttributeError, TypeError):
+                if warning_fn:
+                    warning_fn('Bad install data for %s-%s: %s'
+                               % (name, vers, install))
+
+        # add to table of PayloadIdentifiers
+        if 'PayloadIdentifier' in item:
+            if not item['PayloadIdentifier'] in profile_table:
+                profile_table[item['PayloadIdentifier']] = {}
+            if not vers in profile_table[item['PayloadIdentifier']]:
+                profile_table[item['PayloadIdentifier']][vers] = []
+            profile_table[item['PayloadIdentifier']][vers].append(itemindex)
+
+    pkgdb = {}
+    pkgdb['hashes'] = hash_table
+    pkgdb['receipts'] = pkgid_table
+    pkgdb['applications'] = app_table
+    pkgdb['installer_items'] = installer_item_table
+    pkgdb['profiles'] = profile_table
+    # name -> index of the item with the newest version
+    pkgdb['latest'] = latest_table
+    # names of the items that aren't updates for other items
+    pkgdb['names'] = sorted(names)
+    pkgdb['items'] = catalogitems
+
+    return pkgdb
+
+
+def index_path(repo, catalogname):
+    '''Returns the path of the stored index for catalogname. Indexes are kept
+    in the user's cache directory, one directory per repo URL.'''
+    baseurl = getattr(repo, 'baseurl', '') or ''
+    if isinstance(baseurl, unicode):
+        baseurl = baseurl.encode('UTF-8')
+    return os.path.join(INDEX_CACHE_DIR, hashlib.sha256(baseurl).hexdigest(),
+                        catalogname + '.index')
+
+
+def load_index(path, catalog_sha256):
+    '''Returns the index stored at path if it was built from the catalog
+    with the given sha256, or None.'''
+    try:
+        fileref = open(path, 'rb')
+        try:
+            stored = cPickle.load(fileref)
+        finally:
+            fileref.close()
+    except (IOError, OSError, EOFError, AttributeError, ImportError,
+            IndexError, ValueError, cPickle.UnpicklingError):
+        return None
+    if (not isinstance(stored, dict) or
+            stored.get('version') != INDEX_FORMAT_VERSION or
+            stored.get('catalog_sha256') != catalog_sha256):
+        return None
+    return stored['index']
+
+
+def save_index(path, index, catalog_sha256):
+    '''Writes index, built from the catalog with the given sha256, to path.
+    The index is written to a temporary file first and then moved into
+    place. Raises IOError or OSError on failure.'''
+    index_dir = os.path.dirname(path)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir, 0755)
+    temp_path = path + '.tmp'
+    fileref = open(temp_path, 'wb')
+    try:
+        cPickle.dump({'version': INDEX_FORMAT_VERSION,
+                      'catalog_sha256': catalog_sha256,
+                      'index': index},
+                     fileref, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        fileref.close()
+    os.rename(temp_path, path)
+
+
+def get_catalog_index(repo, catalogname='all', warning_fn=None):
+    '''Returns the index (see make_index()) of catalogs/catalogname.
+    The catalog is retrieved each time to check it hasn't changed, but is
+    only parsed and indexed if neither this process nor an earlier one has
+    already indexed the same catalog.
+    Raises CatalogReadError if the catalog can't be retrieved, and
+    CatalogDecodeError if it can't be parsed.'''
+    try:
+        data = repo.get(os.path.join('catalogs', catalogname))
+    except munkirepo.RepoError, err:
+        raise CatalogReadError(err)
+    catalog_sha256 = catalogdb.catalog_hash(data)
+
+    key = (getattr(repo, 'baseurl', None), catalogname)
+    cached = _INDEXES.get(key)
+    if cached and cached[0] == catalog_sha256:
+        return cached[1]
+
+    path = index_path(repo, catalogname)
+    index = load_index(path, catalog_sha256)
+    if index is None:
+        try:
+            catalogitems = plistlib.readPlistFromString(data)
+        except (ExpatError, ValueError, TypeError, AttributeError), err:
+            raise CatalogDecodeError(err)
+        if not isinstance(catalogitems, list):
+            raise CatalogDecodeError(
+                'catalogs/%s is not an array of items' % catalogname)
+        index = make_index(catalogitems, warning_fn=warning_fn)
+        try:
+            save_index(path, index, catalog_sha256)
+        except (IOError, OSError):
+            # we'll just have to index the catalog again next time
+            pass
+    _INDEXES[key] = (catalog_sha256, index)
+    return index
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
@@ -21,14 +21,24 @@ Routines used by makecatalogs
 """
 
 # std libs
+import cPickle
 import hashlib
+import itertools
 import os
 import plistlib
 
 # our libs
 from .common import list_items_of_kind, AttributeDict
 
+from .. import catalogdb
 from .. import munkirepo
+from ..utils import concurrent_imap
+
+
+# bump this if the structure of the pkginfo index changes
+INDEX_FORMAT_VERSION = 2
+INDEX_CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.makecatalogs')
 
 
 class MakeCatalogsError(Exception):
@@ -36,35 +46,217 @@ class MakeCatalogsError(Exception):
     pass
 
 
-def hash_icons(repo, output_fn=None):
-    '''Builds a dictionary containing hashes for all our repo icons'''
+def new_index():
+    '''Returns an empty pkginfo index'''
+    return {'version': INDEX_FORMAT_VERSION,
+            'pkgsinfo': {},
+            'catalogs': {},
+            'icons': {}}
+
+
+def default_index_path(repo):
+    '''Returns the path of the local pkginfo index for repo. Indexes are kept
+    in the user's cache directory, one per repo URL.'''
+    baseurl = getattr(repo, 'baseurl', '') or ''
+    if isinstance(baseurl, unicode):
+        baseurl = baseurl.encode('UTF-8')
+    return os.path.join(
+        INDEX_CACHE_DIR, hashlib.sha256(baseurl).hexdigest() + '.index')
+
+
+def load_index(index_path):
+    '''Returns the pkginfo index stored at index_path. Returns a new, empty
+    index if the file is missing, unreadable, or in an older format.'''
+    try:
+        fileref = open(index_path, 'rb')
+        try:
+            index = cPickle.load(fileref)
+        finally:
+            fileref.close()
+    except (IOError, OSError, EOFError, AttributeError, ImportError,
+            IndexError, ValueError, cPickle.UnpicklingError):
+        return new_index()
+    if (not isinstance(index, dict) or
+            index.get('version') != INDEX_FORMAT_VERSION):
+        return new_index()
+    return index
+
+
+def save_index(index_path, index):
+    '''Writes the pkginfo index to index_path. The index is written to a
+    temporary file first and then moved into place so an interrupted run
+    never leaves a truncated index behind. Raises IOError or OSError on
+    failure.'''
+    index_dir = os.path.dirname(index_path)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir, 0755)
+    temp_path = index_path + '.tmp'
+    fileref = open(temp_path, 'wb')
+    try:
+        cPickle.dump(index, fileref, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        fileref.close()
+    os.rename(temp_path, index_path)
+
+
+def catalog_signature(pkginfo_refs, index):
+    '''Returns a digest identifying the membership and content of a catalog
+    made from the given (ordered) pkginfo_refs'''
+    digest = hashlib.sha256()
+    for pkginfo_ref in pkginfo_refs:
+        if isinstance(pkginfo_ref, unicode):
+            digest.update(pkginfo_ref.encode('UTF-8'))
+        else:
+            digest.update(pkginfo_ref)
+        digest.update('\0')
+        digest.update(index['pkgsinfo'][pkginfo_ref]['sha256'])
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+def hash_icons(repo, output_fn=None, index=None, jobs=None):
+    '''Builds a dictionary containing hashes for all our repo icons.
+    If an index (as returned by load_index()) is given, icons whose etag
+    (from repo.itemlist_with_metadata()) is unchanged since they were
+    indexed are not read again, and the index is updated in place.
+    jobs is how many icons to read, and to hash, at once. If it is None,
+    icons are hashed one at a time and the repo plugin decides how many to
+    read at once.'''
     errors = []
     icons = {}
     if output_fn:
         output_fn("Getting list of icons...")
-    icon_list = repo.itemlist('icons')
+    etags = {}
+    if index is None:
+        icon_list = repo.itemlist('icons')
+    else:
+        icon_list = []
+        for name, metadata in repo.itemlist_with_metadata('icons'):
+            icon_list.append(name)
+            etags[name] = metadata.get('etag')
     # Don't hash the hashes, they aren't icons.
     if '_icon_hashes.plist' in icon_list:
         icon_list.remove('_icon_hashes.plist')
+
+    indexed_icons = {}
+    if index is not None:
+        indexed_icons = index['icons']
+        index['icons'] = {}
+    to_hash = []
     for icon_ref in icon_list:
+        indexed = indexed_icons.get(icon_ref)
+        if (indexed and etags.get(icon_ref) and
+                indexed['etag'] == etags[icon_ref]):
+            # unchanged since last time; no need to read it again
+            icons[icon_ref] = indexed['sha256']
+            index['icons'][icon_ref] = indexed
+        else:
+            to_hash.append(icon_ref)
+
+    def hash_icon(item):
+        '''Hashes a single icon; may be called from worker threads'''
+        dummy_ref, icondata, err = item
+        if err:
+            return None, err
+        return hashlib.sha256(icondata).hexdigest(), None
+
+    results = concurrent_imap(
+        hash_icon,
+        repo.get_many(['icons/' + icon_ref for icon_ref in to_hash],
+                      concurrency=jobs),
+        int(jobs or 1))
+    for icon_ref, (digest, err) in itertools.izip(to_hash, results):
         if output_fn:
             output_fn("Hashing %s..." % (icon_ref))
-        # Try to read the icon file
-        try:
-            icondata = repo.get('icons/' + icon_ref)
-            icons[icon_ref] = hashlib.sha256(icondata).hexdigest()
-        except munkirepo.RepoError, err:
+        if err:
             errors.append(u'RepoError for %s: %s' % (icon_ref, unicode(err)))
-        except IOError, err:
-            errors.append(u'IO error for %s: %s' % (icon_ref, err))
-        except BaseException, err:
-            errors.append(u'Unexpected error for %s: %s' % (icon_ref, err))
+            continue
+        icons[icon_ref] = digest
+        if index is not None:
+            index['icons'][icon_ref] = {'sha256': digest,
+                                        'etag': etags.get(icon_ref)}
     return icons, errors
 
 
+def write_icon_hashes(repo, icons, output_fn=None):
+    '''Writes icons/_icon_hashes.plist, unless the repo's copy already has
+    the same hashes; rewriting it would make every client download it
+    again. Returns a list of errors.'''
+    icon_hashes_plist = os.path.join("icons", "_icon_hashes.plist")
+    try:
+        existing = plistlib.readPlistFromString(repo.get(icon_hashes_plist))
+    except munkirepo.RepoError:
+        existing = None
+    except BaseException:
+        # not a valid plist; replace it
+        existing = None
+    if existing == icons:
+        if output_fn:
+            output_fn("Skipped unchanged %s..." % icon_hashes_plist)
+        return []
+    icon_hashes = plistlib.writePlistToString(icons)
+    try:
+        repo.put(icon_hashes_plist, icon_hashes)
+        print "Created %s..." % (icon_hashes_plist)
+    except munkirepo.RepoError, err:
+        return [u'Failed to create %s: %s'
+                % (icon_hashes_plist, unicode(err))]
+    return []
+
+
+class PkgsIndex(object):
+    '''The repo's list of pkgs items, indexed so verify_pkginfo() can look
+    up an item, or an item whose path differs only by case, without
+    searching the list'''
+
+    def __init__(self, pkgs_list):
+        self.paths = set(pkgs_list)
+        self.casefolded = {}
+        for repo_pkg in pkgs_list:
+            # keep the first, as searching the list would find
+            self.casefolded.setdefault(repo_pkg.lower(), repo_pkg)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def case_insensitive_match(self, path):
+        '''Returns the repo path that matches path ignoring case, or
+        None'''
+        return self.casefolded.get(path.lower())
+
+
+def _verify_item_exists(pkginfo_ref, location, description, pkgs_index,
+                        errors):
+    '''Returns True if pkgs/location is in pkgs_index, or differs only by
+    case from an item that is (with a warning). description is "installer"
+    or "uninstaller".'''
+    itempath = os.path.join("pkgs", location)
+    if itempath in pkgs_index:
+        return True
+    # do a case-insensitive comparison
+    repo_pkg = pkgs_index.case_insensitive_match(itempath)
+    if repo_pkg:
+        errors.append(
+            "WARNING: %s refers to %s item: %s. "
+            "The pathname of the item in the repo has "
+            "different case: %s. This may cause issues "
+            "depending on the case-sensitivity of the "
+            "underlying filesystem."
+            % (pkginfo_ref, description, location, repo_pkg))
+        return True
+    errors.append(
+        "WARNING: %s refers to missing %s item: %s"
+        % (pkginfo_ref, description, location))
+    return False
+
+
 def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     '''Returns True if referenced installer items are present,
-    False otherwise. Adds errors/warnings to the errors list'''
+    False otherwise. Adds errors/warnings to the errors list.
+    pkgs_list may be a list of pkgs items or a PkgsIndex; make a PkgsIndex
+    once when verifying many pkginfo items.'''
+    if not isinstance(pkgs_list, PkgsIndex):
+        pkgs_list = PkgsIndex(pkgs_list)
     installer_type = pkginfo.get('installer_type')
     if installer_type in ['nopkg', 'apple_update_metadata']:
         # no associated installer item (pkg) for these types
@@ -81,34 +273,16 @@ def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     # Try to form a path and fail if the
     # installer_item_location is not a valid type
     try:
-        installeritempath = os.path.join(
-            "pkgs", pkginfo['installer_item_location'])
+        os.path.join("pkgs", pkginfo['installer_item_location'])
     except TypeError:
         errors.append("WARNING: invalid installer_item_location in %s"
                       % pkginfo_ref)
         return False
 
     # Check if the installer item actually exists
-    if not installeritempath in pkgs_list:
-        # do a case-insensitive comparison
-        found_caseinsensitive_match = False
-        for repo_pkg in pkgs_list:
-            if installeritempath.lower() == repo_pkg.lower():
-                errors.append(
-                    "WARNING: %s refers to installer item: %s. "
-                    "The pathname of the item in the repo has "
-                    "different case: %s. This may cause issues "
-                    "depending on the case-sensitivity of the "
-                    "underlying filesystem."
-                    % (pkginfo_ref,
-                       pkginfo['installer_item_location'], repo_pkg))
-                found_caseinsensitive_match = True
-                break
-        if not found_caseinsensitive_match:
-            errors.append(
-                "WARNING: %s refers to missing installer item: %s"
-                % (pkginfo_ref, pkginfo['installer_item_location']))
-            return False
+    if not _verify_item_exists(pkginfo_ref, pkginfo['installer_item_location'],
+                               'installer', pkgs_list, errors):
+        return False
 
     #uninstaller sanity checking
     uninstaller_type = pkginfo.get('uninstall_method')
@@ -123,48 +297,110 @@ def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     # if an uninstaller_item_location is specified, sanity-check it
     if 'uninstaller_item_location' in pkginfo:
         try:
-            uninstalleritempath = os.path.join(
-                "pkgs", pkginfo['uninstaller_item_location'])
+            os.path.join("pkgs", pkginfo['uninstaller_item_location'])
         except TypeError:
             errors.append("WARNING: invalid uninstaller_item_location "
                           "in %s" % pkginfo_ref)
             return False
 
         # Check if the uninstaller item actually exists
-        if not uninstalleritempath in pkgs_list:
-            # do a case-insensitive comparison
-            found_caseinsensitive_match = False
-            for repo_pkg in pkgs_list:
-                if uninstalleritempath.lower() == repo_pkg.lower():
-                    errors.append(
-                        "WARNING: %s refers to uninstaller item: %s. "
-                        "The pathname of the item in the repo has "
-                        "different case: %s. This may cause issues "
-                        "depending on the case-sensitivity of the "
-                        "underlying filesystem."
-                        % (pkginfo_ref,
-                           pkginfo['uninstaller_item_location'], repo_pkg))
-                    found_caseinsensitive_match = True
-                    break
-            if not found_caseinsensitive_match:
-                errors.append(
-                    "WARNING: %s refers to missing uninstaller item: %s"
-                    % (pkginfo_ref, pkginfo['uninstaller_item_location']))
-                return False
+        if not _verify_item_exists(
+                pkginfo_ref, pkginfo['uninstaller_item_location'],
+                'uninstaller', pkgs_list, errors):
+            return False
 
     # if we get here we passed all the checks
     return True
 
 
-def process_pkgsinfo(repo, options, output_fn=None):
-    '''Processes pkginfo files and returns a dictionary of catalogs'''
+def ingest_pkginfo(pkginfo_ref, data, options, pkgs_list,
+                   indexed_pkgsinfo=None):
+    '''Parses, strips and verifies a single pkginfo item given its data.
+    Returns a tuple of (pkginfo, digest, include, errors). pkginfo is None if
+    the item could not be parsed or has no name; include is False if the item
+    failed verification and should be left out of the catalogs. If
+    indexed_pkgsinfo is given, digest is the sha256 of the pkginfo data and
+    an unchanged indexed pkginfo is used instead of parsing the data again;
+    otherwise digest is None. data may be None if the repo's item metadata
+    already shows the indexed pkginfo is unchanged.
+    Does not modify any shared state, so it is safe to call from multiple
+    threads at once.'''
+    errors = []
+    digest = None
+    # Try to parse the pkginfo file
+    try:
+        if indexed_pkgsinfo is None:
+            pkginfo = plistlib.readPlistFromString(data)
+        elif data is None:
+            indexed = indexed_pkgsinfo[pkginfo_ref]
+            digest = indexed['sha256']
+            pkginfo = indexed['pkginfo']
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+            indexed = indexed_pkgsinfo.get(pkginfo_ref)
+            if indexed and indexed['sha256'] == digest:
+                # unchanged since last time; no need to parse it again
+                pkginfo = indexed['pkginfo']
+            else:
+                pkginfo = plistlib.readPlistFromString(data)
+    except IOError, err:
+        errors.append("IO error for %s: %s" % (pkginfo_ref, err))
+        return None, digest, False, errors
+    except BaseException, err:
+        errors.append("Unexpected error for %s: %s" % (pkginfo_ref, err))
+        return None, digest, False, errors
+
+    if not 'name' in pkginfo:
+        errors.append("WARNING: %s is missing name" % pkginfo_ref)
+        return None, digest, False, errors
+
+    # don't copy admin notes to catalogs.
+    if pkginfo.get('notes'):
+        del pkginfo['notes']
+    # strip out any keys that start with "_"
+    # (example: pkginfo _metadata)
+    for key in pkginfo.keys():
+        if key.startswith('_'):
+            del pkginfo[key]
+
+    # sanity checking
+    include = True
+    if not options.skip_payload_check:
+        verified = verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors)
+        if not verified and not options.force:
+            # Skip this pkginfo unless we're running with force flag
+            include = False
+
+    return pkginfo, digest, include, errors
+
+
+def process_pkgsinfo(repo, options, output_fn=None, index=None):
+    '''Processes pkginfo files and returns a dictionary of catalogs.
+    If an index (as returned by load_index()) is given, pkginfo files whose
+    content is unchanged since the index was built are not re-parsed, those
+    whose etag (from repo.itemlist_with_metadata()) is unchanged are not
+    even read, and the index is updated in place to reflect the current
+    pkginfo files and catalog signatures.
+    options.jobs is how many pkginfo items to read, and to parse and verify,
+    at once. If it is None, items are parsed one at a time and the repo
+    plugin decides how many to read at once.'''
     errors = []
     catalogs = {}
     # get a list of pkgsinfo items
     if output_fn:
         output_fn("Getting list of pkgsinfo...")
+    etags = {}
     try:
-        pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
+        if index is None:
+            pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
+        else:
+            # we'll want etags (if the repo plugin has them) to find the
+            # pkginfo items that haven't changed since they were indexed
+            pkgsinfo_list = []
+            for name, metadata in repo.itemlist_with_metadata('pkgsinfo'):
+                pkginfo_ref = os.path.join('pkgsinfo', name)
+                pkgsinfo_list.append(pkginfo_ref)
+                etags[pkginfo_ref] = metadata.get('etag')
     except munkirepo.RepoError, err:
         raise MakeCatalogsError(
             "Error getting list of pkgsinfo items: %s" % unicode(err))
@@ -173,7 +409,8 @@ def process_pkgsinfo(repo, options, output_fn=None):
     if output_fn:
         output_fn("Getting list of pkgs...")
     try:
-        pkgs_list = list_items_of_kind(repo, 'pkgs')
+        # indexed once, for verifying all the pkginfo items
+        pkgs_list = PkgsIndex(list_items_of_kind(repo, 'pkgs'))
     except munkirepo.RepoError, err:
         raise MakeCatalogsError(
             "Error getting list of pkgs items: %s" % unicode(err))
@@ -182,41 +419,64 @@ def process_pkgsinfo(repo, options, output_fn=None):
     catalogs = {}
     catalogs['all'] = []
 
-    # Walk through the pkginfo files
-    for pkginfo_ref in pkgsinfo_list:
-        # Try to read the pkginfo file
-        try:
-            data = repo.get(pkginfo_ref)
-            pkginfo = plistlib.readPlistFromString(data)
-        except IOError, err:
-            errors.append("IO error for %s: %s" % (pkginfo_ref, err))
-            continue
-        except BaseException, err:
-            errors.append("Unexpected error for %s: %s" % (pkginfo_ref, err))
+    indexed_pkgsinfo = None
+    unchanged = set()
+    if index is not None:
+        indexed_pkgsinfo = index['pkgsinfo']
+        index['pkgsinfo'] = {}
+        catalog_members = {'all': []}
+        # no need to even read pkginfo items whose etag matches the index
+        unchanged = set(
+            pkginfo_ref for pkginfo_ref in pkgsinfo_list
+            if etags.get(pkginfo_ref) and
+            indexed_pkgsinfo.get(pkginfo_ref, {}).get('etag') ==
+            etags[pkginfo_ref])
+
+    def pkginfo_items():
+        '''Yields a (pkginfo_ref, data, err) tuple for each pkginfo item in
+        order, reading only those not known to be unchanged'''
+        fetched = repo.get_many(
+            [pkginfo_ref for pkginfo_ref in pkgsinfo_list
+             if pkginfo_ref not in unchanged],
+            concurrency=options.jobs)
+        for pkginfo_ref in pkgsinfo_list:
+            if pkginfo_ref in unchanged:
+                yield pkginfo_ref, None, None
+            else:
+                yield next(fetched)
+
+    def ingest(item):
+        '''Ingests a single pkginfo item; may be called from worker
+        threads'''
+        pkginfo_ref, data, err = item
+        if err:
+            return (None, None, False,
+                    ["Unexpected error for %s: %s" % (pkginfo_ref, err)])
+        return ingest_pkginfo(pkginfo_ref, data, options, pkgs_list,
+                              indexed_pkgsinfo=indexed_pkgsinfo)
+
+    # Walk through the pkginfo files, reading and then parsing and verifying
+    # options.jobs of them at once. Results come back in pkgsinfo_list order
+    # so the catalogs come out the same either way.
+    results = concurrent_imap(
+        ingest, pkginfo_items(), int(options.jobs or 1))
+    for pkginfo_ref, result in itertools.izip(pkgsinfo_list, results):
+        pkginfo, digest, include, pkginfo_errors = result
+        errors.extend(pkginfo_errors)
+        if pkginfo is None:
             continue
 
-        if not 'name' in pkginfo:
-            errors.append("WARNING: %s is missing name" % pkginfo_ref)
+        if index is not None:
+            index['pkgsinfo'][pkginfo_ref] = {'sha256': digest,
+                                              'etag': etags.get(pkginfo_ref),
+                                              'pkginfo': pkginfo}
+        if not include:
             continue
 
-        # don't copy admin notes to catalogs.
-        if pkginfo.get('notes'):
-            del pkginfo['notes']
-        # strip out any keys that start with "_"
-        # (example: pkginfo _metadata)
-        for key in pkginfo.keys():
-            if key.startswith('_'):
-                del pkginfo[key]
-
-        # sanity checking
-        if not options.skip_payload_check:
-            verified = verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors)
-            if not verified and not options.force:
-                # Skip this pkginfo unless we're running with force flag
-                continue
-
         # append the pkginfo to the relevant catalogs
         catalogs['all'].append(pkginfo)
+        if index is not None:
+            catalog_members['all'].append(pkginfo_ref)
         for catalogname in pkginfo.get("catalogs", []):
             if not catalogname:
                 errors.append("WARNING: %s has an empty catalogs array!"
@@ -225,8 +485,12 @@ def process_pkgsinfo(repo, options, output_fn=None):
             if not catalogname in catalogs:
                 catalogs[catalogname] = []
             catalogs[catalogname].append(pkginfo)
+            if index is not None:
+                catalog_members.setdefault(catalogname, []).append(
+                    pkginfo_ref)
             if output_fn:
-                output_fn("Adding %s to %s..." % (pkginfo_ref, catalogname))
+                output_fn(
+                    "Adding %s to %s..." % (pkginfo_ref, catalogname))
 
     # look for catalog names that differ only in case
     duplicate_catalogs = []
@@ -239,62 +503,122 @@ def process_pkgsinfo(repo, options, output_fn=None):
                       "sensitivity of the underlying filesystem: %s"
                       % duplicate_catalogs)
 
+    if index is not None:
+        index['catalogs'] = dict(
+            (catalogname, catalog_signature(catalog_members[catalogname], index))
+            for catalogname in catalog_members)
+
     return catalogs, errors
 
 
 def makecatalogs(repo, options, output_fn=None):
     '''Assembles all pkginfo files into catalogs.
     User calling this needs to be able to write to the repo/catalogs
-    directory.'''
+    directory.
+    If options.incremental is set, a local index of parsed pkginfo files is
+    used to avoid re-parsing unchanged pkginfo files and re-writing unchanged
+    catalogs. The index is stored at options.index_path, or at
+    default_index_path(repo) if that isn't set.
+    If options.catalog_db is set, a precompiled catalog db is written
+    alongside each catalog. Catalog dbs are removed along with their
+    catalog.'''
 
     if isinstance(options, dict):
         options = AttributeDict(options)
 
-    icons, errors = hash_icons(repo, output_fn=output_fn)
+    index = None
+    previous_signatures = {}
+    if options.incremental:
+        index_path = options.index_path or default_index_path(repo)
+        index = load_index(index_path)
+        previous_signatures = index['catalogs']
+
+    icons, errors = hash_icons(repo, output_fn=output_fn, index=index,
+                               jobs=options.jobs)
 
     catalogs, catalog_errors = process_pkgsinfo(
-        repo, options, output_fn=output_fn)
+        repo, options, output_fn=output_fn, index=index)
 
     errors.extend(catalog_errors)
 
-    # clear out old catalogs
+    # clear out old catalogs, and the catalog dbs of catalogs that no longer
+    # exist. Other catalog dbs are left alone even without options.catalog_db;
+    # clients don't use a db that doesn't match its catalog.
     try:
         catalog_list = repo.itemlist('catalogs')
     except munkirepo.RepoError:
         catalog_list = []
-    for catalog_name in catalog_list:
-        if catalog_name not in catalogs.keys():
-            catalog_ref = os.path.join('catalogs', catalog_name)
-            try:
-                repo.delete(catalog_ref)
-            except munkirepo.RepoError:
-                errors.append('Could not delete catalog %s' % catalog_name)
+    catalogs_to_keep = set(catalogs)
+    catalogs_to_keep.update(
+        catalogdb.catalog_db_name(key) for key in catalogs)
+    old_catalogs = [catalog_name for catalog_name in catalog_list
+                    if catalog_name not in catalogs_to_keep]
+    failures = repo.delete_many(
+        [os.path.join('catalogs', catalog_name)
+         for catalog_name in old_catalogs], concurrency=options.jobs)
+    for catalog_name in old_catalogs:
+        if os.path.join('catalogs', catalog_name) in failures:
+            errors.append('Could not delete catalog %s' % catalog_name)
 
     # write the new catalogs
+    catalog_data = {}
     for key in catalogs:
         catalogpath = os.path.join("catalogs", key)
         if len(catalogs[key]):
-            catalog_data = plistlib.writePlistToString(catalogs[key])
-            try:
-                repo.put(catalogpath, catalog_data)
+            if (index is not None and key in catalog_list and
+                    previous_signatures.get(key) == index['catalogs'][key] and
+                    (not options.catalog_db or
+                     catalogdb.catalog_db_name(key) in catalog_list)):
+                # same pkginfo items with the same content as last time
                 if output_fn:
-                    output_fn("Created %s..." % catalogpath)
-            except munkirepo.RepoError, err:
-                errors.append(
-                    u'Failed to create catalog %s: %s' % (key, unicode(err)))
+                    output_fn("Skipped unchanged %s..." % catalogpath)
+                continue
+            catalog_data[catalogpath] = plistlib.writePlistToString(
+                catalogs[key])
+            if options.catalog_db:
+                try:
+                    catalog_data[
+                        catalogpath + catalogdb.CATALOG_DB_EXTENSION] = (
+                            catalogdb.dumps_catalog_db(
+                                catalogs[key], catalogdb.catalog_hash(
+                                    catalog_data[catalogpath])))
+                except catalogdb.CatalogDBError, err:
+                    # clients will just use the catalog itself
+                    errors.append(
+                        u'WARNING: Did not create catalog db for %s: %s'
+                        % (key, unicode(err)))
         else:
             errors.append(
                 "WARNING: Did not create catalog %s because it is empty" % key)
+    failures = repo.put_many(catalog_data, concurrency=options.jobs)
+    for key in catalogs:
+        catalogpath = os.path.join("catalogs", key)
+        if catalogpath in failures:
+            errors.append(u'Failed to create catalog %s: %s'
+                          % (key, unicode(failures[catalogpath])))
+            if index is not None:
+                # make sure we try again next time
+                del index['catalogs'][key]
+        elif catalogpath in catalog_data and output_fn:
+            output_fn("Created %s..." % catalogpath)
+        dbpath = catalogpath + catalogdb.CATALOG_DB_EXTENSION
+        if dbpath in failures:
+            # clients will just use the catalog itself
+            errors.append(u'WARNING: Failed to create catalog db %s: %s'
+                          % (dbpath, unicode(failures[dbpath])))
+        elif dbpath in catalog_data and output_fn:
+            output_fn("Created %s..." % dbpath)
 
     if icons:
-        icon_hashes_plist = os.path.join("icons", "_icon_hashes.plist")
-        icon_hashes = plistlib.writePlistToString(icons)
+        errors.extend(write_icon_hashes(repo, icons, output_fn=output_fn))
+
+    if index is not None:
         try:
-            repo.put(icon_hashes_plist, icon_hashes)
-            print "Created %s..." % (icon_hashes_plist)
-        except munkirepo.RepoError, err:
+            save_index(index_path, index)
+        except (IOError, OSError), err:
             errors.append(
-                u'Failed to create %s: %s' % (icon_hashes_plist, unicode(err)))
+                u'WARNING: Could not save pkginfo index to %s: %s'
+                % (index_path, unicode(err)))
 
     # Return and errors
     return errors
@@ -0,0 +1,250 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+manifestindex
+
+An index of a repo's parsed manifests, used by manifestutil.
+
+The index keeps every manifest parsed in memory, along with reverse maps
+from the values in each manifest to the manifests and sections they appear
+in, and from each manifest to the manifests that include it. refresh()
+brings the index up to date by listing the manifests with their etags
+(repo.itemlist_with_metadata()) and reading only those that are new or
+have changed. The index can also be kept on disk between runs.
+"""
+
+# std libs
+import cPickle
+import hashlib
+import itertools
+import os
+import plistlib
+
+from xml.parsers.expat import ExpatError
+
+# our libs
+from .. import munkirepo
+
+
+# bump this if the structure of the stored index changes
+INDEX_FORMAT_VERSION = 1
+INDEX_CACHE_DIR = os.path.expanduser(
+    '~/Library/Caches/com.googlecode.munki.manifestutil')
+
+
+def default_index_path(repo):
+    '''Returns the path of the local manifest index for repo. Indexes are
+    kept in the user's cache directory, one per repo URL.'''
+    baseurl = getattr(repo, 'baseurl', '') or ''
+    if isinstance(baseurl, unicode):
+        baseurl = baseurl.encode('UTF-8')
+    return os.path.join(
+        INDEX_CACHE_DIR, hashlib.sha256(baseurl).hexdigest() + '.index')
+
+
+class ManifestIndex(object):
+    '''Parsed manifests from a repo, with reverse maps for searching'''
+
+    def __init__(self, repo, index_path=None):
+        '''If index_path is given, the index is loaded from and saved to
+        that file'''
+        self.repo = repo
+        self.index_path = index_path
+        # manifest name -> {'etag': etag, 'manifest': parsed manifest}
+        self.entries = {}
+        self.names = []
+        # uppercased value -> list of (order, manifest name, key, value)
+        self.values = {}
+        # manifest name -> names of the manifests including it
+        self.includers = {}
+        if index_path:
+            self._load()
+
+    def _load(self):
+        '''Loads the entries stored at index_path, if any'''
+        try:
+            fileref = open(self.index_path, 'rb')
+            try:
+                stored = cPickle.load(fileref)
+            finally:
+                fileref.close()
+        except (IOError, OSError, EOFError, AttributeError, ImportError,
+                IndexError, ValueError, cPickle.UnpicklingError):
+            return
+        if (isinstance(stored, dict) and
+                stored.get('version') == INDEX_FORMAT_VERSION):
+            self.entries = stored['manifests']
+
+    def save(self):
+        '''Writes the index to index_path, if there is one. The index is
+        written to a temporary file first and then moved into place. Raises
+        IOError or OSError on failure.'''
+        if not self.index_path:
+            return
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir, 0755)
+        temp_path = self.index_path + '.tmp'
+        fileref = open(temp_path, 'wb')
+        try:
+            cPickle.dump({'version': INDEX_FORMAT_VERSION,
+                          'manifests': self.entries},
+                         fileref, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fileref.close()
+        os.rename(temp_path, self.index_path)
+
+    def refresh(self):
+        '''Brings the index up to date with the repo's manifests, reading
+        only those whose etag has changed (or all of them, if the repo
+        plugin doesn't supply etags). Returns a list of errors; manifests
+        that can't be read or parsed are left out of the index.'''
+        errors = []
+        try:
+            listing = self.repo.itemlist_with_metadata('manifests')
+        except munkirepo.RepoError, err:
+            return [u'Could not retrieve manifests: %s' % unicode(err)]
+        entries = {}
+        to_read = []
+        for name, metadata in listing:
+            etag = metadata.get('etag')
+            entry = self.entries.get(name)
+            if etag and entry and entry['etag'] == etag:
+                entries[name] = entry
+            else:
+                to_read.append((name, etag))
+        changed = bool(to_read) or len(entries) != len(self.entries)
+
+        manifest_refs = [os.path.join('manifests', name)
+                         for name, dummy_etag in to_read]
+        for (name, etag), (manifest_ref, data, err) in itertools.izip(
+                to_read, self.repo.get_many(manifest_refs)):
+            if err:
+                errors.append(
+                    u'Error reading %s: %s' % (manifest_ref, unicode(err)))
+                continue
+            try:
+                manifest = plistlib.readPlistFromString(data)
+            except (IOError, OSError, ExpatError), err:
+                errors.append(
+                    u'Error reading %s: %s' % (manifest_ref, unicode(err)))
+                continue
+            entries[name] = {'etag': etag, 'manifest': manifest}
+
+        self.entries = entries
+        self._build_maps()
+        if changed:
+            try:
+                self.save()
+            except (IOError, OSError), err:
+                errors.append(
+                    u'WARNING: Could not save manifest index to %s: %s'
+                    % (self.index_path, unicode(err)))
+        return errors
+
+    def _build_maps(self):
+        '''Rebuilds the sorted names and the reverse maps from entries'''
+        self.names = sorted(self.entries)
+        self.values = {}
+        self.includers = {}
+        for manifest_number, name in enumerate(self.names):
+            manifest = self.entries[name]['manifest']
+            for key_number, key in enumerate(manifest.keys()):
+                value = manifest[key]
+                if isinstance(value, list):
+                    items = value
+                else:
+                    items = [value]
+                for item_number, item in enumerate(items):
+                    if not isinstance(item, basestring):
+                        continue
+                    self.values.setdefault(item.upper(), []).append(
+                        ((manifest_number, key_number, item_number),
+                         name, key, item))
+            for included in manifest.get('included_manifests') or []:
+                if isinstance(included, basestring):
+                    self.includers.setdefault(included, []).append(name)
+
+    def get(self, name):
+        '''Returns the parsed manifest name, or None if it isn't in the
+        index'''
+        entry = self.entries.get(name)
+        if entry:
+            return entry['manifest']
+        return None
+
+    def update(self, name, manifest):
+        '''Records that manifest has been saved under name. Its etag isn't
+        known, so the next refresh() reads it again.'''
+        self.entries[name] = {'etag': None, 'manifest': manifest}
+        self._build_maps()
+
+    def remove(self, name):
+        '''Records that the manifest name has been deleted'''
+        if name in self.entries:
+            del self.entries[name]
+            self._build_maps()
+
+    def find(self, findtext, section=None):
+        '''Returns a list of (manifest name, key, value) for each string in
+        the manifests (or in their section key) that contains findtext,
+        ignoring case. Results are in manifest name order, then in the order
+        of the keys and items within each manifest.'''
+        findtext = findtext.upper()
+        matches = []
+        for value, occurrences in self.values.items():
+            if findtext in value:
+                matches.extend(occurrence for occurrence in occurrences
+                               if section is None or
+                               occurrence[2] == section)
+        matches.sort()
+        return [(name, key, item) for dummy_order, name, key, item in matches]
+
+    def manifests_containing(self, item_name, section=None):
+        '''Returns a list of (manifest name, key) for each place item_name
+        appears in the manifests (or in their section key)'''
+        occurrences = sorted(self.values.get(item_name.upper(), []))
+        return [(name, key) for dummy_order, name, key, item in occurrences
+                if item == item_name and (section is None or key == section)]
+
+    def including_manifests(self, name):
+        '''Returns the names of the manifests that directly include the
+        manifest name'''
+        return sorted(self.includers.get(name, []))
+
+    def expand(self, name, include_path=()):
+        '''Returns a copy of the manifest name with each of its
+        included_manifests replaced by a {name: expanded manifest} dict.
+        An included manifest that isn't in the index, or that would include
+        itself, is given as {name: None}.'''
+        manifest = self.get(name)
+        if manifest is None:
+            return None
+        manifest = dict(manifest)
+        if 'included_manifests' in manifest:
+            include_path = include_path + (name,)
+            expanded = []
+            for item in manifest['included_manifests']:
+                if item in include_path:
+                    expanded.append({item: None})
+                else:
+                    expanded.append({item: self.expand(item, include_path)})
+            manifest['included_manifests'] = expanded
+        return manifest
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
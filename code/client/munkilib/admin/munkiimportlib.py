@@ -21,10 +21,15 @@ Routines used by munkimport to import items into Munki repo
 """
 
 # std lib imports
+import itertools
 import os
 import sys
 
+import objc
+
 # our lib imports
+from . import catalogindex
+from . import pkginfolib
 from .common import list_items_of_kind
 from .. import iconutils
 from .. import dmgutils
@@ -35,6 +40,7 @@ from .. import osutils
 from .. import pkgutils
 from .. import FoundationPlist
 from ..cliutils import pref
+from ..utils import concurrent_imap
 
 
 class RepoCopyError(Exception):
@@ -42,12 +48,10 @@ class RepoCopyError(Exception):
     pass
 
 
-def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
-    """Copies an item to the appropriate place in the repo.
-    If itempath is a path within the repo/pkgs directory, copies nothing.
-    Renames the item if an item already exists with that name.
-    Returns the relative path to the item."""
-
+def unique_item_path(itempath, vers, subdirectory, pkgs_list):
+    """Returns the relative repo path to copy the item at itempath to: its
+    name, with vers added if it isn't already there, in pkgs/subdirectory.
+    Numbers are added to the name until it isn't in pkgs_list."""
     destination_path = os.path.join('pkgs', subdirectory)
     item_name = os.path.basename(itempath)
     destination_path_name = os.path.join(destination_path, item_name)
@@ -60,17 +64,27 @@ def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
             destination_path_name = os.path.join(destination_path, item_name)
 
     index = 0
-    try:
-        pkgs_list = list_items_of_kind(repo, 'pkgs')
-    except munkirepo.RepoError, err:
-        raise RepoCopyError(u'Unable to get list of current pkgs: %s'
-                            % unicode(err))
     while destination_path_name in pkgs_list:
         #print 'File %s already exists...' % destination_path_name
         # try appending numbers until we have a unique name
         index += 1
         item_name = '%s__%s%s' % (name, index, ext)
         destination_path_name = os.path.join(destination_path, item_name)
+    return destination_path_name
+
+
+def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
+    """Copies an item to the appropriate place in the repo.
+    If itempath is a path within the repo/pkgs directory, copies nothing.
+    Renames the item if an item already exists with that name.
+    Returns the relative path to the item."""
+    try:
+        pkgs_list = list_items_of_kind(repo, 'pkgs')
+    except munkirepo.RepoError, err:
+        raise RepoCopyError(u'Unable to get list of current pkgs: %s'
+                            % unicode(err))
+    destination_path_name = unique_item_path(
+        itempath, vers, subdirectory, pkgs_list)
 
     try:
         repo.put_from_local_file(destination_path_name, itempath)
@@ -81,10 +95,10 @@ def copy_item_to_repo(repo, itempath, vers, subdirectory=''):
         return destination_path_name
 
 
-def copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
-    """Saves pkginfo to <munki_repo>/pkgsinfo/subdirectory"""
-    # less error checking because we copy the installer_item
-    # first and bail if it fails...
+def unique_pkginfo_path(pkginfo, subdirectory, pkgsinfo_list):
+    """Returns the relative repo path to save pkginfo to in
+    pkgsinfo/subdirectory. Numbers are added to the name until it isn't in
+    pkgsinfo_list."""
     destination_path = os.path.join('pkgsinfo', subdirectory)
     pkginfo_ext = pref('pkginfo_extension') or ''
     if pkginfo_ext and not pkginfo_ext.startswith('.'):
@@ -93,16 +107,24 @@ def copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
                                 pkginfo_ext)
     pkginfo_path = os.path.join(destination_path, pkginfo_name)
     index = 0
-    try:
-        pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
-    except munkirepo.RepoError, err:
-        raise RepoCopyError(u'Unable to get list of current pkgsinfo: %s'
-                            % unicode(err))
     while pkginfo_path in pkgsinfo_list:
         index += 1
         pkginfo_name = '%s-%s__%s%s' % (pkginfo['name'], pkginfo['version'],
                                         index, pkginfo_ext)
         pkginfo_path = os.path.join(destination_path, pkginfo_name)
+    return pkginfo_path
+
+
+def copy_pkginfo_to_repo(repo, pkginfo, subdirectory=''):
+    """Saves pkginfo to <munki_repo>/pkgsinfo/subdirectory"""
+    # less error checking because we copy the installer_item
+    # first and bail if it fails...
+    try:
+        pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
+    except munkirepo.RepoError, err:
+        raise RepoCopyError(u'Unable to get list of current pkgsinfo: %s'
+                            % unicode(err))
+    pkginfo_path = unique_pkginfo_path(pkginfo, subdirectory, pkgsinfo_list)
 
     try:
         pkginfo_str = FoundationPlist.writePlistToString(pkginfo)
@@ -132,110 +154,26 @@ class CatalogDecodeException(CatalogDBException):
 
 
 def make_catalog_db(repo):
-    """Returns a dict we can use like a database"""
+    """Returns a dict we can use like a database. The catalog is only
+    indexed once per process (and again only when it changes), so this is
+    cheap to call for each item being imported."""
 
-    try:
-        plist = repo.get('catalogs/all')
-    except munkirepo.RepoError, err:
-        raise CatalogReadException(err)
+    def warn(message):
+        '''Prints a warning about the catalog'''
+        print >> sys.stderr, message
 
     try:
-        catalogitems = FoundationPlist.readPlistFromString(plist)
-    except FoundationPlist.NSPropertyListSerializationException, err:
+        return catalogindex.get_catalog_index(repo, 'all', warning_fn=warn)
+    except catalogindex.CatalogReadError, err:
+        raise CatalogReadException(err)
+    except catalogindex.CatalogDecodeError, err:
         raise CatalogDecodeException(err)
 
-    pkgid_table = {}
-    app_table = {}
-    installer_item_table = {}
-    hash_table = {}
-    profile_table = {}
-
-    itemindex = -1
-    for item in catalogitems:
-        itemindex = itemindex + 1
-        name = item.get('name', 'NO NAME')
-        vers = item.get('version', 'NO VERSION')
-
-        if name == 'NO NAME' or vers == 'NO VERSION':
-            print >> sys.stderr, 'WARNING: Bad pkginfo: %s' % item
-
-        # add to hash table
-        if 'installer_item_hash' in item:
-            if not item['installer_item_hash'] in hash_table:
-                hash_table[item['installer_item_hash']] = []
-            hash_table[item['installer_item_hash']].append(itemindex)
-
-        # add to installer item table
-        if 'installer_item_location' in item:
-            installer_item_name = os.path.basename(
-                item['installer_item_location'])
-            (name, ext) = os.path.splitext(installer_item_name)
-            if '-' in name:
-                (name, vers) = pkgutils.nameAndVersion(name)
-            installer_item_name = name + ext
-            if not installer_item_name in installer_item_table:
-                installer_item_table[installer_item_name] = {}
-            if not vers in installer_item_table[installer_item_name]:
-                installer_item_table[installer_item_name][vers] = []
-            installer_item_table[installer_item_name][vers].append(itemindex)
-
-        # add to table of receipts
-        for receipt in item.get('receipts', []):
-            try:
-                if 'packageid' in receipt and 'version' in receipt:
-                    pkgid = receipt['packageid']
-                    pkgvers = receipt['version']
-                    if not pkgid in pkgid_table:
-                        pkgid_table[pkgid] = {}
-                    if not pkgvers in pkgid_table[pkgid]:
-                        pkgid_table[pkgid][pkgvers] = []
-                    pkgid_table[pkgid][pkgvers].append(itemindex)
-            except TypeError:
-                print >> sys.stderr, (
-                    'Bad receipt data for %s-%s: %s' % (name, vers, receipt))
-
-        # add to table of installed applications
-        for install in item.get('installs', []):
-            try:
-                if install.get('type') == 'application':
-                    if 'path' in install:
-                        if not install['path'] in app_table:
-                            app_table[install['path']] = {}
-                        if not vers in app_table[install['path']]:
-                            app_table[install['path']][vers] = []
-                        app_table[install['path']][vers].append(itemindex)
-            except TypeError:
-                print >> sys.stderr, (
-                    'Bad install data for %s-%s: %s' % (name, vers, install))
-
-        # add to table of PayloadIdentifiers
-        if 'PayloadIdentifier' in item:
-            if not item['PayloadIdentifier'] in profile_table:
-                profile_table[item['PayloadIdentifier']] = {}
-            if not vers in profile_table[item['PayloadIdentifier']]:
-                profile_table[item['PayloadIdentifier']][vers] = []
-            profile_table[item['PayloadIdentifier']][vers].append(itemindex)
-
-    pkgdb = {}
-    pkgdb['hashes'] = hash_table
-    pkgdb['receipts'] = pkgid_table
-    pkgdb['applications'] = app_table
-    pkgdb['installer_items'] = installer_item_table
-    pkgdb['profiles'] = profile_table
-    pkgdb['items'] = catalogitems
-
-    return pkgdb
-
 
 def find_matching_pkginfo(repo, pkginfo):
     """Looks through repo catalogs looking for matching pkginfo
     Returns a pkginfo dictionary, or an empty dict"""
 
-    def compare_version_keys(value_a, value_b):
-        """Internal comparison function for use in sorting"""
-        return cmp(pkgutils.MunkiLooseVersion(value_b),
-                   pkgutils.MunkiLooseVersion(value_a))
-
     try:
         catdb = make_catalog_db(repo)
     except CatalogReadException, err:
@@ -267,8 +205,8 @@ def find_matching_pkginfo(repo, pkginfo):
         if pkgids:
             possiblematches = catdb['receipts'].get(pkgids[0])
             if possiblematches:
-                versionlist = possiblematches.keys()
-                versionlist.sort(compare_version_keys)
+                versionlist = sorted(possiblematches.keys(),
+                                     key=pkgutils.version_key, reverse=True)
                 # go through possible matches, newest version first
                 for versionkey in versionlist:
                     testpkgindexes = possiblematches[versionkey]
@@ -288,8 +226,8 @@ def find_matching_pkginfo(repo, pkginfo):
             app = applist[0]['path']
             possiblematches = catdb['applications'].get(app)
             if possiblematches:
-                versionlist = possiblematches.keys()
-                versionlist.sort(compare_version_keys)
+                versionlist = sorted(possiblematches.keys(),
+                                     key=pkgutils.version_key, reverse=True)
                 indexes = catdb['applications'][app][versionlist[0]]
                 return catdb['items'][indexes[0]]
 
@@ -297,8 +235,8 @@ def find_matching_pkginfo(repo, pkginfo):
         identifier = pkginfo['PayloadIdentifier']
         possiblematches = catdb['profiles'].get(identifier)
         if possiblematches:
-            versionlist = possiblematches.keys()
-            versionlist.sort(compare_version_keys)
+            versionlist = sorted(possiblematches.keys(),
+                                 key=pkgutils.version_key, reverse=True)
             indexes = catdb['profiles'][identifier][versionlist[0]]
             return catdb['items'][indexes[0]]
 
@@ -308,8 +246,8 @@ def find_matching_pkginfo(repo, pkginfo):
         pkginfo.get('installer_item_location', ''))
     possiblematches = catdb['installer_items'].get(installer_item_name)
     if possiblematches:
-        versionlist = possiblematches.keys()
-        versionlist.sort(compare_version_keys)
+        versionlist = sorted(possiblematches.keys(),
+                             key=pkgutils.version_key, reverse=True)
         indexes = catdb['installer_items'][installer_item_name][versionlist[0]]
         return catdb['items'][indexes[0]]
 
@@ -317,6 +255,129 @@ def find_matching_pkginfo(repo, pkginfo):
     return {}
 
 
+def import_items(repo, installer_items, options, jobs=1, output_fn=None):
+    """Imports several installer items without prompting, for batch mode.
+    Generates the pkginfo for each item, skips items identical to an item
+    already in the repo (or earlier in the batch), then copies the installer
+    items and pkginfo files to the repo. The catalog index used to spot
+    identical items is built only once for the whole batch.
+    If jobs is greater than 1, that many pkginfo items are generated at
+    once; the repo plugin may also copy several items at once.
+    Returns a list of (installer_item, pkginfo_path) tuples for the items
+    imported, and a list of errors."""
+    errors = []
+
+    def make_pkginfo(installer_item):
+        '''Generates the pkginfo for an item; may be called from worker
+        threads'''
+        with objc.autorelease_pool():
+            try:
+                return pkginfolib.makepkginfo(installer_item, options), None
+            except pkginfolib.PkgInfoGenerationError, err:
+                return None, err
+
+    try:
+        catdb = make_catalog_db(repo)
+    except CatalogDBException, err:
+        # as in find_matching_pkginfo(), a missing catalog is only worth
+        # mentioning if there are pkginfo items that should be in it
+        if (not isinstance(err, CatalogReadException) or
+                repo.itemlist('pkgsinfo')):
+            errors.append(u'WARNING: Could not get a list of existing items '
+                          u'from the repo: %s' % unicode(err))
+        catdb = {'hashes': {}, 'items': []}
+
+    # makepkginfo() uses the session's temporary directory, which is
+    # created on first use; create it now rather than racing to do so in
+    # the worker threads
+    osutils.tmpdir()
+
+    to_import = []
+    batch_hashes = {}
+    for installer_item, (pkginfo, err) in itertools.izip(
+            installer_items,
+            concurrent_imap(make_pkginfo, installer_items, int(jobs or 1))):
+        if err:
+            errors.append(u'Getting package info for %s failed: %s'
+                          % (installer_item, unicode(err)))
+            continue
+        itemhash = pkginfo.get('installer_item_hash')
+        if itemhash and itemhash != 'N/A':
+            if itemhash in catdb['hashes']:
+                existing = catdb['items'][catdb['hashes'][itemhash][0]]
+                if output_fn:
+                    output_fn(u'Skipping %s: identical to existing item '
+                              u'%s-%s' % (installer_item, existing.get('name'),
+                                          existing.get('version')))
+                continue
+            if itemhash in batch_hashes:
+                if output_fn:
+                    output_fn(u'Skipping %s: identical to %s'
+                              % (installer_item, batch_hashes[itemhash]))
+                continue
+            batch_hashes[itemhash] = installer_item
+        to_import.append((installer_item, pkginfo))
+    if not to_import:
+        return [], errors
+
+    # name everything before copying anything, so items that would get the
+    # same name in the repo don't overwrite each other
+    try:
+        pkgs_list = set(list_items_of_kind(repo, 'pkgs'))
+        pkgsinfo_list = set(list_items_of_kind(repo, 'pkgsinfo'))
+    except munkirepo.RepoError, err:
+        errors.append(u'Unable to get list of current repo items: %s'
+                      % unicode(err))
+        return [], errors
+    item_paths = []
+    for installer_item, pkginfo in to_import:
+        item_path = unique_item_path(installer_item, pkginfo.get('version'),
+                                     options.subdirectory, pkgs_list)
+        pkgs_list.add(item_path)
+        item_paths.append(item_path)
+
+    if output_fn:
+        output_fn(u'Copying %s items to repo...' % len(to_import))
+    failures = repo.put_many_from_local_files(
+        dict((item_path, installer_item) for item_path, (installer_item, _)
+             in itertools.izip(item_paths, to_import)))
+
+    imported = []
+    pkginfo_data = {}
+    for item_path, (installer_item, pkginfo) in itertools.izip(
+            item_paths, to_import):
+        if item_path in failures:
+            errors.append(u'Unable to copy %s to %s: %s'
+                          % (installer_item, item_path,
+                             unicode(failures[item_path])))
+            continue
+        # adjust the installer_item_location to match
+        # the actual location and name
+        pkginfo['installer_item_location'] = item_path.partition('/')[2]
+        add_icon_hash_to_pkginfo(pkginfo)
+        pkginfo_path = unique_pkginfo_path(
+            pkginfo, options.subdirectory, pkgsinfo_list)
+        pkgsinfo_list.add(pkginfo_path)
+        try:
+            pkginfo_data[pkginfo_path] = FoundationPlist.writePlistToString(
+                pkginfo)
+        except FoundationPlist.NSPropertyListWriteException, err:
+            errors.append(u'Unable to save pkginfo for %s: %s'
+                          % (installer_item, unicode(err)))
+            continue
+        imported.append((installer_item, pkginfo_path))
+
+    failures = repo.put_many(pkginfo_data)
+    for installer_item, pkginfo_path in imported:
+        if pkginfo_path in failures:
+            errors.append(u'Unable to save pkginfo to %s: %s'
+                          % (pkginfo_path, unicode(failures[pkginfo_path])))
+    imported = [(installer_item, pkginfo_path)
+                for installer_item, pkginfo_path in imported
+                if pkginfo_path not in failures]
+    return imported, errors
+
+
 def get_icon_path(pkginfo):
     """Return path for icon"""
     icon_name = pkginfo.get('icon_name') or pkginfo['name']
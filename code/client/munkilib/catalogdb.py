@@ -0,0 +1,228 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogdb.py
+
+Functions for building the indexed catalog databases used when checking for
+updates, and for reading and writing them as precompiled catalog db files.
+
+This module must not depend on PyObjC: makecatalogs uses it to build catalog
+db files alongside the catalogs it writes.
+"""
+
+import cPickle
+import cStringIO
+import datetime
+import hashlib
+
+from .versionutils import trim_version_string, version_key
+
+
+# bump this if the structure of the catalog db changes
+CATALOG_DB_FORMAT_VERSION = 3
+# a precompiled catalog db is stored next to its catalog, with this extension
+CATALOG_DB_EXTENSION = '.db'
+
+
+class CatalogDBError(Exception):
+    '''Error to raise when a catalog db file can't be used'''
+    pass
+
+
+def make_catalog_db(catalogitems, warning_fn=None):
+    """Takes an array of catalog items and builds some indexes so we can
+    get our common data faster. Returns a dict we can use like a database.
+    warning_fn, if given, is called with a format string and arguments for
+    each malformed item."""
+    name_table = {}
+    pkgid_table = {}
+
+    itemindex = -1
+    for item in catalogitems:
+        itemindex = itemindex + 1
+        name = item.get('name', 'NO NAME')
+        vers = item.get('version', 'NO VERSION')
+
+        if name == 'NO NAME' or vers == 'NO VERSION':
+            if warning_fn:
+                warning_fn('Bad pkginfo: %s', item)
+
+        # normalize the version number
+        vers = trim_version_string(vers)
+
+        # build indexes for items by name and version
+        if not name in name_table:
+            name_table[name] = {}
+        if not vers in name_table[name]:
+            name_table[name][vers] = []
+        name_table[name][vers].append(itemindex)
+
+        # build table of receipts
+        for receipt in item.get('receipts', []):
+            if 'packageid' in receipt and 'version' in receipt:
+                pkg_id = receipt['packageid']
+                version = receipt['version']
+                if not pkg_id in pkgid_table:
+                    pkgid_table[pkg_id] = {}
+                if not version in pkgid_table[pkg_id]:
+                    pkgid_table[pkg_id][version] = []
+                pkgid_table[pkg_id][version].append(itemindex)
+
+    # build table of update items with a list comprehension --
+    # filter all items from the catalogitems that have a non-empty
+    # 'update_for' list
+    updaters = [item for item in catalogitems if item.get('update_for')]
+
+    # now fix possible admin errors where 'update_for' is a string instead
+    # of a list of strings
+    for update in updaters:
+        if isinstance(update['update_for'], basestring):
+            # convert to list of strings
+            update['update_for'] = [update['update_for']]
+
+    # build a reverse index from each update_for value (an item name, or
+    # name-version or name--version) to the names of the items that are
+    # updates for it, so we don't have to search the updaters list
+    updates_table = {}
+    for update in updaters:
+        if not update.get('name'):
+            continue
+        for target in update['update_for']:
+            if not isinstance(target, basestring):
+                continue
+            if not target in updates_table:
+                updates_table[target] = []
+            if not update['name'] in updates_table[target]:
+                updates_table[target].append(update['name'])
+
+    # build table of autoremove items with a list comprehension --
+    # filter all items from the catalogitems that have a non-empty
+    # 'autoremove' list
+    # autoremove items are automatically removed if they are not in the
+    # managed_install list (either directly or indirectly via included
+    # manifests)
+    autoremoveitems = [item.get('name') for item in catalogitems
+                       if item.get('autoremove')]
+    # convert to set and back to list to get list of unique names
+    autoremoveitems = list(set(autoremoveitems))
+
+    # list the versions of each name newest first, so lookups don't need to
+    # sort them
+    versions_table = {}
+    for name in name_table:
+        versions_table[name] = sorted(
+            name_table[name], key=version_key, reverse=True)
+
+    pkgdb = {}
+    pkgdb['named'] = name_table
+    pkgdb['versions'] = versions_table
+    pkgdb['receipts'] = pkgid_table
+    pkgdb['updaters'] = updaters
+    pkgdb['updates'] = updates_table
+    pkgdb['autoremoveitems'] = autoremoveitems
+    pkgdb['items'] = catalogitems
+
+    return pkgdb
+
+
+def catalog_db_name(catalogname):
+    '''Returns the name of the precompiled catalog db file for catalogname'''
+    return catalogname + CATALOG_DB_EXTENSION
+
+
+def without_catalog_dbs(names):
+    '''Given a list of the names of the items in a catalogs directory,
+    returns the names that aren't the precompiled catalog db file of another
+    item in the list'''
+    all_names = set(names)
+    return [name for name in names
+            if not (name.endswith(CATALOG_DB_EXTENSION) and
+                    name[:-len(CATALOG_DB_EXTENSION)] in all_names)]
+
+
+def catalog_hash(catalogdata):
+    '''Returns the sha256 of the raw (XML) data of a catalog. A catalog db
+    file is only used if this matches the catalog it was built from.'''
+    return hashlib.sha256(catalogdata).hexdigest()
+
+
+def _plain_copy(value):
+    '''Returns a deep copy of a plist value made only of basic types and
+    dates, which are all a catalog db may contain. Raises CatalogDBError if
+    the value contains anything else (like binary data).'''
+    if isinstance(value, dict):
+        return dict((key, _plain_copy(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_plain_copy(item) for item in value]
+    if isinstance(value, (basestring, bool, int, long, float,
+                          datetime.datetime)):
+        return value
+    raise CatalogDBError(
+        '%s values can\'t be stored in a catalog db' % type(value).__name__)
+
+
+def dumps_catalog_db(catalogitems, catalog_sha256):
+    '''Builds the catalog db for catalogitems and returns it as a string in
+    the precompiled catalog db format. catalog_sha256 is the catalog_hash()
+    of the catalog the items were read from or written to. Raises
+    CatalogDBError if the items can't be stored in a catalog db.'''
+    # make_catalog_db fixes up some values in place, so this also leaves the
+    # caller's items as they were
+    catalogitems = _plain_copy(catalogitems)
+    return cPickle.dumps(
+        {'version': CATALOG_DB_FORMAT_VERSION,
+         'catalog_sha256': catalog_sha256,
+         'db': make_catalog_db(catalogitems)},
+        cPickle.HIGHEST_PROTOCOL)
+
+
+def loads_catalog_db(data, expected_catalog_hash, date_fn=None):
+    '''Returns the catalog db stored in data, a string in the precompiled
+    catalog db format. Raises CatalogDBError if the data can't be read, is
+    in a different format version, or wasn't built from the catalog with
+    the sha256 expected_catalog_hash.
+    Only dates may be reconstructed from the data; anything else that isn't
+    a basic type is refused. If date_fn is given, it is called with each
+    datetime.datetime and its result is used in place of the datetime.'''
+    def find_global(module, name):
+        '''Restricts the classes that can be reconstructed'''
+        if (module, name) == ('datetime', 'datetime'):
+            if date_fn:
+                return lambda *args: date_fn(datetime.datetime(*args))
+            return datetime.datetime
+        raise cPickle.UnpicklingError(
+            '%s.%s is not allowed in a catalog db' % (module, name))
+
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = find_global
+    try:
+        contents = unpickler.load()
+    except (EOFError, AttributeError, IndexError, KeyError, TypeError,
+            ValueError, cPickle.UnpicklingError), err:
+        raise CatalogDBError('Catalog db is invalid: %s' % err)
+    if not isinstance(contents, dict):
+        raise CatalogDBError('Catalog db is invalid')
+    if contents.get('version') != CATALOG_DB_FORMAT_VERSION:
+        raise CatalogDBError(
+            'Catalog db is in format version %s; expected version %s'
+            % (contents.get('version'), CATALOG_DB_FORMAT_VERSION))
+    if contents.get('catalog_sha256') != expected_catalog_hash:
+        raise CatalogDBError('Catalog db does not match its catalog')
+    return contents['db']
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
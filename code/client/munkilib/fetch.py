@@ -41,6 +41,7 @@ from Foundation import NSHTTPURLResponse
 #our libs
 from . import constants
 from . import display
+from . import httptransport
 from . import info
 from . import keychain
 from . import munkihash
@@ -190,7 +191,8 @@ def get_url(url, destinationpath,
             resume=False, follow_redirects=False):
     """Gets an HTTP or HTTPS URL and stores it in
     destination path. Returns a dictionary of headers, which includes
-    http_result_code and http_result_description.
+    http_result_code and http_result_description, and http_result_sha256
+    (the sha256 of the downloaded file) when a file was downloaded.
     Will raise ConnectionError if Gurl has a connection error.
     Will raise HTTPError if HTTP Result code is not 2xx or 304.
     Will raise GurlError if Gurl has some other error.
@@ -198,7 +200,9 @@ def get_url(url, destinationpath,
     indicate you only want to download the file only if it's newer on the
     server.
     If you set resume to True, Gurl will attempt to resume an
-    interrupted download."""
+    interrupted download.
+    If the HTTPTransport preference is 'python', the download is done by
+    httptransport.HTTPTransfer instead of Gurl."""
 
     tempdownloadpath = destinationpath + '.download'
     if os.path.exists(tempdownloadpath) and not resume:
@@ -225,6 +229,15 @@ def get_url(url, destinationpath,
                'download_only_if_changed': onlyifnewer,
                'cache_data': cache_data,
                'logging_function': display.display_debug2}
+    use_python_transport = (
+        str(prefs.pref('HTTPTransport') or '').lower() == 'python')
+    if use_python_transport:
+        options['ca_certificate'] = prefs.pref('SoftwareRepoCACertificate')
+        options['ca_path'] = prefs.pref('SoftwareRepoCAPath')
+        if prefs.pref('UseClientCertificate'):
+            options['client_certificate'] = prefs.pref(
+                'ClientCertificatePath')
+            options['client_key'] = prefs.pref('ClientKeyPath')
     display.display_debug2('Options: %s' % options)
 
     # Allow middleware to modify options
@@ -235,7 +248,10 @@ def get_url(url, destinationpath,
         options = middleware.process_request_options(options)
         display.display_debug2('Options: %s' % options)
 
-    connection = Gurl.alloc().initWithOptions_(options)
+    if use_python_transport:
+        connection = httptransport.HTTPTransfer(options)
+    else:
+        connection = Gurl.alloc().initWithOptions_(options)
     stored_percent_complete = -1
     stored_bytes_received = 0
     connection.start()
@@ -308,6 +324,10 @@ def get_url(url, destinationpath,
         except OSError, err:
             # Re-raise the error as a GurlError
             raise GurlError(-1, str(err))
+        if getattr(connection, 'sha256', None):
+            # the connection hashed the file as it was written
+            connection.headers['http_result_sha256'] = (
+                connection.sha256.hexdigest())
         return connection.headers
     elif connection.status == 304:
         # unchanged on server
@@ -347,6 +367,7 @@ def getResourceIfChangedAtomically(url,
        Raises a FetchError derived exception if there is an error."""
 
     changed = False
+    downloaded_hash = None
 
     # If we already have a downloaded file & its (cached) hash matches what
     # we need, do nothing, return unchanged.
@@ -379,6 +400,9 @@ def getResourceIfChangedAtomically(url,
             url, destinationpath,
             custom_headers=custom_headers,
             message=message, resume=resume, follow_redirects=follow_redirects)
+        if changed:
+            # hashed while downloading; see getHTTPfileIfChangedAtomically
+            downloaded_hash = getxattr(destinationpath, XATTR_SHA)
     elif url_parse.scheme == 'file':
         changed = getFileIfChangedAtomically(url_parse.path, destinationpath)
     else:
@@ -386,9 +410,9 @@ def getResourceIfChangedAtomically(url,
             'Unsupported scheme for %s: %s' % (url, url_parse.scheme))
 
     if changed and verify:
-        (verify_ok, fhash) = verifySoftwarePackageIntegrity(destinationpath,
-                                                            expected_hash,
-                                                            always_hash=True)
+        (verify_ok, fhash) = verifySoftwarePackageIntegrity(
+            destinationpath, expected_hash, always_hash=True,
+            file_hash=downloaded_hash)
         if not verify_ok:
             try:
                 os.unlink(destinationpath)
@@ -544,6 +568,11 @@ def getHTTPfileIfChangedAtomically(url, destinationpath,
         if header.get('etag'):
             # store etag in extended attribute for future use
             xattr.setxattr(destinationpath, XATTR_ETAG, header['etag'])
+        if header.get('http_result_sha256'):
+            # the file was hashed as it was downloaded; cache that so we
+            # don't need to read it again to verify it
+            writeCachedChecksum(
+                destinationpath, fhash=header['http_result_sha256'])
         return True
 
 
@@ -558,7 +587,8 @@ def getURLitemBasename(url):
     return os.path.basename(url_parse.path)
 
 
-def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False):
+def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False,
+                                   file_hash=None):
     """Verifies the integrity of the given software package.
 
     The feature is controlled through the PackageVerificationMode key in
@@ -577,15 +607,17 @@ def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False):
         item_hash: the sha256 hash expected.
         always_hash: True/False always check (& return) the hash even if not
                 necessary for this function.
+        file_hash: the sha256 hash of file_path, if already known (for
+                instance, because it was calculated during the download).
 
     Returns:
         (True/False, sha256-hash)
         True if the package integrity could be validated. Otherwise, False.
     """
     mode = prefs.pref('PackageVerificationMode')
-    chash = None
+    chash = file_hash
     item_name = getURLitemBasename(file_path)
-    if always_hash:
+    if always_hash and not chash:
         chash = munkihash.getsha256hash(file_path)
 
     if not mode:
@@ -22,6 +22,7 @@ Modified in Feb 2016 to add support for NSURLSession.
 curl replacement using NSURLConnection and friends
 """
 
+import hashlib
 import os
 from urlparse import urlparse
 import xattr
@@ -29,6 +30,8 @@ import xattr
 # builtin super doesn't work with Cocoa classes in recent PyObjC releases.
 from objc import super
 
+from .munkihash import update_hash
+
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
 # pylint: disable=E0611
@@ -204,6 +207,8 @@ class Gurl(NSObject):
         self.done = False
         self.redirection = []
         self.destination = None
+        # sha256 of the file as it's written, so it needn't be read again
+        self.sha256 = None
         self.bytesReceived = 0
         self.expectedLength = -1
         self.percentComplete = 0
@@ -445,10 +450,14 @@ class Gurl(NSObject):
                 self.expectedLength += local_filesize
                 # open file for append
                 self.destination = open(self.destination_path, 'a')
+                # the hash has to cover what we already have
+                self.sha256 = hashlib.sha256()
+                update_hash(self.sha256, self.destination_path)
 
             elif str(self.status).startswith('2'):
                 # not resuming, just open the file for writing
                 self.destination = open(self.destination_path, 'w')
+                self.sha256 = hashlib.sha256()
                 # store some headers with the file for use if we need to resume
                 # the download and for future checking if the file on the server
                 # has changed
@@ -674,7 +683,9 @@ class Gurl(NSObject):
     def handleReceivedData_(self, data):
         '''Handle received data'''
         if self.destination:
-            self.destination.write(str(data))
+            data = str(data)
+            self.destination.write(data)
+            self.sha256.update(data)
         else:
             self.log(str(data).decode('UTF-8'))
         self.bytesReceived += len(data)
@@ -0,0 +1,515 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+httptransport.py
+
+An HTTP(S) downloader built on httplib, for use by fetch.get_url() in place
+of Gurl when the HTTPTransport preference is set to 'python'.
+
+HTTPTransfer takes the same options and has the same interface as Gurl, and
+stores the same download data with the files it downloads, so either can
+resume or revalidate a download made by the other. Connections are kept
+alive and reused for later requests to the same server.
+
+This module must not depend on PyObjC.
+"""
+
+import base64
+import errno
+import hashlib
+import httplib
+import os
+import plistlib
+import socket
+import ssl
+import threading
+import urlparse
+import xattr
+
+from xml.parsers.expat import ExpatError
+
+from .munkihash import update_hash
+
+# Disable PyLint complaining about 'invalid' camelCase names; we match Gurl
+# pylint: disable=C0103
+
+# give up after this many redirects
+MAX_REDIRECTS = 10
+# size of the chunks we read and write
+CHUNK_SIZE = 256 * 1024
+
+# error codes, from NSURLError.h, so errors look like those Gurl reports
+NSURLErrorUnknown = -1
+NSURLErrorCancelled = -999
+NSURLErrorBadURL = -1000
+NSURLErrorTimedOut = -1001
+NSURLErrorCannotConnectToHost = -1004
+NSURLErrorNetworkConnectionLost = -1005
+NSURLErrorHTTPTooManyRedirects = -1007
+NSURLErrorCannotWriteToFile = -3003
+NSURLErrorSecureConnectionFailed = -1200
+
+
+class TransferError(Exception):
+    '''Error recorded when a transfer fails. Has the same code() and
+    localizedDescription() methods as the NSError that Gurl records.'''
+
+    def code(self):
+        '''Returns the error code'''
+        return self.args[0]
+
+    def localizedDescription(self):
+        '''Returns a description of the error'''
+        return self.args[1]
+
+
+class ConnectionPool(object):
+    '''Keeps idle HTTP(S) connections so later requests to the same server
+    can reuse them. Safe to use from multiple threads.'''
+
+    def __init__(self, max_idle_per_server=4):
+        self.max_idle_per_server = max_idle_per_server
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns an idle connection for key, or None if there isn't one'''
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def put(self, key, connection):
+        '''Keeps connection for reuse by later requests for key'''
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_server:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        '''Closes all the idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+# connections shared by all transfers
+POOL = ConnectionPool()
+
+
+class HTTPTransfer(object):
+    '''Gets content from a URL using httplib. A drop-in replacement for Gurl:
+    create one with the options dict get_url() builds, start() it, then poll
+    isDone() until the transfer is finished. The transfer itself runs on a
+    background thread.
+
+    Besides Gurl's options, it understands:
+        'ca_certificate': path of a CA certificate file to trust
+        'ca_path': path of a directory of CA certificates to trust
+        'client_certificate': path of a client certificate to present
+        'client_key': path of the key for client_certificate
+    Servers are otherwise verified against the default CA certificates.
+    System proxy settings are not used.'''
+
+    GURL_XATTR = 'com.googlecode.munki.downloadData'
+
+    def __init__(self, options):
+        self.follow_redirects = options.get('follow_redirects', False)
+        self.destination_path = options.get('file')
+        self.can_resume = options.get('can_resume', False)
+        self.url = options.get('url')
+        self.additional_headers = options.get('additional_headers') or {}
+        self.username = options.get('username')
+        self.password = options.get('password')
+        self.download_only_if_changed = options.get(
+            'download_only_if_changed', False)
+        self.cache_data = options.get('cache_data')
+        self.connection_timeout = options.get('connection_timeout', 60)
+        self.ca_certificate = options.get('ca_certificate')
+        self.ca_path = options.get('ca_path')
+        self.client_certificate = options.get('client_certificate')
+        self.client_key = options.get('client_key')
+        self.pool = options.get('connection_pool', POOL)
+
+        self.log = options.get('logging_function') or (lambda message: None)
+
+        self.resume = False
+        self.response = None
+        # sha256 of the file as it's written, so it needn't be read again
+        self.sha256 = None
+        self.headers = {}
+        self.status = None
+        self.error = None
+        self.SSLerror = None
+        self.done = False
+        self.redirection = []
+        self.bytesReceived = 0
+        self.expectedLength = -1
+        self.percentComplete = 0
+        self.connection = None
+        self._cancelled = False
+        self._thread = None
+
+    def start(self):
+        '''Start the transfer'''
+        if not self.destination_path:
+            self.log('No output file specified.')
+            self.done = True
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        '''Cancel the transfer'''
+        self._cancelled = True
+        connection = self.connection
+        if connection:
+            connection.close()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(self.connection_timeout)
+        self.done = True
+
+    def isDone(self):
+        '''Check if the transfer is complete, waiting a little for it if it
+        isn't'''
+        if self._thread and not self.done:
+            self._thread.join(.1)
+        return self.done
+
+    def getStoredHeaders(self):
+        '''Returns any stored headers for self.destination_path'''
+        try:
+            stored_plist_str = xattr.getxattr(
+                self.destination_path, self.GURL_XATTR)
+        except (KeyError, IOError):
+            return {}
+        try:
+            return plistlib.readPlistFromString(stored_plist_str)
+        except (ExpatError, ValueError, AttributeError):
+            return {}
+
+    def storeHeaders_(self, headers):
+        '''Store dictionary data as an xattr for self.destination_path'''
+        try:
+            string = plistlib.writePlistToString(headers)
+        except (TypeError, ValueError):
+            string = ''
+        try:
+            xattr.setxattr(self.destination_path, self.GURL_XATTR, string)
+        except IOError, err:
+            self.log('Could not store metadata to %s: %s'
+                     % (self.destination_path, err))
+
+    def removeExpectedSizeFromStoredHeaders(self):
+        '''If a successful transfer, clear the expected size so we
+        don\'t attempt to resume the download next time'''
+        if str(self.status).startswith('2'):
+            # remove the expected-size from the stored headers
+            headers = self.getStoredHeaders()
+            if 'expected-length' in headers:
+                del headers['expected-length']
+                self.storeHeaders_(headers)
+
+    def _run(self):
+        '''Does the transfer; runs on our background thread'''
+        try:
+            self._transfer()
+        except TransferError, err:
+            self.error = err
+        except ssl.SSLError, err:
+            self.SSLerror = (err.errno, str(err))
+            self.error = TransferError(
+                NSURLErrorSecureConnectionFailed,
+                u'An SSL error has occurred and a secure connection to the '
+                u'server cannot be made.')
+        except socket.timeout:
+            self.error = TransferError(
+                NSURLErrorTimedOut, u'The request timed out.')
+        except (socket.error, httplib.HTTPException), err:
+            if self._cancelled:
+                self.error = TransferError(NSURLErrorCancelled, u'cancelled')
+            elif getattr(err, 'errno', None) == errno.ECONNREFUSED:
+                self.error = TransferError(
+                    NSURLErrorCannotConnectToHost,
+                    u'Could not connect to the server.')
+            else:
+                self.error = TransferError(
+                    NSURLErrorNetworkConnectionLost,
+                    u'The network connection was lost. (%s)' % err)
+        except (IOError, OSError), err:
+            self.error = TransferError(NSURLErrorCannotWriteToFile, str(err))
+        except Exception, err:
+            self.error = TransferError(NSURLErrorUnknown, str(err))
+        finally:
+            self.done = True
+
+    def _request_headers(self):
+        '''Returns the headers for our request, setting self.resume if we
+        are going to try to resume a partial download'''
+        headers = dict(self.additional_headers)
+        self.resume = False
+        # does the file already exist? See if we can resume a partial download
+        if os.path.isfile(self.destination_path):
+            stored_data = self.getStoredHeaders()
+            if (self.can_resume and 'expected-length' in stored_data and
+                    ('last-modified' in stored_data or 'etag' in stored_data)):
+                # we have a partial file and we're allowed to resume
+                self.resume = True
+                local_filesize = os.path.getsize(self.destination_path)
+                headers['Range'] = 'bytes=%s-' % local_filesize
+        if self.download_only_if_changed and not self.resume:
+            stored_data = self.cache_data or self.getStoredHeaders()
+            if 'last-modified' in stored_data:
+                headers['If-Modified-Since'] = stored_data['last-modified']
+            if 'etag' in stored_data:
+                headers['If-None-Match'] = stored_data['etag']
+        return headers
+
+    def _connection_key(self, url_parts):
+        '''Returns the key for pooling connections for url_parts'''
+        return (url_parts.scheme, url_parts.hostname, url_parts.port,
+                self.ca_certificate, self.ca_path,
+                self.client_certificate, self.client_key)
+
+    def _new_connection(self, url_parts):
+        '''Returns a new connection to the server in url_parts'''
+        if url_parts.scheme == 'https':
+            context = ssl.create_default_context(
+                cafile=self.ca_certificate, capath=self.ca_path)
+            if self.client_certificate:
+                context.load_cert_chain(
+                    self.client_certificate, self.client_key)
+            return httplib.HTTPSConnection(
+                url_parts.hostname, url_parts.port,
+                timeout=self.connection_timeout, context=context)
+        return httplib.HTTPConnection(
+            url_parts.hostname, url_parts.port,
+            timeout=self.connection_timeout)
+
+    def _send(self, url, headers):
+        '''Sends a GET request for url, reusing a pooled connection if there
+        is one. Returns the connection and its pool key; the response is
+        self.response.'''
+        url_parts = urlparse.urlsplit(url)
+        if url_parts.scheme not in ['http', 'https'] or not url_parts.hostname:
+            raise TransferError(NSURLErrorBadURL, u'unsupported URL')
+        path = url_parts.path or '/'
+        if url_parts.query:
+            path += '?' + url_parts.query
+        key = self._connection_key(url_parts)
+        while True:
+            connection = self.pool.get(key)
+            reused = connection is not None
+            if not reused:
+                connection = self._new_connection(url_parts)
+            self.connection = connection
+            try:
+                connection.request('GET', path, headers=headers)
+                self.response = connection.getresponse()
+                return connection, key
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if not reused or self._cancelled:
+                    raise
+                # the server closed the idle connection; try another one
+
+    def _finish(self, connection, key):
+        '''Reads and discards anything left of the current response, then
+        returns the connection to the pool if it can be reused'''
+        response = self.response
+        while response.read(CHUNK_SIZE):
+            pass
+        if response.will_close or self._cancelled:
+            connection.close()
+        else:
+            self.pool.put(key, connection)
+        self.connection = None
+
+    def _transfer(self):
+        '''Requests self.url, following redirects as allowed, and saves the
+        content to self.destination_path'''
+        url = self.url
+        headers = self._request_headers()
+        # once redirected to another server, we stop sending it our
+        # credentials and custom headers
+        other_server = False
+        tried_credentials = False
+        redirects = 0
+        while True:
+            connection, key = self._send(url, headers)
+            status = self.response.status
+            if status in (301, 302, 303, 307, 308):
+                location = self.response.getheader('location')
+                if location:
+                    new_url = urlparse.urljoin(url, location)
+                    self.redirection.append(
+                        [new_url, dict(self.response.getheaders())])
+                    if self._redirect_allowed(new_url):
+                        redirects += 1
+                        if redirects > MAX_REDIRECTS:
+                            self._finish(connection, key)
+                            raise TransferError(
+                                NSURLErrorHTTPTooManyRedirects,
+                                u'too many HTTP redirects')
+                        self._finish(connection, key)
+                        url = new_url
+                        if (not other_server and
+                                urlparse.urlsplit(url).netloc !=
+                                urlparse.urlsplit(self.url).netloc):
+                            self.log('Not sending credentials or custom '
+                                     'headers to %s' % url)
+                            other_server = True
+                            headers = self._without_credentials(headers)
+                        continue
+            elif (status == 401 and self.username and self.password and
+                  not tried_credentials and not other_server):
+                self.log('Authentication challenge for %s' % url)
+                tried_credentials = True
+                headers['Authorization'] = 'Basic ' + base64.b64encode(
+                    '%s:%s' % (self.username, self.password))
+                self._finish(connection, key)
+                continue
+            if (status == 206 and self.resume and
+                    not self._can_resume_with_response()):
+                self._finish(connection, key)
+                # file on server is different than the one
+                # we have a partial for
+                self.log('Can\'t resume download; file on server has changed.')
+                self.log('Removing %s' % self.destination_path)
+                os.unlink(self.destination_path)
+                self.log('Restarting download of %s' % self.destination_path)
+                headers = self._request_headers()
+                if other_server:
+                    headers = self._without_credentials(headers)
+                continue
+            self._save_response()
+            self._finish(connection, key)
+            return
+
+    def _without_credentials(self, headers):
+        '''Returns a copy of headers without the Authorization header or any
+        of our additional headers other than User-Agent'''
+        removed = set(key.lower() for key in self.additional_headers)
+        removed.discard('user-agent')
+        removed.add('authorization')
+        return dict((key, value) for key, value in headers.items()
+                    if key.lower() not in removed)
+
+    def _redirect_allowed(self, new_url):
+        '''Returns True if we may follow a redirect to new_url'''
+        # This code was largely based on the work of Andreas Fuchs
+        # (https://github.com/munki/munki/pull/465)
+        if self.follow_redirects is True or self.follow_redirects == 'all':
+            self.log('Allowing redirect to: %s' % new_url)
+            return True
+        if (self.follow_redirects == 'https' and
+                urlparse.urlsplit(new_url).scheme == 'https'):
+            self.log('Allowing redirect to: %s' % new_url)
+            return True
+        self.log('Denying redirect to: %s' % new_url)
+        return False
+
+    def _download_data(self):
+        '''Returns the download data to store with the file for the current
+        response'''
+        download_data = {}
+        last_modified = self.response.getheader('last-modified')
+        if last_modified:
+            download_data['last-modified'] = last_modified
+        etag = self.response.getheader('etag')
+        if etag:
+            download_data['etag'] = etag
+        download_data['expected-length'] = self.expectedLength
+        return download_data
+
+    def _can_resume_with_response(self):
+        '''Returns True if the current 206 response is for the same file we
+        have a partial download of'''
+        stored_data = self.getStoredHeaders()
+        download_data = self._download_data()
+        return (self.resume and stored_data and
+                stored_data.get('etag') == download_data.get('etag') and
+                stored_data.get('last-modified') ==
+                download_data.get('last-modified'))
+
+    def _save_response(self):
+        '''Records the current response and, if it was successful, writes
+        its content to self.destination_path'''
+        response = self.response
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self.bytesReceived = 0
+        self.percentComplete = -1
+        try:
+            self.expectedLength = int(response.getheader('content-length'))
+        except (TypeError, ValueError):
+            self.expectedLength = -1
+        if not str(self.status).startswith('2'):
+            return
+
+        if self.status == 206 and self.resume:
+            # try to resume
+            self.log('Resuming download for %s' % self.destination_path)
+            # add existing file size to bytesReceived so far
+            local_filesize = os.path.getsize(self.destination_path)
+            self.bytesReceived = local_filesize
+            if self.expectedLength != -1:
+                self.expectedLength += local_filesize
+            # open file for append
+            destination = open(self.destination_path, 'ab')
+            # the hash has to cover what we already have
+            self.sha256 = hashlib.sha256()
+            update_hash(self.sha256, self.destination_path)
+        else:
+            # not resuming, just open the file for writing
+            destination = open(self.destination_path, 'wb')
+            self.sha256 = hashlib.sha256()
+            # store some headers with the file for use if we need to resume
+            # the download and for future checking if the file on the server
+            # has changed
+            self.storeHeaders_(self._download_data())
+        try:
+            while not self._cancelled:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                destination.write(data)
+                self.sha256.update(data)
+                self.bytesReceived += len(data)
+                if self.expectedLength > 0:
+                    self.percentComplete = int(
+                        float(self.bytesReceived) /
+                        float(self.expectedLength) * 100)
+        finally:
+            destination.close()
+        if self._cancelled:
+            raise TransferError(NSURLErrorCancelled, u'cancelled')
+        if (self.expectedLength != -1 and
+                self.bytesReceived < self.expectedLength):
+            raise TransferError(
+                NSURLErrorNetworkConnectionLost,
+                u'The network connection was lost.')
+        self.removeExpectedSizeFromStoredHeaders()
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
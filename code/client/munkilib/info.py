@@ -802,14 +802,71 @@ def predicate_info_object():
     return info_object
 
 
+def _fingerprint(value):
+    '''Returns a hashable stand-in for value, which may contain dicts and
+    lists'''
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (key, _fingerprint(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(item) for item in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+@utils.Memoize
+def _compiled_predicate(predicate_string):
+    '''Returns the NSPredicate for predicate_string, parsing each distinct
+    predicate only once'''
+    return NSPredicate.predicateWithFormat_(predicate_string)
+
+
+# predicate results for the current run, keyed by
+# (predicate string, StartTime, additional_info fingerprint)
+_PREDICATE_RESULTS = {}
+# the run (StartTime) that predicate_info_object() was made for
+_PREDICATE_INFO = {'start_time': None}
+
+
+def _cached_predicate_info_object():
+    '''Returns predicate_info_object(), which is memoized. When a new run
+    starts, it and our cached results are cleared so the info object is
+    rebuilt with the new run's start time.'''
+    start_time = reports.report.get('StartTime')
+    if start_time != _PREDICATE_INFO['start_time']:
+        predicate_info_object.clear()
+        _PREDICATE_RESULTS.clear()
+        _PREDICATE_INFO['start_time'] = start_time
+    return predicate_info_object()
+
+
 def predicate_evaluates_as_true(predicate_string, additional_info=None):
-    '''Evaluates predicate against our info object'''
+    '''Evaluates predicate against our info object. Each distinct
+    predicate is evaluated once per run for the same additional_info.'''
+    base_info = _cached_predicate_info_object()
+    if not isinstance(additional_info, dict):
+        additional_info = None
+    cache_key = (predicate_string,
+                 _PREDICATE_INFO['start_time'],
+                 _fingerprint(additional_info))
+    if _PREDICATE_INFO['start_time'] is not None:
+        try:
+            result = _PREDICATE_RESULTS[cache_key]
+            display.display_debug2(
+                'Predicate %s is %s (cached)', predicate_string, result)
+            return result
+        except (KeyError, TypeError):
+            pass
+
     display.display_debug1('Evaluating predicate: %s', predicate_string)
-    info_object = predicate_info_object()
-    if isinstance(additional_info, dict):
+    info_object = dict(base_info)
+    if additional_info:
         info_object.update(additional_info)
     try:
-        predicate = NSPredicate.predicateWithFormat_(predicate_string)
+        predicate = _compiled_predicate(predicate_string)
     except BaseException, err:
         display.display_warning('%s', err)
         # can't parse predicate, so return False
@@ -817,6 +874,11 @@ def predicate_evaluates_as_true(predicate_string, additional_info=None):
 
     result = predicate.evaluateWithObject_(info_object)
     display.display_debug1('Predicate %s is %s', predicate_string, result)
+    if _PREDICATE_INFO['start_time'] is not None:
+        try:
+            _PREDICATE_RESULTS[cache_key] = result
+        except TypeError:
+            pass
     return result
 
 
@@ -55,15 +55,26 @@ from .. import FoundationPlist
 #                          uid INTEGER,
 #                          gid INTEGER,
 #                          perms INTEGER )
+# plus indexes on pkgs_paths(pkg_key), pkgs_paths(path_key), pkgs(pkgid)
+# and pkgs(pkgname), and a table of where each package was imported from,
+# so the database can be brought up to date incrementally:
+#
+# CREATE TABLE pkg_sources (pkg_key INTEGER NOT NULL,
+#                           source VARCHAR NOT NULL UNIQUE,
+#                           mtime REAL NOT NULL )
+#
+# PRAGMA user_version is PKGDB_VERSION once the database is complete.
 #################################################################
 
+PKGDB_VERSION = 2
+
 
 def should_rebuild_db(pkgdbpath):
     """
-    Checks to see if our internal package DB should be rebuilt.
+    Checks to see if our internal package DB should be brought up to date.
     If anything in /Library/Receipts, /Library/Receipts/boms, or
     /Library/Receipts/db/a.receiptdb has a newer modtime than our
-    database, we should rebuild.
+    database, we should update it.
     """
     def items_newer_than_pkgdb(directory, file_extensions):
         '''Return true if the directory or files inside the directory
@@ -126,6 +137,70 @@ def create_tables(curs):
                           uid INTEGER,
                           gid INTEGER,
                           perms INTEGER )''')
+    curs.execute('''CREATE TABLE pkg_sources
+                         (pkg_key INTEGER NOT NULL,
+                          source VARCHAR NOT NULL UNIQUE,
+                          mtime REAL NOT NULL )''')
+
+
+def create_indexes(curs):
+    """
+    Creates the indexes for our internal package database. Creating them
+    after the tables have been filled is faster than maintaining them while
+    importing.
+    """
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_pkg_key
+                    ON pkgs_paths (pkg_key)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_path_key
+                    ON pkgs_paths (path_key)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_pkgid
+                    ON pkgs (pkgid)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_pkgname
+                    ON pkgs (pkgname)''')
+
+
+def tune_for_bulk_load(curs):
+    """
+    Sets PRAGMAs that speed up importing lots of packages. The database is
+    deleted and rebuilt if anything goes wrong, so we don't need the
+    journal to survive a crash.
+    """
+    curs.execute('PRAGMA synchronous = OFF')
+    curs.execute('PRAGMA journal_mode = MEMORY')
+    curs.execute('PRAGMA temp_store = MEMORY')
+    # in KB when negative
+    curs.execute('PRAGMA cache_size = -65536')
+
+
+class PathKeys(object):
+    """
+    In-memory map of the paths table, so importing a package doesn't need a
+    SELECT for every path. New paths are given keys right away and written
+    to the paths table by flush().
+    """
+    def __init__(self, curs):
+        self.keys = dict(curs.execute('SELECT path, path_key FROM paths'))
+        self.next_key = max(self.keys.values() or [0]) + 1
+        self.pending = []
+
+    def key_for(self, path):
+        '''Returns the path_key for path, assigning one if it's new'''
+        if isinstance(path, unicode):
+            # the database returns paths as UTF-8 strs
+            path = path.encode('UTF-8')
+        try:
+            return self.keys[path]
+        except KeyError:
+            pathkey = self.keys[path] = self.next_key
+            self.next_key += 1
+            self.pending.append((pathkey, path))
+            return pathkey
+
+    def flush(self, curs):
+        '''Inserts the new paths into the paths table'''
+        curs.executemany(
+            'INSERT INTO paths (path_key, path) values (?, ?)', self.pending)
+        self.pending = []
 
 
 def find_bundle_receipt(pkgid):
@@ -148,9 +223,10 @@ def find_bundle_receipt(pkgid):
     return ''
 
 
-def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
-    '''Parses line from lsbom or pkgutil --files and inserts the paths into
-    our pkgdb'''
+def parse_bom_line(bom_line, ppath):
+    '''Parses line from lsbom or pkgutil --files. Returns a tuple of
+    (path, uid, gid, perms), where path is where the item is installed, or
+    None if the line isn't for an installed item.'''
     try:
         item = bom_line.rstrip("\n").split("\t")
         path = item[0]
@@ -164,40 +240,50 @@ def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
         uid = "0"
         gid = "0"
 
-    try:
-        if path != ".":
-            # special case for MS Office 2008 installers
-            if ppath == "tmp/com.microsoft.updater/office_location":
-                ppath = "Applications"
-
-            # prepend the ppath so the paths match the actual install locations
-            path = path.lstrip("./")
-            if ppath:
-                path = ppath + "/" + path
-
-            values_t = (path, )
-            row = curs.execute(
-                'SELECT path_key from paths where path = ?',
-                values_t).fetchone()
-            if not row:
-                curs.execute(
-                    'INSERT INTO paths (path) values (?)', values_t)
-                pathkey = curs.lastrowid
-            else:
-                pathkey = row[0]
+    if path == "." or not path:
+        return None
+
+    # special case for MS Office 2008 installers
+    if ppath == "tmp/com.microsoft.updater/office_location":
+        ppath = "Applications"
+
+    # prepend the ppath so the paths match the actual install locations
+    path = path.lstrip("./")
+    if ppath:
+        path = ppath + "/" + path
+    return (path, uid, gid, perms)
 
-            values_t = (pkgkey, pathkey, uid, gid, perms)
-            curs.execute(
-                'INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, '
-                'perms) values (?, ?, ?, ?, ?)', values_t)
-    except sqlite3.DatabaseError:
-        pass
 
+def insert_bom_into_pkgdb(cmd, pkgkey, ppath, curs, pathkeys):
+    '''Runs cmd (lsbom or pkgutil --files) and inserts the paths it lists
+    into our pkgdb for the package with pkgkey, in one transaction'''
+    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    rows = []
+    for line in iter(proc.stdout.readline, ''):
+        values = parse_bom_line(line.decode('UTF-8'), ppath)
+        if values:
+            path, uid, gid, perms = values
+            rows.append((pkgkey, pathkeys.key_for(path), uid, gid, perms))
+    proc.wait()
 
-def import_package(packagepath, curs):
+    try:
+        pathkeys.flush(curs)
+        curs.executemany(
+            'INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, '
+            'perms) values (?, ?, ?, ?, ?)', rows)
+    except sqlite3.DatabaseError, err:
+        display.display_debug1(
+            'Error recording paths for %s: %s', ' '.join(cmd), err)
+    curs.connection.commit()
+
+
+def import_package(packagepath, curs, pathkeys):
     """
     Imports package data from the receipt at packagepath into
-    our internal package database.
+    our internal package database. Returns the new pkg_key, or None if
+    the receipt was skipped.
     """
 
     bompath = os.path.join(packagepath, 'Contents/Archive.bom')
@@ -248,22 +334,17 @@ def import_package(packagepath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    proc = subprocess.Popen(
-        ['/usr/bin/lsbom', bompath], shell=False, bufsize=-1,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
+    insert_bom_into_pkgdb(
+        ['/usr/bin/lsbom', bompath], pkgkey, ppath, curs, pathkeys)
+    return pkgkey
 
 
-def import_bom(bompath, curs):
+def import_bom(bompath, curs, pathkeys):
     """
     Imports package data into our internal package database
     using a combination of the bom file and data in Apple's
     package database into our internal package database.
+    Returns the new pkg_key.
     """
     # If we completely trusted the accuracy of Apple's database, we wouldn't
     # need the bom files, but in my environment at least, the bom files are
@@ -301,20 +382,15 @@ def import_bom(bompath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/bin/lsbom", bompath]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    insert_bom_into_pkgdb(
+        ["/usr/bin/lsbom", bompath], pkgkey, ppath, curs, pathkeys)
+    return pkgkey
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
 
-def import_from_pkgutil(pkgname, curs):
+def import_from_pkgutil(pkgname, curs, pathkeys):
     """
     Imports package data from pkgutil into our internal package database.
+    Returns the new pkg_key.
     """
 
     timestamp = 0
@@ -356,21 +432,91 @@ def import_from_pkgutil(pkgname, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/sbin/pkgutil", "--files", pkgid]
+    insert_bom_into_pkgdb(
+        ["/usr/sbin/pkgutil", "--files", pkgid], pkgkey, ppath, curs, pathkeys)
+    return pkgkey
+
+
+def get_package_sources():
+    """
+    Returns a list of (source, mtime, import_function, argument) tuples for
+    the receipts, BOMs and packages in Apple's package database that are
+    on this machine, in the order they should be imported. source
+    identifies the package in the pkg_sources table; a different mtime
+    means it needs to be imported again.
+    """
+    def mtime_of(path):
+        '''Returns the modtime of path, or 0 if it doesn't exist'''
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return 0
+
+    sources = []
+    receiptsdir = '/Library/Receipts'
+    if os.path.exists(receiptsdir):
+        for item in osutils.listdir(receiptsdir):
+            if item.endswith('.pkg'):
+                receiptpath = os.path.join(receiptsdir, item)
+                sources.append(('receipt:' + receiptpath,
+                                mtime_of(receiptpath),
+                                import_package, receiptpath))
+
+    bomsdir = '/Library/Receipts/boms'
+    if os.path.exists(bomsdir):
+        for item in osutils.listdir(bomsdir):
+            if item.endswith('.bom'):
+                bompath = os.path.join(bomsdir, item)
+                sources.append(('bom:' + bompath, mtime_of(bompath),
+                                import_bom, bompath))
+
+    cmd = ['/usr/sbin/pkgutil', '--pkgs']
     proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
                             stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (output, dummy_err) = proc.communicate()
+    apple_receipts = '/private/var/db/receipts'
+    for pkg in output.splitlines():
+        if not pkg:
+            continue
+        # pkgutil's receipt for pkg changes when it's reinstalled
+        mtime = max(
+            mtime_of(os.path.join(apple_receipts, pkg + '.plist')),
+            mtime_of(os.path.join(apple_receipts, pkg + '.bom')))
+        sources.append(('pkgutil:' + pkg, mtime, import_from_pkgutil, pkg))
+    return sources
+
+
+def remove_packages_from_pkgdb(pkgkeys, curs):
+    """
+    Removes the packages with pkgkeys, and the paths only they used, from
+    our internal package database.
+    """
+    for pkgkey in pkgkeys:
+        pkgkey_t = (pkgkey, )
+        curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
+        curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+    curs.execute(
+        '''DELETE FROM paths where path_key not in
+           (select distinct path_key from pkgs_paths)''')
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
+
+def pkgdb_version(curs):
+    """
+    Returns the PRAGMA user_version of our internal package database
+    """
+    try:
+        return curs.execute('PRAGMA user_version').fetchone()[0]
+    except sqlite3.DatabaseError:
+        return 0
 
 
 def init_database(forcerebuild=False):
     """
-    Builds or rebuilds our internal package database.
+    Builds our internal package database, or brings it up to date: packages
+    that are new or have changed since they were imported are imported, and
+    packages that are gone are dropped.
     """
     def abort_init_database():
         '''What to do if user requests we stop'''
@@ -380,13 +526,22 @@ def init_database(forcerebuild=False):
         os.remove(PACKAGEDB)
         return False
 
-    if not should_rebuild_db(PACKAGEDB) and not forcerebuild:
-        return True
+    rebuild = forcerebuild or not os.path.exists(PACKAGEDB)
+    if not rebuild:
+        conn = sqlite3.connect(PACKAGEDB)
+        curs = conn.cursor()
+        # databases that are incomplete, or were built by older versions,
+        # have to be rebuilt
+        rebuild = pkgdb_version(curs) != PKGDB_VERSION
+        curs.close()
+        conn.close()
+        if not rebuild and not should_rebuild_db(PACKAGEDB):
+            return True
 
     display.display_status_minor(
         'Gathering information on installed packages')
 
-    if os.path.exists(PACKAGEDB):
+    if rebuild and os.path.exists(PACKAGEDB):
         try:
             os.remove(PACKAGEDB)
         except (OSError, IOError):
@@ -394,76 +549,74 @@ def init_database(forcerebuild=False):
                 "Could not remove out-of-date receipt database.")
             return False
 
-    receiptsdir = '/Library/Receipts'
-    receiptlist = []
-    if os.path.exists(receiptsdir):
-        receiptlist = [item for item in osutils.listdir(receiptsdir)
-                       if item.endswith('.pkg')]
-
-    bomsdir = '/Library/Receipts/boms'
-    bomslist = []
-    if os.path.exists(bomsdir):
-        bomslist = [item for item in osutils.listdir(bomsdir)
-                    if item.endswith('.bom')]
-
-    pkglist = []
-    cmd = ['/usr/sbin/pkgutil', '--pkgs']
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    while True:
-        line = proc.stdout.readline()
-        if not line and (proc.poll() != None):
-            break
-
-        pkglist.append(line.rstrip('\n'))
+    sources = get_package_sources()
 
-    pkgcount = len(receiptlist) + len(bomslist) + len(pkglist)
     conn = sqlite3.connect(PACKAGEDB)
     conn.text_factory = str
     curs = conn.cursor()
-    create_tables(curs)
+    tune_for_bulk_load(curs)
+    # mark the database incomplete until we're done
+    curs.execute('PRAGMA user_version = 0')
+    if rebuild:
+        create_tables(curs)
+        to_import = sources
+    else:
+        current = dict((source, mtime)
+                       for source, mtime, dummy, dummy in sources)
+        stale_sources = []
+        stale_pkgkeys = []
+        imported = set()
+        for source, pkgkey, mtime in curs.execute(
+                'SELECT source, pkg_key, mtime FROM pkg_sources').fetchall():
+            if current.get(source) == mtime:
+                imported.add(source)
+            else:
+                # gone, or changed since it was imported
+                stale_sources.append((source, ))
+                stale_pkgkeys.append(pkgkey)
+        if stale_sources:
+            display.display_detail(
+                "Removing %s changed or removed packages from internal "
+                "package database...", len(stale_sources))
+            remove_packages_from_pkgdb(stale_pkgkeys, curs)
+            curs.executemany(
+                'DELETE FROM pkg_sources where source = ?', stale_sources)
+        to_import = [item for item in sources if item[0] not in imported]
+    conn.commit()
+    pathkeys = PathKeys(curs)
 
+    pkgcount = len(to_import)
     currentpkgindex = 0
     display.display_percent_done(0, pkgcount)
 
-    for item in receiptlist:
+    for source, mtime, import_function, argument in to_import:
         if processes.stop_requested():
             return abort_init_database()
 
-        receiptpath = os.path.join(receiptsdir, item)
-        display.display_detail("Importing %s...", receiptpath)
-        import_package(receiptpath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
-
-    for item in bomslist:
-        if processes.stop_requested():
-            return abort_init_database()
-
-        bompath = os.path.join(bomsdir, item)
-        display.display_detail("Importing %s...", bompath)
-        import_bom(bompath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
-
-    for pkg in pkglist:
-        if processes.stop_requested():
-            return abort_init_database()
-
-        display.display_detail("Importing %s...", pkg)
-        import_from_pkgutil(pkg, curs)
+        display.display_detail("Importing %s...", argument)
+        # skipped receipts are recorded too, so they aren't tried again
+        # until they change
+        pkgkey = import_function(argument, curs, pathkeys) or 0
+        curs.execute(
+            'INSERT OR REPLACE INTO pkg_sources (pkg_key, source, mtime) '
+            'values (?, ?, ?)', (pkgkey, source, mtime))
+        conn.commit()
         currentpkgindex += 1
         display.display_percent_done(currentpkgindex, pkgcount)
 
     # in case we didn't quite get to 100% for some reason
     display.display_percent_done(pkgcount, pkgcount)
 
+    display.display_detail("Indexing package data...")
+    create_indexes(curs)
+
     # commit and close the db when we're done.
+    curs.execute('PRAGMA user_version = %d' % PKGDB_VERSION)
     conn.commit()
     curs.close()
     conn.close()
+    # the database is up to date, even if nothing changed it
+    os.utime(PACKAGEDB, None)
     return True
 
 
@@ -519,39 +672,22 @@ def getpathstoremove(pkgkeylist):
     conn = sqlite3.connect(PACKAGEDB)
     curs = conn.cursor()
 
-    # set up some subqueries:
-    # all the paths that are referred to by the selected packages:
-    if len(pkgkeys) > 1:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key in %s" % \
-           str(pkgkeys)
-    else:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key = %s" % \
-           str(pkgkeys[0])
-
-    # all the paths that are referred to by every package
-    # except the selected packages:
-    if len(pkgkeys) > 1:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key not in %s" % \
-         str(pkgkeys)
-    else:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key != %s" % \
-         str(pkgkeys[0])
-
-    # every path that is used by the selected packages and no other packages:
-    combined_query = \
-        "select path from paths where " + \
-        "(path_key in (%s) and path_key not in (%s))" % \
-                                (in_selected_packages, not_in_other_packages)
+    # every path that is used by the selected packages and no other
+    # packages. The indexes on pkgs_paths let this look at just the rows for
+    # the selected packages' paths, instead of every row in the table.
+    placeholders = ', '.join(['?'] * len(pkgkeys))
+    combined_query = (
+        'select path from paths where path_key in '
+        '(select path_key from pkgs_paths where pkg_key in (%s)) '
+        'and not exists '
+        '(select 1 from pkgs_paths where pkgs_paths.path_key = paths.path_key '
+        'and pkg_key not in (%s))' % (placeholders, placeholders))
 
     display.display_status_minor(
         'Determining which filesystem items to remove')
     munkistatus.percent(-1)
 
-    curs.execute(combined_query)
+    curs.execute(combined_query, pkgkeys + pkgkeys)
     results = curs.fetchall()
     curs.close()
     conn.close()
@@ -608,6 +744,8 @@ def remove_receipts(pkgkeylist, noupdateapplepkgdb):
             "Removing package data from internal database...")
         curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
         curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+        # if the receipt is left behind, import it again next time
+        curs.execute('DELETE FROM pkg_sources where pkg_key = ?', pkgkey_t)
 
         # then remove pkg info from Apple's database unless option is passed
         if not noupdateapplepkgdb and pkgid:
@@ -25,6 +25,27 @@ Munki's hash functions
 import hashlib
 import os
 
+def update_hash(hash_function, filename):
+    """
+    Feeds the content of the given file to hash_function. Used to pick up
+    hashing where a partial download left off before hashing the rest of the
+    download as it arrives.
+
+    Args:
+      hash_function: The hash function object to update, e.g. hashlib.md5().
+      filename: The file name to read.
+    """
+    fileref = open(filename, 'rb')
+    try:
+        while 1:
+            chunk = fileref.read(2**16)
+            if not chunk:
+                break
+            hash_function.update(chunk)
+    finally:
+        fileref.close()
+
+
 def gethash(filename, hash_function):
     """
     Calculates the hashvalue of the given file with the given hash_function.
@@ -40,13 +61,7 @@ def gethash(filename, hash_function):
     if not os.path.isfile(filename):
         return 'NOT A FILE'
 
-    fileref = open(filename, 'rb')
-    while 1:
-        chunk = fileref.read(2**16)
-        if not chunk:
-            break
-        hash_function.update(chunk)
-    fileref.close()
+    update_hash(hash_function, filename)
     return hash_function.hexdigest()
 
 
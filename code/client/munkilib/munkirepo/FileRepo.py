@@ -3,15 +3,31 @@
 
 import errno
 import getpass
+import hashlib
 import os
 import shutil
+import stat
 import subprocess
 import sys
 import urllib
 
 from urlparse import urlparse
 
-from munkilib.munkirepo import Repo, RepoError
+from munkilib.munkirepo import Repo, RepoError, get_item_or_error
+from munkilib.utils import concurrent_imap
+
+try:
+    # Python 3.5+, or the scandir backport if it's installed
+    try:
+        from os import scandir
+    except ImportError:
+        from scandir import scandir
+except ImportError:
+    scandir = None
+
+# how many files get_many, put_many and delete_many work on at once. Local
+# disks don't care much, but this hides a lot of latency on AFP/SMB/NFS shares
+CONCURRENT_FILE_OPERATIONS = 8
 
 
 # NetFS share mounting code borrowed and liberally adapted from Michael Lynn's
@@ -64,6 +80,73 @@ def unicodeize(path):
     return path
 
 
+def walk_with_stats(search_dir):
+    '''Generator that walks search_dir like os.walk(followlinks=True),
+    skipping files and directories whose names start with a period, and
+    yields a (relative_path, stat_result) tuple for each file. Each entry is
+    stat-ed once, and the result is used both to tell files from directories
+    and as the file metadata. stat_result is None if the entry could not be
+    stat-ed (a broken symlink, for example). Directories that can't be
+    listed are skipped.
+    Files are yielded in the same order os.walk would list them.'''
+    def listing(dirpath):
+        '''Returns a list of (name, stat_result) for dirpath'''
+        entries = []
+        if scandir:
+            for entry in scandir(dirpath):
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    entries.append((entry.name, entry.stat()))
+                except OSError:
+                    entries.append((entry.name, None))
+        else:
+            for name in os.listdir(dirpath):
+                if name.startswith('.'):
+                    continue
+                try:
+                    entries.append(
+                        (name, os.stat(os.path.join(dirpath, name))))
+                except OSError:
+                    entries.append((name, None))
+        return entries
+
+    pending = [u'']
+    while pending:
+        rel_dir = pending.pop(0)
+        subdirs = []
+        try:
+            entries = listing(os.path.join(search_dir, rel_dir))
+        except OSError:
+            # os.walk skips directories it can't list, so we do too
+            continue
+        for name, stat_result in entries:
+            rel_path = os.path.join(rel_dir, name)
+            if stat_result and stat.S_ISDIR(stat_result.st_mode):
+                subdirs.append(rel_path)
+            else:
+                yield rel_path, stat_result
+        # os.walk is depth-first, so the subdirectories are walked before
+        # anything else that's pending
+        pending[0:0] = subdirs
+
+
+def hash_file(filepath):
+    '''Returns the SHA-256 hex digest of the file at filepath, reading it in
+    chunks so large files don't need to fit in memory'''
+    digest = hashlib.sha256()
+    fileref = open(filepath, 'rb')
+    try:
+        while True:
+            chunk = fileref.read(2**20)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        fileref.close()
+    return digest.hexdigest()
+
+
 def mount_share(share_url):
     '''Mounts a share at /Volumes, returns the mount point or raises an error'''
     # Uses some constants defined in NetFS.h
@@ -222,6 +305,52 @@ class FileRepo(Repo):
         except (OSError, IOError), err:
             raise RepoError(err)
 
+    def itemlist_with_metadata(self, kind, include_hashes=False):
+        '''Returns a list of (identifier, metadata) tuples for each item of
+        kind, in the same order as itemlist(kind). metadata contains 'size',
+        'mtime' and 'etag' (derived from size and mtime) from a single stat of
+        each file; if include_hashes is True it also contains 'sha256', which
+        requires reading each file. Entries that can't be stat-ed or read
+        (broken symlinks, for example) have empty metadata.'''
+        kind = unicodeize(kind)
+        search_dir = os.path.join(self.root, kind)
+        metadata_list = []
+        try:
+            if not os.path.isdir(search_dir):
+                # os.walk (and therefore itemlist) returns nothing in this
+                # case
+                return metadata_list
+            for rel_path, stat_result in walk_with_stats(search_dir):
+                metadata = {}
+                if stat_result:
+                    metadata['size'] = stat_result.st_size
+                    metadata['mtime'] = stat_result.st_mtime
+                    # st_ino and st_ctime catch a rewrite that keeps the
+                    # size and lands within the mtime granularity
+                    metadata['etag'] = '%x-%r-%x-%r' % (
+                        stat_result.st_size, stat_result.st_mtime,
+                        stat_result.st_ino, stat_result.st_ctime)
+                metadata_list.append((rel_path, metadata))
+        except (OSError, IOError), err:
+            raise RepoError(err)
+
+        if include_hashes:
+            def add_hash(item):
+                '''Worker function'''
+                rel_path, metadata = item
+                if 'size' in metadata:
+                    try:
+                        metadata['sha256'] = hash_file(
+                            os.path.join(search_dir, rel_path))
+                    except (OSError, IOError):
+                        # leave it to the caller to deal with when it
+                        # tries to get() the item
+                        pass
+                return item
+            metadata_list = list(concurrent_imap(
+                add_hash, metadata_list, CONCURRENT_FILE_OPERATIONS))
+        return metadata_list
+
     def get(self, resource_identifier):
         '''Returns the content of item with given resource_identifier.
         For a file-backed repo, a resource_identifier of
@@ -301,3 +430,97 @@ class FileRepo(Repo):
             os.remove(repo_filepath)
         except (OSError, IOError), err:
             raise RepoError(err)
+
+    def get_many(self, resource_identifiers, concurrency=None):
+        '''Gets the content of several items, reading concurrency files at
+        once (CONCURRENT_FILE_OPERATIONS if concurrency is None). Yields a
+        (resource_identifier, content, error) tuple for each item, in the
+        order given. If an item could not be read, content is None and error
+        is a RepoError; otherwise error is None.'''
+        return concurrent_imap(
+            lambda identifier: get_item_or_error(self, identifier),
+            resource_identifiers,
+            concurrency or CONCURRENT_FILE_OPERATIONS)
+
+    def _make_dirs_for(self, resource_identifiers):
+        '''Creates the directories needed for resource_identifiers up front,
+        so worker threads don't race each other to do it'''
+        dir_paths = set(
+            os.path.dirname(os.path.join(self.root, unicodeize(identifier)))
+            for identifier in resource_identifiers)
+        for dir_path in sorted(dir_paths):
+            if not os.path.exists(dir_path):
+                try:
+                    os.makedirs(dir_path, 0755)
+                except (OSError, IOError):
+                    # the put will report the problem for each affected item
+                    pass
+
+    def put_many(self, content_by_identifier, concurrency=None):
+        '''Stores several items on the repo, writing several files at once
+        (see get_many). content_by_identifier is a dict mapping
+        resource_identifiers to content. Returns a dict mapping the
+        resource_identifiers of any items that could not be stored to the
+        RepoError encountered.'''
+        self._make_dirs_for(content_by_identifier)
+
+        def put_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.put(resource_identifier,
+                         content_by_identifier[resource_identifier])
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                put_one, sorted(content_by_identifier),
+                concurrency or CONCURRENT_FILE_OPERATIONS)
+            if err)
+
+    def put_many_from_local_files(self, path_by_identifier,
+                                  concurrency=None):
+        '''Copies several local files to the repo, several at once (see
+        get_many).
+        path_by_identifier is a dict mapping resource_identifiers to local
+        file paths. Returns a dict mapping the resource_identifiers of any
+        items that could not be stored to the RepoError encountered.'''
+        self._make_dirs_for(path_by_identifier)
+
+        def put_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.put_from_local_file(
+                    resource_identifier,
+                    path_by_identifier[resource_identifier])
+            except (OSError, IOError), err:
+                return resource_identifier, RepoError(err)
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                put_one, sorted(path_by_identifier),
+                concurrency or CONCURRENT_FILE_OPERATIONS)
+            if err)
+
+    def delete_many(self, resource_identifiers, concurrency=None):
+        '''Deletes several items from the repo, removing several files at
+        once (see get_many). Returns a dict mapping the resource_identifiers
+        of any items that could not be deleted to the RepoError
+        encountered.'''
+        def delete_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.delete(resource_identifier)
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                delete_one, resource_identifiers,
+                concurrency or CONCURRENT_FILE_OPERATIONS)
+            if err)
@@ -8,6 +8,7 @@ import subprocess
 import sys
 
 from FileRepo import FileRepo
+from munkilib.munkirepo import Repo
 
 # TODO: make this more easily customized
 GITCMD = '/usr/bin/git'
@@ -137,3 +138,16 @@ class GitFileRepo(FileRepo):
         super(GitFileRepo, self).delete(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
         MunkiGit(self).delete_file_at_path(repo_filepath)
+
+    # git can only do one thing at a time in a given repo (it holds a lock on
+    # the index while adding and committing), so changes are made one by one.
+    # get_many is inherited from FileRepo since reading doesn't touch git.
+
+    def put_many(self, content_by_identifier, concurrency=None):
+        return Repo.put_many(self, content_by_identifier)
+
+    def put_many_from_local_files(self, path_by_identifier, concurrency=None):
+        return Repo.put_many_from_local_files(self, path_by_identifier)
+
+    def delete_many(self, resource_identifiers, concurrency=None):
+        return Repo.delete_many(self, resource_identifiers)
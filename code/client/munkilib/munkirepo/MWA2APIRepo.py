@@ -3,20 +3,31 @@
 
 import base64
 import getpass
+import hashlib
 import os
 import plistlib
+import shutil
 import subprocess
 import tempfile
 import urllib2
 from xml.parsers.expat import ExpatError
 
 from munkilib.munkirepo import Repo, RepoError
+from munkilib.utils import concurrent_imap
 
 DEBUG = False
 
 # TODO: make this more easily configurable
 CURL_CMD = '/usr/bin/curl'
 
+# get_many fetches items in batches of GET_BATCH_SIZE with a single curl
+# process (and therefore a single connection) per batch, running up to
+# CONCURRENT_REQUESTS batches at once. put_many and delete_many run up to
+# CONCURRENT_REQUESTS individual requests at once, unless the caller asks for
+# a different concurrency.
+GET_BATCH_SIZE = 50
+CONCURRENT_REQUESTS = 4
+
 class CurlError(Exception):
     pass
 
@@ -111,6 +122,65 @@ class MWA2APIRepo(Repo):
                 raise CurlError((proc.returncode, err))
         return output
 
+    def _curl_get_batch(self, resource_identifiers, headers=None):
+        '''Uses a single curl process to GET several items over one
+        connection. Returns a list of (resource_identifier, content, error)
+        tuples in the order given.'''
+        tempdir = tempfile.mkdtemp()
+        try:
+            directivepath = os.path.join(tempdir, 'curl_directives')
+            fileobj = open(directivepath, 'w')
+            print >> fileobj, 'silent'         # no progress meter
+            print >> fileobj, 'show-error'     # print error msg to stderr
+            print >> fileobj, 'location'       # follow redirects
+            # we don't use 'fail' here; it would stop us from finding out
+            # which transfers failed. Instead have curl print the status code
+            # of each transfer.
+            print >> fileobj, 'write-out = "%{http_code}\\n"'
+            if headers:
+                for key in headers:
+                    print >> fileobj, 'header = "%s: %s"' % (key, headers[key])
+            print >> fileobj, 'header = "Authorization: %s"' % self.authtoken
+            for (index, resource_identifier) in enumerate(resource_identifiers):
+                url = os.path.join(
+                    self.baseurl,
+                    urllib2.quote(resource_identifier.encode('UTF-8')))
+                print >> fileobj, 'url = "%s"' % url
+                print >> fileobj, 'output = "%s"' % os.path.join(
+                    tempdir, str(index))
+            fileobj.close()
+
+            cmd = [CURL_CMD, '-q', '--config', directivepath]
+            proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, err = proc.communicate()
+            status_codes = output.splitlines()
+
+            results = []
+            for (index, resource_identifier) in enumerate(resource_identifiers):
+                try:
+                    status = status_codes[index].strip()
+                except IndexError:
+                    status = '000'
+                if not status.startswith('2'):
+                    results.append(
+                        (resource_identifier, None,
+                         RepoError(CurlError((proc.returncode, err, status)))))
+                    continue
+                try:
+                    fileref = open(os.path.join(tempdir, str(index)))
+                    content = fileref.read()
+                    fileref.close()
+                except (OSError, IOError):
+                    # curl doesn't create an output file for an empty body
+                    content = ''
+                results.append((resource_identifier, content, None))
+            return results
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
     def itemlist(self, kind):
         '''Returns a list of identifiers for each item of kind.
         Kind might be 'catalogs', 'manifests', 'pkgsinfo', 'pkgs', or 'icons'.
@@ -132,6 +202,37 @@ class MWA2APIRepo(Repo):
             # it's a list of filenames
             return plist
 
+    def itemlist_with_metadata(self, kind, include_hashes=False):
+        '''Returns a list of (identifier, metadata) tuples for each item of
+        kind, in the same order as itemlist(kind).
+        For manifests and pkgsinfo the API can return every item's content in
+        a single listing call, so metadata contains an 'etag' computed from
+        that content. Other kinds have no metadata unless include_hashes is
+        True, in which case every item is downloaded and hashed.'''
+        if include_hashes or kind not in ['manifests', 'pkgsinfo']:
+            return super(MWA2APIRepo, self).itemlist_with_metadata(
+                kind, include_hashes=include_hashes)
+        url = urllib2.quote(kind.encode('UTF-8'))
+        headers = {'Accept': 'application/xml'}
+        try:
+            data = self._curl(url, headers=headers)
+        except CurlError, err:
+            raise RepoError(err)
+        try:
+            plist = plistlib.readPlistFromString(data)
+        except ExpatError, err:
+            raise RepoError(err)
+        metadata_list = []
+        for item in plist:
+            filename = item.pop('filename')
+            # this is a hash of the item as the API serves it in listings,
+            # which isn't byte-for-byte what get() returns, so it is only
+            # useful as an etag
+            etag = hashlib.sha256(
+                plistlib.writePlistToString(item)).hexdigest()
+            metadata_list.append((filename, {'etag': etag}))
+        return metadata_list
+
     def get(self, resource_identifier):
         '''Returns the content of item with given resource_identifier.
         For a file-backed repo, a resource_identifier of
@@ -217,4 +318,101 @@ class MWA2APIRepo(Repo):
             self._curl(url, method='DELETE')
         except CurlError, err:
             raise RepoError(err)
-        
\ No newline at end of file
+        
+    def get_many(self, resource_identifiers, concurrency=None):
+        '''Gets the content of several items. Items are requested in batches,
+        each over a single connection, with several batches in flight at
+        once. Yields a (resource_identifier, content, error) tuple for each
+        item, in the order given. If an item could not be retrieved, content
+        is None and error is the RepoError; otherwise error is None.'''
+        def batches():
+            '''Splits resource_identifiers into batches that need the same
+            request headers, preserving order'''
+            batch = []
+            batch_wants_xml = None
+            for resource_identifier in resource_identifiers:
+                wants_xml = resource_identifier.startswith(
+                    ('catalogs/', 'manifests/', 'pkgsinfo/'))
+                if batch and (wants_xml != batch_wants_xml or
+                              len(batch) >= GET_BATCH_SIZE):
+                    yield batch_wants_xml, batch
+                    batch = []
+                batch.append(resource_identifier)
+                batch_wants_xml = wants_xml
+            if batch:
+                yield batch_wants_xml, batch
+
+        def get_batch(batch_info):
+            '''Worker function'''
+            wants_xml, batch = batch_info
+            if wants_xml:
+                headers = {'Accept': 'application/xml'}
+            else:
+                headers = {}
+            return self._curl_get_batch(batch, headers=headers)
+
+        for results in concurrent_imap(
+                get_batch, batches(), concurrency or CONCURRENT_REQUESTS):
+            for result in results:
+                yield result
+
+    def put_many(self, content_by_identifier, concurrency=None):
+        '''Stores several items on the repo, with several requests in flight
+        at once. content_by_identifier is a dict mapping resource_identifiers
+        to content. Returns a dict mapping the resource_identifiers of any
+        items that could not be stored to the RepoError encountered.'''
+        def put_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.put(resource_identifier,
+                         content_by_identifier[resource_identifier])
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                put_one, sorted(content_by_identifier),
+                concurrency or CONCURRENT_REQUESTS)
+            if err)
+
+    def put_many_from_local_files(self, path_by_identifier,
+                                  concurrency=None):
+        '''Uploads several local files to the repo, with several requests in
+        flight at once. path_by_identifier is a dict mapping
+        resource_identifiers to local file paths. Returns a dict mapping the
+        resource_identifiers of any items that could not be stored to the
+        RepoError encountered.'''
+        def put_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.put_from_local_file(
+                    resource_identifier,
+                    path_by_identifier[resource_identifier])
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                put_one, sorted(path_by_identifier),
+                concurrency or CONCURRENT_REQUESTS)
+            if err)
+
+    def delete_many(self, resource_identifiers, concurrency=None):
+        '''Deletes several items from the repo, with several requests in
+        flight at once. Returns a dict mapping the resource_identifiers of any
+        items that could not be deleted to the RepoError encountered.'''
+        def delete_one(resource_identifier):
+            '''Worker function'''
+            try:
+                self.delete(resource_identifier)
+            except RepoError, err:
+                return resource_identifier, err
+            return resource_identifier, None
+
+        return dict(
+            (identifier, err) for identifier, err in concurrent_imap(
+                delete_one, resource_identifiers,
+                concurrency or CONCURRENT_REQUESTS)
+            if err)
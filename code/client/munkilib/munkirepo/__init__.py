@@ -1,4 +1,6 @@
+import hashlib
 import imp
+import itertools
 import os
 import sys
 
@@ -14,6 +16,108 @@ class Repo(object):
         '''Override in subclasses'''
         pass
 
+    def itemlist_with_metadata(self, kind, include_hashes=False):
+        '''Returns a list of (identifier, metadata) tuples for each item of
+        kind, in the same order as itemlist(kind). metadata is a dict that
+        may contain:
+            'size': size of the item in bytes
+            'mtime': modification time of the item, in seconds since the epoch
+            'etag': an opaque string that changes whenever the item changes
+            'sha256': SHA-256 hex digest of the item's content
+        Plugins supply whatever they can get without reading each item, so
+        callers must cope with any of these being missing. If include_hashes
+        is True, 'size' and 'sha256' are present for every item that can be
+        read, even if that means reading every item.
+        This generic fallback has no cheap metadata to offer.'''
+        identifiers = self.itemlist(kind)
+        if not include_hashes:
+            return [(identifier, {}) for identifier in identifiers]
+        metadata_list = []
+        resource_identifiers = [os.path.join(kind, identifier)
+                                for identifier in identifiers]
+        for identifier, (dummy_ref, content, err) in itertools.izip(
+                identifiers, self.get_many(resource_identifiers)):
+            if err:
+                # leave it to the caller to deal with when it tries to
+                # get() the item
+                metadata_list.append((identifier, {}))
+                continue
+            metadata_list.append(
+                (identifier, {'size': len(content),
+                              'sha256': hashlib.sha256(content).hexdigest()}))
+        return metadata_list
+
+    # The *_many methods below are generic fallbacks that work one item at a
+    # time using get(), put() and delete(). Plugins that can overlap or
+    # pipeline requests should override them. concurrency is a hint for how
+    # many items to work on at once; None means the plugin's own default.
+    # These fallbacks ignore it.
+
+    def get_many(self, resource_identifiers, concurrency=None):
+        '''Gets the content of several items. Yields a
+        (resource_identifier, content, error) tuple for each item, in the
+        order given. If an item could not be retrieved, content is None and
+        error is a RepoError; otherwise error is None.'''
+        for resource_identifier in resource_identifiers:
+            yield get_item_or_error(self, resource_identifier)
+
+    def put_many(self, content_by_identifier, concurrency=None):
+        '''Stores several items on the repo. content_by_identifier is a dict
+        mapping resource_identifiers to content. Returns a dict mapping the
+        resource_identifiers of any items that could not be stored to the
+        RepoError encountered; an empty dict means everything was stored.'''
+        failures = {}
+        for resource_identifier in sorted(content_by_identifier):
+            try:
+                self.put(resource_identifier,
+                         content_by_identifier[resource_identifier])
+            except RepoError, err:
+                failures[resource_identifier] = err
+        return failures
+
+    def put_many_from_local_files(self, path_by_identifier,
+                                  concurrency=None):
+        '''Copies several local files to the repo. path_by_identifier is a
+        dict mapping resource_identifiers to local file paths. Returns a
+        dict mapping the resource_identifiers of any items that could not be
+        stored to the RepoError encountered; an empty dict means everything
+        was stored.'''
+        failures = {}
+        for resource_identifier in sorted(path_by_identifier):
+            try:
+                self.put_from_local_file(
+                    resource_identifier,
+                    path_by_identifier[resource_identifier])
+            except RepoError, err:
+                failures[resource_identifier] = err
+        return failures
+
+    def delete_many(self, resource_identifiers, concurrency=None):
+        '''Deletes several items from the repo. Returns a dict mapping the
+        resource_identifiers of any items that could not be deleted to the
+        RepoError encountered; an empty dict means everything was deleted.'''
+        failures = {}
+        for resource_identifier in resource_identifiers:
+            try:
+                self.delete(resource_identifier)
+            except RepoError, err:
+                failures[resource_identifier] = err
+        return failures
+
+
+def get_item_or_error(repo, resource_identifier):
+    '''Returns a (resource_identifier, content, error) tuple for get_many().
+    Any error from repo.get() is returned as a RepoError, so one item a
+    plugin can't read doesn't stop the others from being read.'''
+    try:
+        return resource_identifier, repo.get(resource_identifier), None
+    except RepoError, err:
+        return resource_identifier, None, err
+    except IOError, err:
+        return resource_identifier, None, RepoError(err)
+    except BaseException, err:
+        return resource_identifier, None, RepoError(err)
+
 
 def plugin_named(name):
     '''Returns a plugin object given a name'''
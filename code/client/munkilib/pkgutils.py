@@ -22,7 +22,6 @@ Common pkg/receipt functions and classes used by the munki tools.
 """
 
 import os
-import re
 import shutil
 import subprocess
 import tempfile
@@ -37,6 +36,11 @@ from . import osutils
 from . import utils
 from . import FoundationPlist
 
+# these are also needed by tools that can't use PyObjC. trim_version_string
+# and version_key aren't used here, but callers still get them from pkgutils.
+from .versionutils import nameAndVersion
+from .versionutils import trim_version_string, version_key  # noqa: F401
+
 # we use lots of camelCase-style names. Deal with it.
 # pylint: disable=C0103
 
@@ -607,71 +611,6 @@ def getInstalledPackageVersion(pkgid):
     return ""
 
 
-def trim_version_string(version_string):
-    """Trims all lone trailing zeros in the version string after major/minor.
-
-    Examples:
-      10.0.0.0 -> 10.0
-      10.0.0.1 -> 10.0.0.1
-      10.0.0-abc1 -> 10.0.0-abc1
-      10.0.0-abc1.0 -> 10.0.0-abc1
-    """
-    if version_string is None or version_string == '':
-        return ''
-    version_parts = version_string.split('.')
-    # strip off all trailing 0's in the version, while over 2 parts.
-    while len(version_parts) > 2 and version_parts[-1] == '0':
-        del version_parts[-1]
-    return '.'.join(version_parts)
-
-
-def nameAndVersion(aString):
-    """
-    Splits a string into the name and version numbers:
-    'TextWrangler2.3b1' becomes ('TextWrangler', '2.3b1')
-    'AdobePhotoshopCS3-11.2.1' becomes ('AdobePhotoshopCS3', '11.2.1')
-    'MicrosoftOffice2008v12.2.1' becomes ('MicrosoftOffice2008', '12.2.1')
-    """
-    # first try regex
-    m = re.search(r'[0-9]+(\.[0-9]+)((\.|a|b|d|v)[0-9]+)+', aString)
-    if m:
-        vers = m.group(0)
-        name = aString[0:aString.find(vers)].rstrip(' .-_v')
-        return (name, vers)
-
-    # try another way
-    index = 0
-    for char in aString[::-1]:
-        if char in '0123456789._':
-            index -= 1
-        elif char in 'abdv':
-            partialVersion = aString[index:]
-            if set(partialVersion).intersection(set('abdv')):
-                # only one of 'abdv' allowed in the version
-                break
-            else:
-                index -= 1
-        else:
-            break
-
-    if index < 0:
-        possibleVersion = aString[index:]
-        # now check from the front of the possible version until we
-        # reach a digit (because we might have characters in '._abdv'
-        # at the start)
-        for char in possibleVersion:
-            if not char in '0123456789':
-                index += 1
-            else:
-                break
-        vers = aString[index:]
-        return (aString[0:index].rstrip(' .-_v'), vers)
-    else:
-        # no version number found,
-        # just return original string and empty string
-        return (aString, '')
-
-
 def hasValidConfigProfileExt(path):
     """Verifies a path ends in '.mobileconfig'"""
     ext = os.path.splitext(path)[1]
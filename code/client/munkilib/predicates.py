@@ -0,0 +1,417 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+predicates.py
+
+A pure-Python evaluator for the subset of NSPredicate format strings used in
+manifest conditional_items and installable_condition, so conditions can be
+checked without PyObjC (on a build host, or in tests). Clients evaluate
+conditions with NSPredicate; see info.predicate_evaluates_as_true().
+
+Supported:
+  comparisons: ==, =, !=, <>, <, <=, =<, >, >=, =>, BEGINSWITH, ENDSWITH,
+               CONTAINS, LIKE, MATCHES, IN, BETWEEN, with the [c] (case
+               insensitive) and [d] (diacritic insensitive) modifiers
+  aggregates: ANY, SOME, ALL, NONE
+  compound predicates: AND, &&, OR, ||, NOT, !, and parentheses
+  TRUEPREDICATE and FALSEPREDICATE
+  values: key paths, quoted strings, numbers, TRUE, YES, FALSE, NO, NIL,
+          NULL, {array, of, values} and CAST("...", "NSDate")
+
+This module must not depend on PyObjC.
+"""
+
+import datetime
+import re
+import unicodedata
+
+from .utils import Memoize
+
+
+class PredicateError(Exception):
+    '''Error to raise when a predicate can't be parsed or evaluated'''
+    pass
+
+
+# NSDate's reference date, for CAST(number, "NSDate")
+REFERENCE_DATE = datetime.datetime(2001, 1, 1)
+
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<operator>==|=<|=>|<=|>=|!=|<>|&&|\|\||[=<>!(){},\[\]])
+      | (?P<word>\#?[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_@][A-Za-z0-9_]*)*)
+    )''', re.VERBOSE)
+
+_COMPARISON_WORDS = ['BEGINSWITH', 'ENDSWITH', 'CONTAINS', 'LIKE', 'MATCHES',
+                     'IN', 'BETWEEN']
+_COMPARISON_SYMBOLS = {'==': '==', '=': '==', '!=': '!=', '<>': '!=',
+                       '<': '<', '<=': '<=', '=<': '<=', '>': '>',
+                       '>=': '>=', '=>': '>='}
+_AGGREGATES = ['ANY', 'SOME', 'ALL', 'NONE']
+_CONSTANTS = {'TRUE': True, 'YES': True, 'FALSE': False, 'NO': False,
+              'NIL': None, 'NULL': None}
+
+
+def _tokenize(predicate_string):
+    '''Returns a list of (kind, value) tokens for predicate_string'''
+    tokens = []
+    position = 0
+    predicate_string = predicate_string.rstrip()
+    while position < len(predicate_string):
+        match = _TOKEN_RE.match(predicate_string, position)
+        if not match:
+            raise PredicateError(
+                'Unable to parse the format string "%s"' % predicate_string)
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = _unquote(value)
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'word' and value.upper() in (
+                _COMPARISON_WORDS + _AGGREGATES + list(_CONSTANTS) +
+                ['AND', 'OR', 'NOT', 'TRUEPREDICATE', 'FALSEPREDICATE',
+                 'CAST']):
+            kind, value = 'keyword', value.upper()
+        elif kind == 'word' and value.startswith('#'):
+            # an escaped reserved word used as a key
+            value = value[1:]
+        tokens.append((kind, value))
+    return tokens
+
+
+def _unquote(quoted):
+    '''Returns the content of a quoted string token'''
+    content = quoted[1:-1]
+    return re.sub(r'\\(.)', r'\1', content)
+
+
+class _Parser(object):
+    '''Recursive descent parser building a tree of tuples:
+        ('true',) or ('false',)
+        ('not', predicate)
+        ('and', left, right) or ('or', left, right)
+        ('compare', aggregate, operator, modifiers, left, right)
+    where left and right are expressions:
+        ('key', keypath) or ('value', value) or ('array', [expressions])
+    '''
+
+    def __init__(self, predicate_string):
+        self.predicate_string = predicate_string
+        self.tokens = _tokenize(predicate_string)
+        self.position = 0
+
+    def error(self, message):
+        '''Raises a PredicateError'''
+        raise PredicateError(
+            '%s in format string "%s"' % (message, self.predicate_string))
+
+    def peek(self):
+        '''Returns the next token without consuming it'''
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self):
+        '''Consumes and returns the next token'''
+        token = self.peek()
+        if token == (None, None):
+            self.error('Unexpected end')
+        self.position += 1
+        return token
+
+    def expect(self, kind, value):
+        '''Consumes the next token, which must be (kind, value)'''
+        if self.next() != (kind, value):
+            self.error('Expected "%s"' % value)
+
+    def parse(self):
+        '''Returns the tree for the whole predicate'''
+        tree = self.parse_or()
+        if self.peek() != (None, None):
+            self.error('Unexpected "%s"' % self.peek()[1])
+        return tree
+
+    def parse_or(self):
+        '''Parses predicates joined by OR'''
+        tree = self.parse_and()
+        while self.peek() in [('keyword', 'OR'), ('operator', '||')]:
+            self.next()
+            tree = ('or', tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        '''Parses predicates joined by AND'''
+        tree = self.parse_not()
+        while self.peek() in [('keyword', 'AND'), ('operator', '&&')]:
+            self.next()
+            tree = ('and', tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        '''Parses a predicate, possibly negated'''
+        if self.peek() in [('keyword', 'NOT'), ('operator', '!')]:
+            self.next()
+            return ('not', self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        '''Parses a parenthesized predicate, a constant predicate or a
+        comparison'''
+        token = self.peek()
+        if token == ('operator', '('):
+            self.next()
+            tree = self.parse_or()
+            self.expect('operator', ')')
+            return tree
+        if token == ('keyword', 'TRUEPREDICATE'):
+            self.next()
+            return ('true',)
+        if token == ('keyword', 'FALSEPREDICATE'):
+            self.next()
+            return ('false',)
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        '''Parses a comparison between two expressions'''
+        aggregate = None
+        if self.peek()[0] == 'keyword' and self.peek()[1] in _AGGREGATES:
+            aggregate = self.next()[1]
+            if aggregate == 'SOME':
+                aggregate = 'ANY'
+        left = self.parse_expression()
+        kind, value = self.next()
+        if kind == 'operator' and value in _COMPARISON_SYMBOLS:
+            operator = _COMPARISON_SYMBOLS[value]
+        elif kind == 'keyword' and value in _COMPARISON_WORDS:
+            operator = value
+        else:
+            self.error('Expected a comparison, found "%s"' % value)
+        modifiers = ''
+        if self.peek() == ('operator', '['):
+            self.next()
+            kind, modifiers = self.next()
+            if kind != 'word' or not set(modifiers.lower()) <= set('cdn'):
+                self.error('Unknown comparison modifier "%s"' % modifiers)
+            modifiers = modifiers.lower()
+            self.expect('operator', ']')
+        right = self.parse_expression()
+        return ('compare', aggregate, operator, modifiers, left, right)
+
+    def parse_expression(self):
+        '''Parses a key path, a constant value, an array or a CAST'''
+        kind, value = self.next()
+        if kind in ['string', 'number']:
+            return ('value', value)
+        if kind == 'word':
+            return ('key', value)
+        if kind == 'keyword' and value in _CONSTANTS:
+            return ('value', _CONSTANTS[value])
+        if kind == 'keyword' and value == 'CAST':
+            self.expect('operator', '(')
+            cast_value = self.parse_expression()
+            self.expect('operator', ',')
+            kind, cast_type = self.next()
+            self.expect('operator', ')')
+            if cast_value[0] != 'value' or kind != 'string':
+                self.error('Unsupported CAST')
+            return ('value', _cast(cast_value[1], cast_type))
+        if (kind, value) == ('operator', '{'):
+            items = []
+            if self.peek() != ('operator', '}'):
+                items.append(self.parse_expression())
+                while self.peek() == ('operator', ','):
+                    self.next()
+                    items.append(self.parse_expression())
+            self.expect('operator', '}')
+            return ('array', items)
+        if (kind, value) == ('operator', '('):
+            expression = self.parse_expression()
+            self.expect('operator', ')')
+            return expression
+        return self.error('Unexpected "%s"' % value)
+
+
+def _cast(value, cast_type):
+    '''Returns value CAST to cast_type; only NSDate is supported'''
+    if cast_type != 'NSDate':
+        raise PredicateError('Unsupported CAST to %s' % cast_type)
+    if isinstance(value, (int, long, float)):
+        return REFERENCE_DATE + datetime.timedelta(seconds=value)
+    for date_format in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S +0000',
+                        '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            pass
+    raise PredicateError('Can\'t CAST "%s" to NSDate' % value)
+
+
+@Memoize
+def compile_predicate(predicate_string):
+    '''Parses predicate_string and returns a tree for evaluate_tree().
+    Results are cached, so each distinct predicate is only parsed once.
+    Raises PredicateError if it can't be parsed.'''
+    return _Parser(predicate_string).parse()
+
+
+def evaluate(predicate_string, info_object):
+    '''Returns True if predicate_string is true for info_object, a dict.
+    Raises PredicateError if the predicate can't be parsed or evaluated.'''
+    return evaluate_tree(compile_predicate(predicate_string), info_object)
+
+
+def evaluate_tree(tree, info_object):
+    '''Evaluates a tree returned by compile_predicate() against
+    info_object'''
+    kind = tree[0]
+    if kind == 'true':
+        return True
+    if kind == 'false':
+        return False
+    if kind == 'not':
+        return not evaluate_tree(tree[1], info_object)
+    if kind == 'and':
+        return (evaluate_tree(tree[1], info_object) and
+                evaluate_tree(tree[2], info_object))
+    if kind == 'or':
+        return (evaluate_tree(tree[1], info_object) or
+                evaluate_tree(tree[2], info_object))
+    dummy, aggregate, operator, modifiers, left, right = tree
+    left_value = _expression_value(left, info_object)
+    right_value = _expression_value(right, info_object)
+    if aggregate is None:
+        return _compare(operator, modifiers, left_value, right_value)
+    if not isinstance(left_value, (list, tuple, set)):
+        if left_value is None:
+            left_value = []
+        else:
+            raise PredicateError(
+                '%s needs a collection on the left-hand side' % aggregate)
+    results = [_compare(operator, modifiers, item, right_value)
+               for item in left_value]
+    if aggregate == 'ANY':
+        return any(results)
+    if aggregate == 'ALL':
+        return all(results)
+    # NONE
+    return not any(results)
+
+
+def _expression_value(expression, info_object):
+    '''Returns the value of an expression for info_object'''
+    kind = expression[0]
+    if kind == 'value':
+        return expression[1]
+    if kind == 'array':
+        return [_expression_value(item, info_object)
+                for item in expression[1]]
+    return _value_for_key_path(info_object, expression[1])
+
+
+def _value_for_key_path(value, key_path):
+    '''Looks up a dotted key path, like valueForKeyPath: does'''
+    for key in key_path.split('.'):
+        if key == '@count' and isinstance(value, (list, tuple, dict)):
+            value = len(value)
+        elif isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, (list, tuple)):
+            value = [_value_for_key_path(item, key) for item in value]
+        else:
+            return None
+    return value
+
+
+def _normalize(value, modifiers):
+    '''Applies the case and diacritic insensitive modifiers to a string'''
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item, modifiers) for item in value]
+    if not isinstance(value, basestring):
+        return value
+    if 'd' in modifiers:
+        if isinstance(value, str):
+            value = value.decode('UTF-8', 'replace')
+        value = u''.join(
+            char for char in unicodedata.normalize('NFD', value)
+            if not unicodedata.combining(char))
+    if 'c' in modifiers:
+        value = value.lower()
+    return value
+
+
+def _compare(operator, modifiers, left, right):
+    '''Returns the result of comparing left to right with operator'''
+    if modifiers:
+        left = _normalize(left, modifiers)
+        right = _normalize(right, modifiers)
+
+    if operator == '==':
+        return left == right
+    if operator == '!=':
+        return left != right
+    if operator in ['<', '<=', '>', '>=']:
+        if left is None or right is None:
+            return False
+        if operator == '<':
+            return left < right
+        if operator == '<=':
+            return left <= right
+        if operator == '>':
+            return left > right
+        return left >= right
+    if operator == 'IN':
+        if isinstance(right, (list, tuple, dict, set)):
+            return left in right
+        if isinstance(right, basestring) and isinstance(left, basestring):
+            return left in right
+        return False
+    if operator == 'CONTAINS':
+        if isinstance(left, (list, tuple, set)):
+            return right in left
+        if isinstance(left, basestring) and isinstance(right, basestring):
+            return right in left
+        return False
+    if operator == 'BETWEEN':
+        if not isinstance(right, (list, tuple)) or len(right) != 2:
+            raise PredicateError('BETWEEN needs an array of two values')
+        if left is None:
+            return False
+        return right[0] <= left <= right[1]
+    if not (isinstance(left, basestring) and isinstance(right, basestring)):
+        return False
+    if operator == 'BEGINSWITH':
+        return left.startswith(right)
+    if operator == 'ENDSWITH':
+        return left.endswith(right)
+    if operator == 'LIKE':
+        # * matches any characters and ? matches one
+        pattern = re.escape(right).replace('\\*', '.*').replace('\\?', '.')
+        return re.match('(?:%s)\\Z' % pattern, left, re.DOTALL) is not None
+    if operator == 'MATCHES':
+        flags = re.IGNORECASE if 'c' in modifiers else 0
+        try:
+            return re.match('(?:%s)\\Z' % right, left, flags) is not None
+        except re.error, err:
+            raise PredicateError('Invalid regular expression: %s' % err)
+    raise PredicateError('Unsupported operator %s' % operator)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
@@ -47,6 +47,8 @@ DEFAULT_INSECURE_REPO_URL = 'http://munki/repo'
 DEFAULT_PREFS = {
     'AdditionalHttpHeaders': None,
     'AppleSoftwareUpdatesOnly': False,
+    'CacheEvictionPolicy': 'lru',
+    'CacheSizeLimitMB': 0,
     'CatalogURL': None,
     'ClientCertificatePath': None,
     'ClientIdentifier': '',
@@ -56,6 +58,7 @@ DEFAULT_PREFS = {
     'DaysBetweenNotifications': 1,
     'FollowHTTPRedirects': 'none',
     'HelpURL': None,
+    'HTTPTransport': 'gurl',
     'IconURL': None,
     'IgnoreSystemProxies': False,
     'InstallRequiresLogout': False,
@@ -67,6 +70,8 @@ DEFAULT_PREFS = {
     'LogToSyslog': False,
     'ManagedInstallDir': '/Library/Managed Installs',
     'ManifestURL': None,
+    'MaxConcurrentDownloads': 1,
+    'MaxConcurrentManifestDownloads': 4,
     'PackageURL': None,
     'PackageVerificationMode': 'hash',
     'PerformAuthRestarts': False,
@@ -84,6 +89,7 @@ DEFAULT_PREFS = {
     'UseClientCertificate': False,
     'UseClientCertificateCNAsClientIdentifier': False,
     'UseNotificationCenterDays': 3,
+    'UsePrecompiledCatalogs': False,
 }
 
 
@@ -27,23 +27,33 @@ from . import catalogs
 from . import compare
 from . import download
 from . import installationstate
+from . import manifestresolver
 from . import manifestutils
 from . import unused_software
 
 from .. import display
 from .. import fetch
-from .. import info
 from .. import munkilog
 from .. import prefs
 from .. import processes
 
 
+# installer items downloading in the background while we check for updates;
+# see start_download_queue()
+_DOWNLOADS = {'queue': None}
+
+
 def item_in_installinfo(item_pl, thelist, vers=''):
     """Determines if an item is in a list of processed items.
 
     Returns True if the item has already been processed (it's in the list)
     and, optionally, the version is the same or greater.
     """
+    if hasattr(thelist, 'items_named'):
+        # an indexed list; only look at the items with the same name
+        if 'name' not in item_pl:
+            return False
+        thelist = thelist.items_named(item_pl['name'])
     for listitem in thelist:
         try:
             if listitem['name'] == item_pl['name']:
@@ -85,6 +95,138 @@ def is_apple_item(item_pl):
     return False
 
 
+def download_speed(installer_item_size, download_seconds):
+    """Returns the download speed in KB/s to record in InstallResults for an
+    item of installer_item_size KB that took download_seconds to download"""
+    try:
+        if installer_item_size < 1024:
+            # ignore downloads under 1 MB or speeds will
+            # be skewed.
+            return 0
+        # installer_item_size is KBytes, so divide
+        # by seconds.
+        return int(installer_item_size / download_seconds)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0
+
+
+def record_failed_download(manifestitem, item_pl, iteminfo, err):
+    """Warns about a failed download of the installer item for item_pl and
+    turns iteminfo into a managed_installs entry explaining why it can't be
+    installed"""
+    if isinstance(err, fetch.PackageVerificationError):
+        display.display_warning(
+            'Can\'t install %s because the integrity check failed.',
+            manifestitem)
+        note = 'Integrity check failed'
+    elif isinstance(err, (fetch.GurlError, fetch.GurlDownloadError)):
+        display.display_warning(
+            'Download of %s failed: %s', manifestitem, err)
+        note = u'Download failed (%s)' % err
+    else:
+        display.display_warning(
+            'Can\'t install %s because: %s', manifestitem, err)
+        note = '%s' % err
+    # drop anything that was recorded on the assumption that the download
+    # would work
+    for key in iteminfo.keys():
+        if key not in ['name', 'display_name', 'description',
+                       'localized_strings', 'installer_item_size',
+                       'installed_size']:
+            del iteminfo[key]
+    iteminfo['installed'] = False
+    iteminfo['note'] = note
+    iteminfo['version_to_install'] = item_pl.get('version', 'UNKNOWN')
+    for key in ['developer', 'icon_name']:
+        if key in item_pl:
+            iteminfo[key] = item_pl[key]
+
+
+def start_download_queue():
+    """If the MaxConcurrentDownloads preference is greater than 1, installer
+    items found by process_install() are downloaded in the background, that
+    many at a time, until finish_download_queue() is called. Otherwise
+    process_install() downloads each item before it carries on."""
+    try:
+        max_concurrent = int(prefs.pref('MaxConcurrentDownloads') or 1)
+    except (TypeError, ValueError):
+        max_concurrent = 1
+    if max_concurrent > 1:
+        _DOWNLOADS['queue'] = download.DownloadQueue(max_concurrent)
+
+
+def finish_download_queue(installinfo):
+    """Waits for any background downloads to finish and records the results
+    in installinfo['managed_installs']. Items whose download failed are
+    recorded as they would have been had they been downloaded as they were
+    found. So are items that require an item that can't be installed, and
+    updates all of whose targets can't be installed; an update for several
+    items is still installed if any of them can be."""
+    queue = _DOWNLOADS['queue']
+    if not queue:
+        return
+    _DOWNLOADS['queue'] = None
+    failed_names = set()
+    for context, downloaded, seconds, err in queue.join():
+        manifestitem, item_pl, iteminfo = context
+        if err:
+            record_failed_download(manifestitem, item_pl, iteminfo, err)
+            failed_names.add(iteminfo['name'])
+            continue
+        if downloaded:
+            speed = download_speed(iteminfo['installer_item_size'], seconds)
+            iteminfo['download_kbytes_per_sec'] = speed
+            if speed:
+                display.display_detail(
+                    '%s downloaded at %d KB/s',
+                    iteminfo['installer_item'], speed)
+
+    def names(iteminfo, key):
+        """Returns the item names listed under key in iteminfo"""
+        value = iteminfo.get(key, [])
+        if isinstance(value, basestring):
+            value = [value]
+        return [catalogs.split_name_and_version(item)[0] for item in value]
+
+    # an item can't be installed if something it requires can't be
+    # installed, and an update can't be installed if none of the items it
+    # updates can be; keep going until no more items drop out
+    all_failed = set(failed_names)
+    while failed_names:
+        newly_failed = set()
+        for iteminfo in installinfo['managed_installs']:
+            if not iteminfo.get('installer_item'):
+                continue
+            required = names(iteminfo, 'requires')
+            updated = names(iteminfo, 'update_for')
+            if ([name for name in required if name in all_failed] or
+                    (updated and not [name for name in updated
+                                      if name not in all_failed])):
+                display.display_warning(
+                    'Didn\'t attempt to install %s because could not resolve '
+                    'all dependencies.', iteminfo['name'])
+                for key in iteminfo.keys():
+                    if key not in ['name', 'display_name', 'description',
+                                   'localized_strings', 'version_to_install',
+                                   'developer', 'icon_name']:
+                        del iteminfo[key]
+                iteminfo['installed'] = False
+                iteminfo['note'] = (
+                    'Can\'t install %s because could not resolve all '
+                    'dependencies.' % iteminfo['display_name'])
+                newly_failed.add(iteminfo['name'])
+        all_failed.update(newly_failed)
+        failed_names = newly_failed
+
+
+def cancel_download_queue():
+    """Drops any background downloads that haven't started yet; used when
+    the update check stops early"""
+    if _DOWNLOADS['queue']:
+        _DOWNLOADS['queue'].cancel()
+        _DOWNLOADS['queue'] = None
+
+
 def already_processed(itemname, installinfo, sections):
     '''Returns True if itemname has already been added to installinfo in one
     of the given sections'''
@@ -150,12 +292,12 @@ def process_optional_install(manifestitem, cataloglist, installinfo):
 
     # check to see if item (any version) is already in the
     # optional_install list:
-    for item in installinfo['optional_installs']:
-        if manifestitemname == item['name']:
-            display.display_debug1(
-                '%s has already been processed for optional install.',
-                manifestitemname)
-            return
+    if item_in_installinfo({'name': manifestitemname},
+                           installinfo['optional_installs']):
+        display.display_debug1(
+            '%s has already been processed for optional install.',
+            manifestitemname)
+        return
 
     item_pl = catalogs.get_item_detail(manifestitem, cataloglist,
                                        suppress_warnings=True)
@@ -412,37 +554,35 @@ def process_install(manifestitem, cataloglist, installinfo,
             start = datetime.datetime.now()
             if item_pl.get('installer_type', 0) == 'nopkg':
                 # Packageless install
-                download_speed = 0
+                speed = 0
                 filename = 'packageless_install'
+            elif _DOWNLOADS['queue']:
+                # download in the background; finish_download_queue()
+                # records the download speed, or why it failed
+                _DOWNLOADS['queue'].add(
+                    item_pl, installinfo,
+                    context=(manifestitem, item_pl, iteminfo))
+                speed = 0
+                filename = download.get_url_basename(
+                    item_pl['installer_item_location'])
             else:
                 if download.download_installeritem(item_pl, installinfo):
                     # Record the download speed to the InstallResults output.
                     end = datetime.datetime.now()
-                    download_seconds = (end - start).seconds
-                    try:
-                        if iteminfo['installer_item_size'] < 1024:
-                            # ignore downloads under 1 MB or speeds will
-                            # be skewed.
-                            download_speed = 0
-                        else:
-                            # installer_item_size is KBytes, so divide
-                            # by seconds.
-                            download_speed = int(
-                                iteminfo['installer_item_size'] /
-                                download_seconds)
-                    except (TypeError, ValueError, ZeroDivisionError):
-                        download_speed = 0
+                    speed = download_speed(
+                        iteminfo['installer_item_size'],
+                        (end - start).seconds)
                 else:
-                    # Item was already in cache; set download_speed to 0.
-                    download_speed = 0
+                    # Item was already in cache; set download speed to 0.
+                    speed = 0
 
                 filename = download.get_url_basename(
                     item_pl['installer_item_location'])
 
-            iteminfo['download_kbytes_per_sec'] = download_speed
-            if download_speed:
+            iteminfo['download_kbytes_per_sec'] = speed
+            if speed:
                 display.display_detail(
-                    '%s downloaded at %d KB/s', filename, download_speed)
+                    '%s downloaded at %d KB/s', filename, speed)
 
             # required keys
             iteminfo['installer_item'] = filename
@@ -541,42 +681,8 @@ def process_install(manifestitem, cataloglist, installinfo,
                     update_item, cataloglist, installinfo,
                     is_managed_update=is_managed_update)
             return True
-        except fetch.PackageVerificationError:
-            display.display_warning(
-                'Can\'t install %s because the integrity check failed.',
-                manifestitem)
-            iteminfo['installed'] = False
-            iteminfo['note'] = 'Integrity check failed'
-            iteminfo['version_to_install'] = item_pl.get('version', 'UNKNOWN')
-            for key in ['developer', 'icon_name']:
-                if key in item_pl:
-                    iteminfo[key] = item_pl[key]
-            installinfo['managed_installs'].append(iteminfo)
-            #if manifestitemname in installinfo['processed_installs']:
-            #    installinfo['processed_installs'].remove(manifestitemname)
-            return False
-        except (fetch.GurlError, fetch.GurlDownloadError), errmsg:
-            display.display_warning(
-                'Download of %s failed: %s', manifestitem, errmsg)
-            iteminfo['installed'] = False
-            iteminfo['note'] = u'Download failed (%s)' % errmsg
-            iteminfo['version_to_install'] = item_pl.get('version', 'UNKNOWN')
-            for key in ['developer', 'icon_name']:
-                if key in item_pl:
-                    iteminfo[key] = item_pl[key]
-            installinfo['managed_installs'].append(iteminfo)
-            #if manifestitemname in installinfo['processed_installs']:
-            #    installinfo['processed_installs'].remove(manifestitemname)
-            return False
         except fetch.Error, errmsg:
-            display.display_warning(
-                'Can\'t install %s because: %s', manifestitemname, errmsg)
-            iteminfo['installed'] = False
-            iteminfo['note'] = '%s' % errmsg
-            iteminfo['version_to_install'] = item_pl.get('version', 'UNKNOWN')
-            for key in ['developer', 'icon_name']:
-                if key in item_pl:
-                    iteminfo[key] = item_pl[key]
+            record_failed_download(manifestitem, item_pl, iteminfo, errmsg)
             installinfo['managed_installs'].append(iteminfo)
             #if manifestitemname in installinfo['processed_installs']:
             #    installinfo['processed_installs'].remove(manifestitemname)
@@ -636,67 +742,26 @@ def process_manifest_for_key(manifest, manifest_key, installinfo,
     """Processes keys in manifests to build the lists of items to install and
     remove.
 
-    Can be recursive if manifests include other manifests.
-    Probably doesn't handle circular manifest references well.
+    Includes the manifests that manifest includes, and its conditional_items.
+    To process several keys, resolve the manifest once with
+    manifestresolver.resolve_manifest() and use process_resolved_items().
 
     manifest can be a path to a manifest file or a dictionary object.
     """
-    if isinstance(manifest, basestring):
-        display.display_debug1(
-            "** Processing manifest %s for %s" %
-            (os.path.basename(manifest), manifest_key))
-        manifestdata = manifestutils.get_manifest_data(manifest)
-    else:
-        manifestdata = manifest
-        manifest = 'embedded manifest'
+    resolved = manifestresolver.resolve_manifest(
+        manifest, keys=[manifest_key], parentcatalogs=parentcatalogs)
+    process_resolved_items(resolved, manifest_key, installinfo)
 
-    cataloglist = manifestdata.get('catalogs')
-    if cataloglist:
-        catalogs.get_catalogs(cataloglist)
-    elif parentcatalogs:
-        cataloglist = parentcatalogs
 
-    if not cataloglist:
-        display.display_warning('Manifest %s has no catalogs', manifest)
-        return
-
-    for item in manifestdata.get('included_manifests', []):
-        if item: # only process if item is not empty
-            nestedmanifestpath = manifestutils.get_manifest(item)
-            if not nestedmanifestpath:
-                raise manifestutils.ManifestException
-            if processes.stop_requested():
-                return {}
-            process_manifest_for_key(nestedmanifestpath, manifest_key,
-                                     installinfo, cataloglist)
-
-    conditionalitems = manifestdata.get('conditional_items', [])
-    if conditionalitems:
-        display.display_debug1(
-            '** Processing conditional_items in %s', manifest)
-    # conditionalitems should be an array of dicts
-    # each dict has a predicate; the rest consists of the
-    # same keys as a manifest
-    for item in conditionalitems:
-        try:
-            predicate = item['condition']
-        except (AttributeError, KeyError):
-            display.display_warning(
-                'Missing predicate for conditional_item %s', item)
-            continue
-        except BaseException:
-            display.display_warning(
-                'Conditional item is malformed: %s', item)
-            continue
-        if info.predicate_evaluates_as_true(
-                predicate, additional_info={'catalogs': cataloglist}):
-            conditionalmanifest = item
-            process_manifest_for_key(
-                conditionalmanifest, manifest_key, installinfo, cataloglist)
-
-    for item in manifestdata.get(manifest_key, []):
+def process_resolved_items(resolved, manifest_key, installinfo):
+    """Processes the items for manifest_key in resolved, as returned by
+    manifestresolver.resolve_manifest(), to build the lists of items to
+    install and remove."""
+    for item, cataloglist, source in resolved.get(manifest_key, []):
         if processes.stop_requested():
-            return {}
+            return
+        display.display_debug2(
+            'Processing %s from %s for %s', item, source, manifest_key)
         if manifest_key == 'managed_installs':
             dummy_result = process_install(item, cataloglist, installinfo)
         elif manifest_key == 'managed_updates':
@@ -744,8 +809,7 @@ def process_removal(manifestitem, cataloglist, installinfo):
         manifestitemname_withversion)
 
     # have we processed this already?
-    if manifestitemname in [catalogs.split_name_and_version(item)[0]
-                            for item in installinfo['processed_installs']]:
+    if installinfo['processed_installs'].contains_name(manifestitemname):
         display.display_warning(
             'Will not attempt to remove %s because some version of it is in '
             'the list of managed installs, or it is required by another'
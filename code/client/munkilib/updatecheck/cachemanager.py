@@ -0,0 +1,244 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+updatecheck.cachemanager
+
+Eviction policy for the Cache directory.
+
+Each time an installer item is needed, its use is recorded in xattrs on the
+cached file. When the Cache directory grows past the CacheSizeLimitMB
+preference, or space is needed for a download, items are evicted in the
+order given by the CacheEvictionPolicy preference:
+
+    lru: least recently used first
+    lfu: least frequently used first, then least recently used
+
+with larger items first among equals. Items referenced by InstallInfo.plist,
+and items used or downloaded during this run (including their partial
+downloads), are pinned and never evicted. Evictions are recorded in the
+report as CacheEvictions.
+"""
+
+import os
+import threading
+import time
+
+import xattr
+
+from . import contentcache
+
+from .. import display
+from .. import fetch
+from .. import osutils
+from .. import prefs
+from .. import reports
+from .. import FoundationPlist
+
+
+# XATTR names storing when a cached item was last used, and how many times
+XATTR_LAST_USED = 'com.googlecode.munki.lastused'
+XATTR_USE_COUNT = 'com.googlecode.munki.usecount'
+
+# names of the items used (or being downloaded) during this run; downloads
+# run on worker threads, so access is guarded by _USED_LOCK
+_USED_THIS_RUN = set()
+_USED_LOCK = threading.Lock()
+
+
+def cache_dir():
+    '''Returns the path of the Cache directory'''
+    return os.path.join(prefs.pref('ManagedInstallDir'), 'Cache')
+
+
+def _cached_names():
+    '''Returns the names of the items in the Cache directory'''
+    if not os.path.isdir(cache_dir()):
+        return []
+    return osutils.listdir(cache_dir())
+
+
+def pin(path):
+    '''Records that the cached item at path is needed during this run, so
+    neither it nor its partial download is evicted. Call this before
+    starting to download the item.'''
+    with _USED_LOCK:
+        _USED_THIS_RUN.add(os.path.basename(path))
+
+
+def record_use(path):
+    '''Records that the cached item at path was needed just now'''
+    pin(path)
+    try:
+        count = int(fetch.getxattr(path, XATTR_USE_COUNT) or 0)
+    except (IOError, ValueError):
+        count = 0
+    try:
+        xattr.setxattr(path, XATTR_LAST_USED, str(int(time.time())))
+        xattr.setxattr(path, XATTR_USE_COUNT, str(count + 1))
+    except IOError, err:
+        display.display_debug1(
+            'Could not record use of %s: %s', path, err)
+
+
+def pinned_items(installinfo=None):
+    '''Returns the set of names of items in the Cache directory that must
+    not be evicted: those InstallInfo.plist needs, and those used during
+    this run. installinfo defaults to the contents of InstallInfo.plist.'''
+    if installinfo is None:
+        installinfopath = os.path.join(
+            prefs.pref('ManagedInstallDir'), 'InstallInfo.plist')
+        try:
+            installinfo = FoundationPlist.readPlist(installinfopath)
+        except FoundationPlist.FoundationPlistException:
+            installinfo = {}
+    with _USED_LOCK:
+        pinned = set(_USED_THIS_RUN)
+    for item in installinfo.get('managed_installs', []):
+        if item.get('installer_item'):
+            pinned.add(item['installer_item'])
+    for item in installinfo.get('removals', []):
+        if item.get('uninstaller_item'):
+            pinned.add(item['uninstaller_item'])
+    # keep partial downloads of pinned items too
+    pinned.update([name + '.download' for name in pinned])
+    return pinned
+
+
+def _item_info(name):
+    '''Returns a dict describing the cached item name, or None if it can't
+    be read'''
+    path = os.path.join(cache_dir(), name)
+    try:
+        info = os.stat(path)
+        last_used = fetch.getxattr(path, XATTR_LAST_USED)
+        use_count = fetch.getxattr(path, XATTR_USE_COUNT)
+    except (IOError, OSError):
+        return None
+    try:
+        last_used = int(last_used)
+    except (TypeError, ValueError):
+        # never recorded; the inode change time is about when it was
+        # downloaded (the modification time is the server's)
+        last_used = int(info.st_ctime)
+    try:
+        use_count = int(use_count)
+    except (TypeError, ValueError):
+        use_count = 0
+    return {'name': name,
+            'path': path,
+            'size': info.st_size,
+            'inode': (info.st_dev, info.st_ino),
+            'last_used': last_used,
+            'use_count': use_count}
+
+
+def _eviction_key(policy):
+    '''Returns a function giving the sort key for evicting items by policy;
+    items that sort first are evicted first'''
+    if policy == 'lfu':
+        return lambda item: (item['use_count'], item['last_used'],
+                             -item['size'])
+    return lambda item: (item['last_used'], -item['size'])
+
+
+def cache_size(items):
+    '''Returns the number of bytes used by items, counting files that share
+    their data once'''
+    sizes = {}
+    for item in items:
+        sizes[item['inode']] = item['size']
+    return sum(sizes.values())
+
+
+def evict(bytes_to_free, installinfo=None, reason='size limit',
+          all_or_nothing=False):
+    '''Evicts unpinned items from the Cache directory, in the order set by
+    the CacheEvictionPolicy preference, until bytes_to_free bytes have been
+    freed. If all_or_nothing is True, nothing is evicted unless enough space
+    can be freed. Returns the number of bytes freed.'''
+    if bytes_to_free <= 0:
+        return 0
+    pinned = pinned_items(installinfo)
+    candidates = []
+    for name in _cached_names():
+        if name in pinned:
+            continue
+        item = _item_info(name)
+        if item:
+            item['reclaimable'] = contentcache.reclaimable_size(item['path'])
+            candidates.append(item)
+    if all_or_nothing:
+        if sum(item['reclaimable'] for item in candidates) < bytes_to_free:
+            display.display_debug1(
+                'Can\'t free %s bytes from the cache; not evicting anything.',
+                bytes_to_free)
+            return 0
+
+    policy = str(prefs.pref('CacheEvictionPolicy') or 'lru').lower()
+    candidates.sort(key=_eviction_key(policy))
+    freed = 0
+    for item in candidates:
+        if freed >= bytes_to_free:
+            break
+        try:
+            # check again: evicting an earlier item may have left this one
+            # as the only user of its data
+            reclaimable = contentcache.reclaimable_size(item['path'])
+            contentcache.remove_item(item['path'])
+        except OSError, err:
+            display.display_error(
+                'Could not evict %s from the cache: %s', item['name'], err)
+            continue
+        freed += reclaimable
+        display.display_detail(
+            'Evicted %s (%s bytes) from the cache: %s',
+            item['name'], item['size'], reason)
+        _report_eviction(item, reason)
+    return freed
+
+
+def _report_eviction(item, reason):
+    '''Adds an eviction to the report'''
+    if not 'CacheEvictions' in reports.report:
+        reports.report['CacheEvictions'] = []
+    reports.report['CacheEvictions'].append(
+        {'name': item['name'],
+         'size': item['size'],
+         'last_used': reports.format_time(item['last_used']),
+         'use_count': item['use_count'],
+         'policy': str(prefs.pref('CacheEvictionPolicy') or 'lru').lower(),
+         'reason': reason})
+
+
+def enforce_size_limit(installinfo=None):
+    '''Evicts items until the Cache directory fits in CacheSizeLimitMB.
+    A limit of 0 (the default) means there is no limit.'''
+    try:
+        limit = int(prefs.pref('CacheSizeLimitMB') or 0) * 1024 * 1024
+    except (TypeError, ValueError):
+        display.display_warning('Invalid CacheSizeLimitMB preference.')
+        return 0
+    if limit <= 0:
+        return 0
+    items = [_item_info(name) for name in _cached_names()]
+    used = cache_size([item for item in items if item])
+    display.display_debug1(
+        'Cache uses %s bytes; limit is %s bytes.', used, limit)
+    return evict(used - limit, installinfo=installinfo)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
@@ -21,12 +21,23 @@ Created by Greg Neagle on 2017-01-01.
 Functions for working with Munki catalogs
 """
 
+import calendar
+import datetime
 import os
 
+# PyLint cannot properly find names inside Cocoa libraries, so issues bogus
+# No name 'Foo' in module 'Bar' warnings. Disable them.
+# pylint: disable=E0611
+from Foundation import NSArray, NSDate, NSDictionary
+# pylint: enable=E0611
+
 from . import download
 
+from .. import catalogdb
 from .. import display
+from .. import fetch
 from .. import info
+from .. import osutils
 from .. import pkgutils
 from .. import prefs
 from .. import utils
@@ -36,70 +47,8 @@ from .. import FoundationPlist
 def make_catalog_db(catalogitems):
     """Takes an array of catalog items and builds some indexes so we can
     get our common data faster. Returns a dict we can use like a database"""
-    name_table = {}
-    pkgid_table = {}
-
-    itemindex = -1
-    for item in catalogitems:
-        itemindex = itemindex + 1
-        name = item.get('name', 'NO NAME')
-        vers = item.get('version', 'NO VERSION')
-
-        if name == 'NO NAME' or vers == 'NO VERSION':
-            display.display_warning('Bad pkginfo: %s', item)
-
-        # normalize the version number
-        vers = pkgutils.trim_version_string(vers)
-
-        # build indexes for items by name and version
-        if not name in name_table:
-            name_table[name] = {}
-        if not vers in name_table[name]:
-            name_table[name][vers] = []
-        name_table[name][vers].append(itemindex)
-
-        # build table of receipts
-        for receipt in item.get('receipts', []):
-            if 'packageid' in receipt and 'version' in receipt:
-                pkg_id = receipt['packageid']
-                version = receipt['version']
-                if not pkg_id in pkgid_table:
-                    pkgid_table[pkg_id] = {}
-                if not version in pkgid_table[pkg_id]:
-                    pkgid_table[pkg_id][version] = []
-                pkgid_table[pkg_id][version].append(itemindex)
-
-    # build table of update items with a list comprehension --
-    # filter all items from the catalogitems that have a non-empty
-    # 'update_for' list
-    updaters = [item for item in catalogitems if item.get('update_for')]
-
-    # now fix possible admin errors where 'update_for' is a string instead
-    # of a list of strings
-    for update in updaters:
-        if isinstance(update['update_for'], basestring):
-            # convert to list of strings
-            update['update_for'] = [update['update_for']]
-
-    # build table of autoremove items with a list comprehension --
-    # filter all items from the catalogitems that have a non-empty
-    # 'autoremove' list
-    # autoremove items are automatically removed if they are not in the
-    # managed_install list (either directly or indirectly via included
-    # manifests)
-    autoremoveitems = [item.get('name') for item in catalogitems
-                       if item.get('autoremove')]
-    # convert to set and back to list to get list of unique names
-    autoremoveitems = list(set(autoremoveitems))
-
-    pkgdb = {}
-    pkgdb['named'] = name_table
-    pkgdb['receipts'] = pkgid_table
-    pkgdb['updaters'] = updaters
-    pkgdb['autoremoveitems'] = autoremoveitems
-    pkgdb['items'] = catalogitems
-
-    return pkgdb
+    return catalogdb.make_catalog_db(
+        catalogitems, warning_fn=display.display_warning)
 
 
 def add_package_ids(catalogitems, itemname_to_pkgid, pkgid_to_itemname):
@@ -158,24 +107,21 @@ def get_all_items_with_name(name, cataloglist):
       list of pkginfo items; sorted with newest version first. No precedence
       is given to catalog order.
     """
-    def compare_item_versions(item_a, item_b):
-        """Internal comparison function for use with sorting"""
-        return cmp(pkgutils.MunkiLooseVersion(item_b['version']),
-                   pkgutils.MunkiLooseVersion(item_a['version']))
-
     itemlist = []
     # we'll throw away any included version info
     name = split_name_and_version(name)[0]
 
     display.display_debug1('Looking for all items matching: %s...', name)
+    catalogs_with_name = 0
     for catalogname in cataloglist:
         if not catalogname in _CATALOG.keys():
             # in case catalogname refers to a non-existent catalog...
             continue
         # is name in the catalog name table?
         if name in _CATALOG[catalogname]['named']:
-            versionsmatchingname = _CATALOG[catalogname]['named'][name]
-            for vers in versionsmatchingname:
+            catalogs_with_name += 1
+            # versions are already sorted newest first
+            for vers in _CATALOG[catalogname]['versions'][name]:
                 if vers == 'latest':
                     continue
                 indexlist = _CATALOG[catalogname]['named'][name][vers]
@@ -187,9 +133,12 @@ def get_all_items_with_name(name, cataloglist):
                             name, thisitem['version'], catalogname)
                         itemlist.append(thisitem)
 
-    if itemlist:
-        # sort so latest version is first
-        itemlist.sort(compare_item_versions)
+    if catalogs_with_name > 1:
+        # merge the (already sorted) items from each catalog so latest
+        # version is first; this is a stable sort, so catalog order is kept
+        # for equal versions
+        itemlist.sort(key=lambda item: pkgutils.version_key(item['version']),
+                      reverse=True)
     return itemlist
 
 
@@ -205,11 +154,10 @@ def get_auto_removal_items(installinfo, cataloglist):
         if catalogname in _CATALOG.keys():
             autoremovalnames += _CATALOG[catalogname]['autoremoveitems']
 
-    processed_installs_names = [split_name_and_version(item)[0]
-                                for item in installinfo['processed_installs']]
-    autoremovalnames = [item for item in autoremovalnames
-                        if item not in processed_installs_names
-                        and item not in installinfo['processed_uninstalls']]
+    autoremovalnames = [
+        item for item in autoremovalnames
+        if not installinfo['processed_installs'].contains_name(item)
+        and item not in installinfo['processed_uninstalls']]
     return autoremovalnames
 
 
@@ -225,20 +173,15 @@ def look_for_updates(itemname, cataloglist):
     """
 
     display.display_debug1('Looking for updates for: %s', itemname)
-    # get a list of catalog items that are updates for other items
+    # get a list of catalog items that are updates for this item
     update_list = []
     for catalogname in cataloglist:
         if catalogname not in _CATALOG:
             # in case the list refers to a non-existent catalog
             continue
 
-        updaters = _CATALOG[catalogname]['updaters']
-        # list comprehension coming up...
-        update_items = [catalogitem['name']
-                        for catalogitem in updaters
-                        if itemname in catalogitem.get('update_for', [])]
-        if update_items:
-            update_list.extend(update_items)
+        update_list.extend(
+            _CATALOG[catalogname]['updates'].get(itemname, []))
 
     # make sure the list has only unique items:
     update_list = list(set(update_list))
@@ -425,11 +368,6 @@ def get_item_detail(name, cataloglist, vers='',
     If no version is given at all, the latest version is assumed.
     Returns a pkginfo item, or None.
     """
-    def compare_versions(item_a, item_b):
-        """Internal comparison function for use in sorting"""
-        return cmp(pkgutils.MunkiLooseVersion(item_b),
-                   pkgutils.MunkiLooseVersion(item_a))
-
     rejected_items = []
     machine = info.getMachineFacts()
     # condition check functions
@@ -572,10 +510,8 @@ def get_item_detail(name, cataloglist, vers='',
             itemsmatchingname = _CATALOG[catalogname]['named'][name]
             indexlist = []
             if vers == 'latest':
-                # order all our items, highest version first
-                versionlist = itemsmatchingname.keys()
-                versionlist.sort(compare_versions)
-                for versionkey in versionlist:
+                # all our items, highest version first
+                for versionkey in _CATALOG[catalogname]['versions'][name]:
                     indexlist.extend(itemsmatchingname[versionkey])
             elif vers in itemsmatchingname.keys():
                 # get the specific requested version
@@ -610,6 +546,150 @@ def get_item_detail(name, cataloglist, vers='',
     return None
 
 
+def _nsdate(a_datetime):
+    '''Converts a (UTC) datetime.datetime from a catalog db to the NSDate
+    we'd get from reading the catalog itself'''
+    return NSDate.dateWithTimeIntervalSince1970_(
+        calendar.timegm(a_datetime.utctimetuple()) +
+        a_datetime.microsecond / 1000000.0)
+
+
+def _python_value(value):
+    '''Converts a value read by FoundationPlist to the plain Python types
+    that can be stored in a catalog db'''
+    if isinstance(value, NSDate):
+        return datetime.datetime.utcfromtimestamp(
+            value.timeIntervalSince1970())
+    if isinstance(value, (dict, NSDictionary)):
+        return dict((unicode(key), _python_value(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, NSArray)):
+        return [_python_value(item) for item in value]
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    # anything else (NSData) can't be stored in a catalog db;
+    # catalogdb.dumps_catalog_db() will tell us so
+    return value
+
+
+def _catalog_hash(catalogpath):
+    '''Returns the sha256 of a downloaded catalog, using the hash cached in
+    the file's xattr if we have one. A freshly downloaded catalog replaces
+    the old file, so a cached hash is never out of date.'''
+    catalog_hash = fetch.getxattr(catalogpath, fetch.XATTR_SHA)
+    if not catalog_hash:
+        catalog_hash = fetch.writeCachedChecksum(catalogpath)
+    return catalog_hash
+
+
+def _catalog_db_cache_dir():
+    '''Returns the path of our local catalog db cache'''
+    return os.path.join(prefs.pref('ManagedInstallDir'), 'catalog_dbs')
+
+
+def _catalog_db_cache_path(catalogname):
+    '''Returns the path of our locally cached catalog db for catalogname'''
+    return os.path.join(_catalog_db_cache_dir(),
+                        catalogdb.catalog_db_name(catalogname))
+
+
+def _read_catalog_db(dbpath, catalog_hash):
+    '''Returns a tuple of the raw data and the catalog db stored in the file
+    at dbpath if it was built from the catalog with the given hash. Raises
+    IOError, OSError or catalogdb.CatalogDBError otherwise.'''
+    fileref = open(dbpath, 'rb')
+    try:
+        data = fileref.read()
+    finally:
+        fileref.close()
+    return data, catalogdb.loads_catalog_db(data, catalog_hash, date_fn=_nsdate)
+
+
+def _cache_catalog_db(catalogname, data):
+    '''Saves catalog db data to our local catalog db cache'''
+    cachedir = _catalog_db_cache_dir()
+    cachepath = _catalog_db_cache_path(catalogname)
+    temppath = cachepath + '.tmp'
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir, 0755)
+        fileref = open(temppath, 'wb')
+        try:
+            fileref.write(data)
+        finally:
+            fileref.close()
+        os.rename(temppath, cachepath)
+    except (IOError, OSError), err:
+        display.display_debug1(
+            'Could not cache catalog db for %s: %s', catalogname, err)
+
+
+def load_cached_catalog(catalogname, catalog_hash):
+    '''Returns our locally cached catalog db for the catalog with the given
+    hash, or None if we don't have one for this exact catalog.'''
+    cachepath = _catalog_db_cache_path(catalogname)
+    if not os.path.exists(cachepath):
+        return None
+    try:
+        dummy_data, pkgdb = _read_catalog_db(cachepath, catalog_hash)
+        display.display_debug1('Using cached catalog db for %s', catalogname)
+        return pkgdb
+    except (IOError, OSError, catalogdb.CatalogDBError), err:
+        display.display_debug1(
+            'Not using cached catalog db for %s: %s', catalogname, err)
+        return None
+
+
+def load_precompiled_catalog(catalogname, catalog_hash):
+    '''Downloads and loads the precompiled catalog db for a catalog, and
+    caches it locally. Returns None if there isn't one for this exact
+    catalog.'''
+    dbpath = download.download_catalog_db(catalogname)
+    if not dbpath:
+        return None
+    try:
+        data, pkgdb = _read_catalog_db(dbpath, catalog_hash)
+    except (IOError, OSError, catalogdb.CatalogDBError), err:
+        display.display_debug1(
+            'Not using precompiled catalog for %s: %s', catalogname, err)
+        return None
+    _cache_catalog_db(catalogname, data)
+    return pkgdb
+
+
+def load_catalog(catalogname, catalogpath, catalog_hash):
+    '''Reads a downloaded catalog, builds its catalog db and caches it
+    locally. Returns None if the catalog is invalid.'''
+    try:
+        catalogdata = FoundationPlist.readPlist(catalogpath)
+    except FoundationPlist.NSPropertyListSerializationException:
+        display.display_error(
+            'Retrieved catalog %s is invalid.', catalogname)
+        try:
+            os.unlink(catalogpath)
+        except (OSError, IOError):
+            pass
+        return None
+    pkgdb = make_catalog_db(catalogdata)
+    if not catalog_hash:
+        return pkgdb
+    try:
+        _cache_catalog_db(
+            catalogname,
+            catalogdb.dumps_catalog_db(
+                _python_value(pkgdb['items']), catalog_hash))
+    except catalogdb.CatalogDBError, err:
+        display.display_debug1(
+            'Could not cache catalog db for %s: %s', catalogname, err)
+    return pkgdb
+
+
 # global to hold our catalog DBs
 _CATALOG = {}
 def get_catalogs(cataloglist):
@@ -620,27 +700,46 @@ def get_catalogs(cataloglist):
     for catalogname in cataloglist:
         if not catalogname in _CATALOG:
             catalogpath = download.download_catalog(catalogname)
-            if catalogpath:
-                try:
-                    catalogdata = FoundationPlist.readPlist(catalogpath)
-                except FoundationPlist.NSPropertyListSerializationException:
-                    display.display_error(
-                        'Retrieved catalog %s is invalid.', catalogname)
-                    try:
-                        os.unlink(catalogpath)
-                    except (OSError, IOError):
-                        pass
-                else:
-                    _CATALOG[catalogname] = make_catalog_db(catalogdata)
+            if not catalogpath:
+                continue
+            try:
+                catalog_hash = _catalog_hash(catalogpath)
+            except (IOError, OSError), err:
+                display.display_debug1(
+                    'Could not get hash of catalog %s: %s', catalogname, err)
+                catalog_hash = None
+            pkgdb = None
+            if catalog_hash:
+                pkgdb = load_cached_catalog(catalogname, catalog_hash)
+                if pkgdb is None and prefs.pref('UsePrecompiledCatalogs'):
+                    pkgdb = load_precompiled_catalog(
+                        catalogname, catalog_hash)
+            if pkgdb is None:
+                pkgdb = load_catalog(catalogname, catalogpath, catalog_hash)
+            if pkgdb is not None:
+                _CATALOG[catalogname] = pkgdb
 
 
 def clean_up():
     """Removes any catalog files that are no longer in use by this client"""
     catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'),
                                'catalogs')
+    in_use = set(_CATALOG.keys())
+    in_use.update(catalogdb.catalog_db_name(catalogname)
+                  for catalogname in _CATALOG)
     for item in os.listdir(catalog_dir):
-        if item not in _CATALOG:
+        if item not in in_use:
             os.unlink(os.path.join(catalog_dir, item))
+    # and any cached catalog dbs for them
+    cache_dir = _catalog_db_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for item in osutils.listdir(cache_dir):
+        if item not in in_use:
+            try:
+                os.unlink(os.path.join(cache_dir, item))
+            except (OSError, IOError):
+                pass
 
 
 def catalogs():
@@ -0,0 +1,183 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+updatecheck.contentcache
+
+Content-addressed store for downloaded installer items.
+
+The Cache directory holds installer items under the basename of their
+installer_item_location, which is what the installer code expects. Each
+verified item is also hard-linked into the ContentCache directory under its
+sha256, so an item with the same installer_item_hash but a different name
+(or a renamed item) can be linked into the Cache directory instead of being
+downloaded again. Hard links share their data, so this takes no extra space.
+
+An entry in ContentCache whose only link is itself is no longer used by any
+item in the Cache directory and is removed by prune().
+"""
+
+import os
+
+from .. import display
+from .. import fetch
+from .. import osutils
+from .. import prefs
+
+
+def store_dir():
+    '''Returns the path of the content-addressed store'''
+    return os.path.join(prefs.pref('ManagedInstallDir'), 'ContentCache')
+
+
+def _is_sha256(item_hash):
+    '''Returns True if item_hash looks like a sha256 hex digest'''
+    if not isinstance(item_hash, basestring) or len(item_hash) != 64:
+        return False
+    try:
+        int(item_hash, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def entry_path(item_hash):
+    '''Returns the path of the store entry for item_hash, or None if
+    item_hash isn't a sha256'''
+    if not _is_sha256(item_hash):
+        return None
+    return os.path.join(store_dir(), item_hash.lower())
+
+
+def link_cached_item(item_hash, destinationpath):
+    '''If the store has an item with item_hash, hard-links it to
+    destinationpath and returns True. Returns False if it doesn't, or if
+    destinationpath already exists.'''
+    entry = entry_path(item_hash)
+    if not entry or not os.path.isfile(entry):
+        return False
+    if os.path.lexists(destinationpath):
+        return False
+    try:
+        os.link(entry, destinationpath)
+    except OSError, err:
+        display.display_debug1(
+            'Could not link %s to %s: %s', entry, destinationpath, err)
+        return False
+    display.display_detail(
+        'Using cached copy of %s with the same sha256',
+        os.path.basename(destinationpath))
+    return True
+
+
+def add_item(item_hash, path):
+    '''Adds the file at path to the store under item_hash. Only files whose
+    cached sha256 (see fetch.writeCachedChecksum) is item_hash are added,
+    so nothing unverified ends up in the store.'''
+    entry = entry_path(item_hash)
+    if not entry or not os.path.isfile(path):
+        return
+    if fetch.getxattr(path, fetch.XATTR_SHA) != item_hash:
+        return
+    try:
+        if os.path.exists(entry) and os.path.samefile(entry, path):
+            return
+        if not os.path.isdir(store_dir()):
+            os.makedirs(store_dir())
+        # link under a temporary name, then rename, so an existing entry is
+        # replaced in one step
+        temp_entry = entry + '.tmp'
+        if os.path.lexists(temp_entry):
+            os.unlink(temp_entry)
+        os.link(path, temp_entry)
+        os.rename(temp_entry, entry)
+    except OSError, err:
+        display.display_debug1(
+            'Could not add %s to the content cache: %s', path, err)
+
+
+def _is_store_entry_for(path, info):
+    '''Returns True if the store has an entry for the file at path, whose
+    os.stat() result is info'''
+    entry = entry_path(fetch.getxattr(path, fetch.XATTR_SHA))
+    if not entry:
+        return False
+    try:
+        entry_info = os.stat(entry)
+    except OSError:
+        return False
+    return (entry_info.st_dev, entry_info.st_ino) == (info.st_dev,
+                                                      info.st_ino)
+
+
+def reclaimable_size(path):
+    '''Returns how many bytes removing path with remove_item() would free:
+    its size, unless another item in the Cache directory shares its data'''
+    try:
+        info = os.stat(path)
+    except OSError:
+        return 0
+    other_links = info.st_nlink - 1
+    if _is_store_entry_for(path, info):
+        other_links -= 1
+    if other_links > 0:
+        return 0
+    return info.st_size
+
+
+def remove_item(path):
+    '''Removes path from the Cache directory, and its store entry if nothing
+    else is using it'''
+    entry = None
+    try:
+        info = os.stat(path)
+        if _is_store_entry_for(path, info):
+            entry = entry_path(fetch.getxattr(path, fetch.XATTR_SHA))
+    except OSError:
+        pass
+    os.unlink(path)
+    if entry:
+        _remove_if_unused(entry)
+
+
+def _remove_if_unused(entry):
+    '''Removes a store entry if it's the file's only remaining link'''
+    try:
+        if os.stat(entry).st_nlink == 1:
+            os.unlink(entry)
+    except OSError, err:
+        display.display_debug1(
+            'Could not remove %s from the content cache: %s', entry, err)
+
+
+def prune():
+    '''Removes store entries that no item in the Cache directory uses'''
+    directory = store_dir()
+    if not os.path.isdir(directory):
+        return
+    for name in osutils.listdir(directory):
+        entry = os.path.join(directory, name)
+        if name.endswith('.tmp'):
+            # left over from an interrupted add_item()
+            try:
+                os.unlink(entry)
+            except OSError:
+                pass
+        else:
+            _remove_if_unused(entry)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
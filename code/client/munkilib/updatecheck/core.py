@@ -26,9 +26,13 @@ import os
 # our libs
 from . import analyze
 from . import autoconfig
+from . import cachemanager
 from . import catalogs
+from . import contentcache
 from . import download
+from . import indexedlists
 from . import licensing
+from . import manifestresolver
 from . import manifestutils
 
 from .. import display
@@ -96,21 +100,27 @@ def check(client_id='', localmanifestpath=None):
             caffeinator = powermgr.Caffeinator(
                 'Munki is checking for new software')
 
-        # initialize our installinfo record
-        installinfo['processed_installs'] = []
-        installinfo['processed_uninstalls'] = []
-        installinfo['managed_updates'] = []
-        installinfo['optional_installs'] = []
-        installinfo['featured_items'] = []
-        installinfo['managed_installs'] = []
-        installinfo['removals'] = []
+        # initialize our installinfo record; its lists are indexed by name
+        # while we analyze manifests
+        installinfo = indexedlists.new_installinfo()
+
+        # download installer items in the background if configured to
+        analyze.start_download_queue()
 
         # record info object for conditional item comparisons
         reports.report['Conditions'] = info.predicate_info_object()
 
+        # get all the included manifests up front, several at a time
+        manifestutils.prefetch_manifests(mainmanifestpath)
+
+        # walk the manifests and their conditional_items once for all keys
+        resolved = manifestresolver.resolve_manifest(mainmanifestpath)
+        if processes.stop_requested():
+            return 0
+
         display.display_detail('**Checking for installs**')
-        analyze.process_manifest_for_key(
-            mainmanifestpath, 'managed_installs', installinfo)
+        analyze.process_resolved_items(
+            resolved, 'managed_installs', installinfo)
         if processes.stop_requested():
             return 0
 
@@ -121,8 +131,8 @@ def check(client_id='', localmanifestpath=None):
 
         # now generate a list of items to be uninstalled
         display.display_detail('**Checking for removals**')
-        analyze.process_manifest_for_key(
-            mainmanifestpath, 'managed_uninstalls', installinfo)
+        analyze.process_resolved_items(
+            resolved, 'managed_uninstalls', installinfo)
         if processes.stop_requested():
             return 0
 
@@ -141,8 +151,8 @@ def check(client_id='', localmanifestpath=None):
 
         # look for additional updates
         display.display_detail('**Checking for managed updates**')
-        analyze.process_manifest_for_key(
-            mainmanifestpath, 'managed_updates', installinfo)
+        analyze.process_resolved_items(
+            resolved, 'managed_updates', installinfo)
         if processes.stop_requested():
             return 0
 
@@ -202,14 +212,14 @@ def check(client_id='', localmanifestpath=None):
                 )
 
         # build list of optional installs
-        analyze.process_manifest_for_key(
-            mainmanifestpath, 'optional_installs', installinfo)
+        analyze.process_resolved_items(
+            resolved, 'optional_installs', installinfo)
         if processes.stop_requested():
             return 0
 
         # build list of featured installs
-        analyze.process_manifest_for_key(
-            mainmanifestpath, 'featured_items', installinfo)
+        analyze.process_resolved_items(
+            resolved, 'featured_items', installinfo)
         if processes.stop_requested():
             return 0
         in_featured_items = set(installinfo.get('featured_items', []))
@@ -304,6 +314,9 @@ def check(client_id='', localmanifestpath=None):
                           item, installinfo['removals'])):
                     item['will_be_removed'] = True
 
+        # wait for any background downloads and record how they went
+        analyze.finish_download_queue(installinfo)
+
         # filter managed_installs to get items already installed
         installed_items = [item.get('name', '')
                            for item in installinfo['managed_installs']
@@ -352,6 +365,10 @@ def check(client_id='', localmanifestpath=None):
                    startosinstall_items[0].get('version_to_install'))
             )
 
+        # done analyzing; from here on installinfo is what gets reported and
+        # written to InstallInfo.plist, so use plain lists
+        indexedlists.to_plain_lists(installinfo)
+
         # record detail before we throw it away...
         reports.report['ManagedInstalls'] = installinfo['managed_installs']
         reports.report['InstalledItems'] = installed_items
@@ -435,6 +452,10 @@ def check(client_id='', localmanifestpath=None):
             elif item not in cache_list:
                 display.display_detail('Removing %s from cache', item)
                 os.unlink(os.path.join(cachedir, item))
+        # and any content no longer used by an item in the cache
+        contentcache.prune()
+        # then keep the cache within its size limit
+        cachemanager.enforce_size_limit(installinfo)
 
         # write out install list so our installer
         # can use it to install things in the right order
@@ -474,6 +495,9 @@ def check(client_id='', localmanifestpath=None):
                 installinfo.get('managed_installs', [])
             reports.report['ItemsToRemove'] = \
                 installinfo.get('removals', [])
+    finally:
+        # if we stopped early, don't leave downloads running
+        analyze.cancel_download_queue()
 
     reports.savereport()
     munkilog.log('###    End managed software check    ###')
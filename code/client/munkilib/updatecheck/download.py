@@ -22,10 +22,20 @@ Created by Greg Neagle on 2016-12-31.
 Functions for downloading resources from the Munki server
 """
 
+import datetime
 import os
+import threading
 import urllib2
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
+import objc
+
+from . import cachemanager
+from . import contentcache
+
+from .. import catalogdb
 from .. import display
 from .. import fetch
 from .. import info
@@ -59,9 +69,11 @@ def get_download_cache_path(url):
 
 
 def enough_disk_space(item_pl, installlist=None,
-                      uninstalling=False, warn=True, precaching=False):
+                      uninstalling=False, warn=True, precaching=False,
+                      reserved_kbytes=0):
     """Determine if there is enough disk space to download the installer
-    item."""
+    item. reserved_kbytes is space already promised to downloads that are
+    still in progress."""
     # fudgefactor is set to 100MB
     fudgefactor = 102400
     alreadydownloadedsize = 0
@@ -79,7 +91,7 @@ def enough_disk_space(item_pl, installlist=None,
                        installedsize + fudgefactor)
 
     # info.available_disk_space() returns KB
-    availablediskspace = info.available_disk_space()
+    availablediskspace = info.available_disk_space() - reserved_kbytes
     if installlist:
         for item in installlist:
             # subtract space needed for other items that are to be installed
@@ -90,7 +102,7 @@ def enough_disk_space(item_pl, installlist=None,
     if diskspaceneeded > availablediskspace and not precaching:
         # try to clear space by deleting some precached items
         uncache(diskspaceneeded - availablediskspace)
-        availablediskspace = info.available_disk_space()
+        availablediskspace = info.available_disk_space() - reserved_kbytes
 
     if availablediskspace >= diskspaceneeded:
         return True
@@ -112,9 +124,12 @@ def enough_disk_space(item_pl, installlist=None,
 
 
 def download_installeritem(item_pl,
-                           installinfo, uninstalling=False, precaching=False):
+                           installinfo, uninstalling=False, precaching=False,
+                           check_disk_space=True):
     """Downloads an (un)installer item.
     Returns True if the item was downloaded, False if it was already cached.
+    Set check_disk_space to False if the caller has already checked there is
+    enough free space.
     Raises an error if there are issues..."""
 
     download_item_key = 'installer_item_location'
@@ -149,10 +164,17 @@ def download_installeritem(item_pl,
 
     destinationpath = get_download_cache_path(location)
     display.display_debug2('Downloading to: %s', destinationpath)
+    # don't let eviction remove the item (or its partial download) while
+    # we are getting it
+    cachemanager.pin(destinationpath)
+
+    # an item with the same content may already have been downloaded
+    expected_hash = item_pl.get(item_hash_key, None)
+    contentcache.link_cached_item(expected_hash, destinationpath)
 
     display.display_detail('Downloading %s from %s', pkgname, location)
 
-    if not os.path.exists(destinationpath):
+    if check_disk_space and not os.path.exists(destinationpath):
         # check to see if there is enough free space to download and install
         if not enough_disk_space(item_pl,
                                  installinfo['managed_installs'],
@@ -165,12 +187,113 @@ def download_installeritem(item_pl,
                 'Downloading %s from %s', pkgname, location)
 
     dl_message = 'Downloading %s...' % pkgname
-    expected_hash = item_pl.get(item_hash_key, None)
-    return fetch.munki_resource(pkgurl, destinationpath,
-                                resume=True,
-                                message=dl_message,
-                                expected_hash=expected_hash,
-                                verify=True)
+    downloaded = fetch.munki_resource(pkgurl, destinationpath,
+                                      resume=True,
+                                      message=dl_message,
+                                      expected_hash=expected_hash,
+                                      verify=True)
+    contentcache.add_item(expected_hash, destinationpath)
+    cachemanager.record_use(destinationpath)
+    return downloaded
+
+
+def _timed_download(item_pl, installinfo):
+    """Downloads the installer item for item_pl, for DownloadQueue's worker
+    threads. Returns a tuple of (downloaded, seconds), where downloaded is
+    the result of download_installeritem() and seconds is how long it
+    took."""
+    with objc.autorelease_pool():
+        start = datetime.datetime.now()
+        downloaded = download_installeritem(
+            item_pl, installinfo, check_disk_space=False)
+        end = datetime.datetime.now()
+    return downloaded, (end - start).seconds
+
+
+class DownloadQueue(object):
+    """Downloads installer items on a pool of worker threads, so checking for
+    updates can carry on while they download. Use one queue per update
+    check: add() items as they are found, then join() before writing
+    InstallInfo.plist."""
+
+    def __init__(self, max_concurrent):
+        self._pool = ThreadPool(max_concurrent)
+        self._pending = []
+        self._reserved_kbytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, item_pl, installinfo, context=None):
+        """Queues the installer item for item_pl for download. The free space
+        check happens now, counting the space needed by the items already
+        queued; raises fetch.DownloadError if there isn't enough. context is
+        handed back with the result by join()."""
+        location = item_pl.get('installer_item_location')
+        if not location:
+            raise fetch.DownloadError(
+                "No installer_item_location in item info.")
+        destinationpath = get_download_cache_path(location)
+        # pin the item now: eviction for later items runs on this thread
+        # while the workers download
+        cachemanager.pin(destinationpath)
+        contentcache.link_cached_item(
+            item_pl.get('installer_item_hash'), destinationpath)
+        kbytes = 0
+        if not os.path.exists(destinationpath):
+            with self._lock:
+                reserved_kbytes = self._reserved_kbytes
+            if not enough_disk_space(item_pl,
+                                     installinfo['managed_installs'],
+                                     reserved_kbytes=reserved_kbytes):
+                raise fetch.DownloadError(
+                    'Insufficient disk space to download and install %s'
+                    % get_url_basename(location))
+            kbytes = int(item_pl.get('installer_item_size', 0))
+            with self._lock:
+                self._reserved_kbytes += kbytes
+        display.display_detail(
+            'Queueing %s for download', get_url_basename(location))
+        self._pending.append(
+            (context,
+             self._pool.apply_async(
+                 self._download, (item_pl, installinfo, kbytes))))
+
+    def _download(self, item_pl, installinfo, kbytes):
+        """Runs on a worker thread: downloads the item, then releases the
+        kbytes reserved for it. Once the download is finished (or has
+        failed), available disk space already reflects it."""
+        try:
+            return _timed_download(item_pl, installinfo)
+        finally:
+            with self._lock:
+                self._reserved_kbytes -= kbytes
+
+    def join(self):
+        """Waits for all queued downloads to finish. Returns a list of
+        (context, downloaded, seconds, error) tuples in the order the items
+        were queued. error is the fetch.Error the download failed with, or
+        None; downloaded and seconds are as for _timed_download()."""
+        results = []
+        try:
+            for context, pending in self._pending:
+                try:
+                    downloaded, seconds = pending.get()
+                    results.append((context, downloaded, seconds, None))
+                except fetch.Error, err:
+                    results.append((context, False, 0, err))
+        finally:
+            # if something unexpected was raised, this also drops the
+            # downloads that haven't started
+            self.cancel()
+        return results
+
+    def cancel(self):
+        """Drops the downloads that haven't started yet, waits for those in
+        progress to finish, and empties the queue"""
+        self._pool.terminate()
+        self._pool.join()
+        self._pending = []
+        with self._lock:
+            self._reserved_kbytes = 0
 
 
 def clean_up_icons_dir(icons_to_keep):
@@ -354,6 +477,36 @@ def download_catalog(catalogname):
         return None
 
 
+def download_catalog_db(catalogname):
+    '''Attempt to download the precompiled catalog db for a catalog from the
+    Munki server. Returns the path to the downloaded file, or None if there
+    isn't one.'''
+    catalogbaseurl = (prefs.pref('CatalogURL') or
+                      prefs.pref('SoftwareRepoURL') + '/catalogs/')
+    if not catalogbaseurl.endswith('?') and not catalogbaseurl.endswith('/'):
+        catalogbaseurl = catalogbaseurl + '/'
+    catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'), 'catalogs')
+    dbname = catalogdb.catalog_db_name(catalogname)
+    dburl = catalogbaseurl + urllib2.quote(dbname.encode('UTF-8'))
+    dbpath = os.path.join(catalog_dir, dbname)
+    message = 'Retrieving precompiled catalog "%s"...' % catalogname
+    try:
+        fetch.munki_resource(dburl, dbpath, message=message)
+        return dbpath
+    except fetch.Error, err:
+        # not an error; makecatalogs only writes these if asked to
+        display.display_debug1(
+            'Could not retrieve precompiled catalog %s from server: %s',
+            catalogname, err)
+        if os.path.exists(dbpath):
+            # don't keep using a copy the server no longer has
+            try:
+                os.unlink(dbpath)
+            except (OSError, IOError):
+                pass
+        return None
+
+
 ### precaching support ###
 
 def _installinfo():
@@ -392,64 +545,16 @@ def cache():
 
 
 def uncache(space_needed_in_kb):
-    '''Discard precached items to free up space for managed installs'''
-    install_info = _installinfo()
-    # make a list of names of precachable items
-    precachable_items = [
-        [os.path.basename(item['installer_item_location'])]
-        for item in _items_to_precache(install_info)
-        if item.get('installer_item_location')]
-    if not precachable_items:
-        return
-
-    cachedir = os.path.join(prefs.pref('ManagedInstallDir'), 'Cache')
-    # now filter our list to items actually downloaded
-    items_in_cache = osutils.listdir(cachedir)
-    precached_items = [item for item in precachable_items
-                       if item in items_in_cache]
-    if not precached_items:
-        return
-
-    precached_size = 0
-    for item in precached_items:
-        # item is [itemname]
-        item_path = os.path.join(cachedir, item[0])
-        try:
-            itemsize = int(os.path.getsize(item_path)/1024)
-        except OSError, err:
-            display.display_warning("Could not get size of %s: %s"
-                                    % (item_path, err))
-            itemsize = 0
-        precached_size += itemsize
-        item.append(itemsize)
-        # item is now [itemname, itemsize]
-
-    if precached_size < space_needed_in_kb:
-        # we can't clear enough space, so don't bother removing anything.
-        # otherwise we'll clear some space, but still can't download the large
-        # managed install, but then we'll have enough space to redownload the
-        # precachable items and so we will (and possibly do this over and
-        # over -- delete some, redownload, delete some, redownload...)
-        return
-
-    # sort reversed by size; smallest at end
-    precached_items.sort(key=lambda x: x[1], reverse=True)
-    deleted_kb = 0
-    while precached_items:
-        if deleted_kb >= space_needed_in_kb:
-            break
-        # remove and return last item in precached_items
-        # we delete the smallest item first, proceeeding until we've freed up
-        # enough space or deleted all the items
-        item = precached_items.pop()
-        item_path = os.path.join(cachedir, item[0])
-        item_size = item[1]
-        try:
-            os.remove(item_path)
-            deleted_kb += item_size
-        except OSError, err:
-            display.display_error(
-                "Could not remove precached item %s: %s" % (item_path, err))
+    '''Evict cached items to free up space for managed installs. Items
+    InstallInfo.plist needs, and those used during this run, are kept.'''
+    # if we can't clear enough space, don't bother removing anything.
+    # otherwise we'll clear some space, but still can't download the large
+    # managed install, but then we'll have enough space to redownload the
+    # precachable items and so we will (and possibly do this over and
+    # over -- delete some, redownload, delete some, redownload...)
+    cachemanager.evict(space_needed_in_kb * 1024,
+                       reason='space needed for a download',
+                       all_or_nothing=True)
 
 
 PRECACHING_AGENT_LABEL = "com.googlecode.munki.precache_agent"
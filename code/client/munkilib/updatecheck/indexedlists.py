@@ -0,0 +1,158 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+updatecheck.indexedlists
+
+Lists used for the installinfo record while checking for updates. They behave
+like the plain lists stored in InstallInfo.plist, but keep indexes so that
+checking whether an item has already been processed doesn't need to scan the
+whole list.
+
+Only append(), extend(), insert() and remove() keep the indexes up to date;
+sorting is fine, since it doesn't change what is in a list.
+"""
+
+from .catalogs import split_name_and_version
+
+
+# installinfo sections that are lists of item names
+NAME_SECTIONS = ['processed_installs', 'processed_uninstalls',
+                 'managed_updates', 'featured_items']
+# installinfo sections that are lists of item dicts
+ITEM_SECTIONS = ['optional_installs', 'managed_installs', 'removals']
+
+
+class NameList(list):
+    '''A list of item names (which may include a version, like
+    'Firefox-52.0') that keeps sets of its names for membership tests'''
+
+    def __init__(self, iterable=()):
+        list.__init__(self, iterable)
+        self._reindex()
+
+    def _reindex(self):
+        '''Rebuilds the sets from the list contents'''
+        self._names = set(self)
+        self._basenames = set(
+            split_name_and_version(name)[0] for name in self
+            if isinstance(name, basestring))
+
+    def _add(self, name):
+        '''Adds name to the sets'''
+        self._names.add(name)
+        if isinstance(name, basestring):
+            self._basenames.add(split_name_and_version(name)[0])
+
+    def __contains__(self, name):
+        try:
+            return name in self._names
+        except TypeError:
+            # unhashable values can't be in the list
+            return False
+
+    def contains_name(self, name):
+        '''Returns True if name, ignoring any version, is in the list'''
+        return name in self._basenames
+
+    def append(self, name):
+        list.append(self, name)
+        self._add(name)
+
+    def extend(self, names):
+        names = list(names)
+        list.extend(self, names)
+        for name in names:
+            self._add(name)
+
+    def insert(self, index, name):
+        list.insert(self, index, name)
+        self._add(name)
+
+    def remove(self, name):
+        list.remove(self, name)
+        self._reindex()
+
+
+class ItemList(list):
+    '''A list of item dicts that keeps an index of its items by name'''
+
+    def __init__(self, iterable=()):
+        list.__init__(self, iterable)
+        self._reindex()
+
+    def _reindex(self):
+        '''Rebuilds the name index from the list contents'''
+        self._named = {}
+        for item in self:
+            self._add(item)
+
+    def _add(self, item):
+        '''Adds item to the name index'''
+        try:
+            name = item['name']
+            self._named.setdefault(name, []).append(item)
+        except (KeyError, TypeError):
+            # item is missing 'name', so can't be found by name
+            pass
+
+    def items_named(self, name):
+        '''Returns the items in the list with the given name, in the order
+        they were added'''
+        try:
+            return self._named.get(name, [])
+        except TypeError:
+            return []
+
+    def append(self, item):
+        list.append(self, item)
+        self._add(item)
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        for item in items:
+            self._add(item)
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._add(item)
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._reindex()
+
+
+def new_installinfo():
+    '''Returns an empty installinfo record with indexed lists'''
+    installinfo = {}
+    for section in NAME_SECTIONS:
+        installinfo[section] = NameList()
+    for section in ITEM_SECTIONS:
+        installinfo[section] = ItemList()
+    return installinfo
+
+
+def to_plain_lists(installinfo):
+    '''Replaces the indexed lists in installinfo with plain lists, so it can
+    be written out and compared to what was written before'''
+    for key, value in installinfo.items():
+        if isinstance(value, (NameList, ItemList)):
+            installinfo[key] = list(value)
+    return installinfo
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
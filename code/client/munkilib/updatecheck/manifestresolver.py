@@ -0,0 +1,128 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+updatecheck.manifestresolver
+
+Walks a manifest, the manifests it includes and its conditional_items once,
+and flattens the items for every manifest key into ordered lists. The items
+are in the order the manifests used to be processed for each key: a
+manifest's included manifests, then its conditional_items whose conditions
+are true, then its own items.
+
+Each item is given as a (item, cataloglist, source) tuple, where cataloglist
+is the catalogs to look the item up in and source describes the manifest the
+item came from, for logging.
+"""
+
+import os
+
+from . import catalogs
+from . import manifestutils
+
+from .. import display
+from .. import info
+from .. import processes
+
+
+# the manifest keys that list items
+MANIFEST_KEYS = ['managed_installs', 'managed_uninstalls', 'managed_updates',
+                 'optional_installs', 'featured_items']
+
+
+def resolve_manifest(manifest, keys=None, parentcatalogs=None):
+    """Returns a dict of manifest key to the list of (item, cataloglist,
+    source) tuples for that key from manifest and everything it includes.
+    keys defaults to MANIFEST_KEYS.
+
+    manifest can be a path to a manifest file or a dictionary object.
+    Raises manifestutils.ManifestException if an included manifest can't be
+    retrieved. If a stop is requested, returns what was found so far.
+    """
+    resolved = {}
+    for key in keys or MANIFEST_KEYS:
+        resolved[key] = []
+    _resolve(manifest, resolved, parentcatalogs, ())
+    return resolved
+
+
+def _resolve(manifest, resolved, parentcatalogs, include_path,
+             source=None):
+    """Adds the items from manifest, and the manifests it includes, to
+    resolved. include_path is the names of the manifests that included this
+    one; a manifest that includes one of those is skipped, since that would
+    never end. source describes a manifest given as a dictionary."""
+    if isinstance(manifest, basestring):
+        source = os.path.basename(manifest)
+        display.display_debug1('** Resolving manifest %s', source)
+        manifestdata = manifestutils.get_manifest_data(manifest)
+    else:
+        manifestdata = manifest
+        source = source or 'embedded manifest'
+
+    cataloglist = manifestdata.get('catalogs')
+    if cataloglist:
+        catalogs.get_catalogs(cataloglist)
+    elif parentcatalogs:
+        cataloglist = parentcatalogs
+
+    if not cataloglist:
+        display.display_warning('Manifest %s has no catalogs', source)
+        return
+
+    for item in manifestdata.get('included_manifests', []):
+        if item: # only process if item is not empty
+            if item in include_path:
+                display.display_debug1(
+                    'Skipping included manifest %s: include cycle', item)
+                continue
+            nestedmanifestpath = manifestutils.get_manifest(item)
+            if not nestedmanifestpath:
+                raise manifestutils.ManifestException
+            if processes.stop_requested():
+                return
+            _resolve(nestedmanifestpath, resolved, cataloglist,
+                     include_path + (item,))
+
+    conditionalitems = manifestdata.get('conditional_items', [])
+    if conditionalitems:
+        display.display_debug1(
+            '** Processing conditional_items in %s', source)
+    # conditionalitems should be an array of dicts
+    # each dict has a predicate; the rest consists of the
+    # same keys as a manifest
+    for item in conditionalitems:
+        try:
+            predicate = item['condition']
+        except (AttributeError, KeyError):
+            display.display_warning(
+                'Missing predicate for conditional_item %s', item)
+            continue
+        except BaseException:
+            display.display_warning(
+                'Conditional item is malformed: %s', item)
+            continue
+        if info.predicate_evaluates_as_true(
+                predicate, additional_info={'catalogs': cataloglist}):
+            _resolve(item, resolved, cataloglist, include_path,
+                     source='conditional_items in %s' % source)
+
+    for key in resolved:
+        for item in manifestdata.get(key, []):
+            resolved[key].append((item, cataloglist, source))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools for the Munki Suite.'
@@ -25,6 +25,8 @@ Functions for working with manifest files
 import os
 import urllib2
 
+import objc
+
 from .. import display
 from .. import fetch
 from .. import info
@@ -32,6 +34,7 @@ from .. import keychain
 from .. import prefs
 from .. import reports
 from .. import FoundationPlist
+from ..utils import concurrent_imap
 
 
 PRIMARY_MANIFEST_TAG = '_primary_manifest_'
@@ -78,6 +81,9 @@ def get_manifest(manifest_name, suppress_errors=False):
     """
     if manifest_name in _MANIFESTS:
         return _MANIFESTS[manifest_name]
+    if manifest_name in _INVALID_MANIFESTS:
+        # prefetch_manifests() already got this one and reported the error
+        raise _INVALID_MANIFESTS[manifest_name]
 
     manifestbaseurl = (prefs.pref('ManifestURL') or
                        prefs.pref('SoftwareRepoURL') + '/manifests/')
@@ -208,6 +214,107 @@ def get_primary_manifest(alternate_id=''):
     return manifest
 
 
+def included_manifest_names(manifestdata, cataloglist):
+    """Returns the names of the manifests manifestdata includes, directly or
+    in conditional_items whose conditions are true, in the order
+    process_manifest_for_key() processes them. cataloglist is used for
+    evaluating conditions."""
+    names = [item for item in manifestdata.get('included_manifests', [])
+             if item]
+    for item in manifestdata.get('conditional_items', []):
+        try:
+            predicate = item['condition']
+        except (AttributeError, KeyError, TypeError):
+            continue
+        if info.predicate_evaluates_as_true(
+                predicate, additional_info={'catalogs': cataloglist}):
+            names.extend(included_manifest_names(item, cataloglist))
+    return names
+
+
+def _prefetch_manifest(manifest_name):
+    """Gets manifest_name for prefetch_manifests(). Returns the local path,
+    or None if it couldn't be retrieved. Most errors are reported when the
+    manifest is processed and retrieved again; an invalid manifest has
+    already been reported, so it is remembered and not retrieved again."""
+    with objc.autorelease_pool():
+        try:
+            return get_manifest(manifest_name, suppress_errors=True)
+        except ManifestInvalidException, err:
+            _INVALID_MANIFESTS[manifest_name] = err
+            return None
+        except ManifestException:
+            return None
+
+
+def _find_include_cycles(graph, root):
+    """Returns a list of the include paths in graph (a dict of manifest name
+    to the names of the manifests it includes) that lead from a manifest
+    back to itself, starting from root"""
+    cycles = []
+    path = []
+    done = set()
+
+    def visit(name):
+        """Depth-first search for includes of a manifest on path"""
+        if name in path:
+            cycles.append(path[path.index(name):] + [name])
+            return
+        if name in done:
+            return
+        path.append(name)
+        for included in graph.get(name, []):
+            visit(included)
+        path.pop()
+        done.add(name)
+
+    visit(root)
+    return cycles
+
+
+def prefetch_manifests(manifestpath):
+    """Discovers all the manifests included by the manifest at manifestpath,
+    and by the manifests they include, and gets them from the server a level
+    at a time, MaxConcurrentManifestDownloads at once. Afterwards
+    get_manifest() finds them in _MANIFESTS without a round trip to the
+    server.
+
+    Conditions are evaluated the same way as when the manifests are
+    processed, so call this after the conditions are set up.
+    Include cycles are reported as warnings.
+    """
+    try:
+        workers = int(prefs.pref('MaxConcurrentManifestDownloads') or 1)
+    except (TypeError, ValueError):
+        workers = 1
+    root = PRIMARY_MANIFEST_TAG
+    graph = {}
+    seen = set([root])
+    level = [(root, manifestpath, None)]
+    while level:
+        discovered = []
+        for name, path, parentcatalogs in level:
+            manifestdata = get_manifest_data(path)
+            cataloglist = manifestdata.get('catalogs') or parentcatalogs
+            graph[name] = included_manifest_names(manifestdata, cataloglist)
+            for included in graph[name]:
+                if included not in seen:
+                    seen.add(included)
+                    discovered.append((included, cataloglist))
+        if discovered:
+            display.display_debug1(
+                'Prefetching %s included manifests...', len(discovered))
+        paths = concurrent_imap(
+            _prefetch_manifest, [name for name, dummy in discovered], workers)
+        level = [(name, path, cataloglist)
+                 for (name, cataloglist), path in zip(discovered, paths)
+                 if path]
+
+    for cycle in _find_include_cycles(graph, root):
+        display.display_warning(
+            'Manifests include each other: %s', ' -> '.join(cycle))
+
+
 def clean_up_manifests():
     """Removes any manifest files that are no longer in use by this client"""
     manifest_dir = os.path.join(
@@ -317,6 +424,8 @@ def remove_from_selfserve_uninstalls(itemname):
 
 # module globals
 _MANIFESTS = {}
+# manifest name -> ManifestInvalidException for manifests prefetched invalid
+_INVALID_MANIFESTS = {}
 
 if __name__ == '__main__':
     print 'This is a library of support tools for the Munki Suite.'
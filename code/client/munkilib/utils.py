@@ -24,11 +24,14 @@ Note: this module should be 100% free of ObjC-dependent Python imports.
 """
 
 
+import collections
 import grp
 import os
 import subprocess
 import stat
 
+from multiprocessing.pool import ThreadPool
+
 
 class Memoize(dict):
     '''Class to cache the return values of an expensive function.
@@ -203,5 +206,49 @@ def getFirstPlist(textString):
             textString[plist_end_index:])
 
 
+def concurrent_imap(function, iterable, workers):
+    """Like itertools.imap, but calls function on up to `workers` items at
+    once using a pool of threads.
+
+    Results are yielded in the same order as the items in iterable, and
+    only a small multiple of `workers` calls are outstanding at any time, so
+    a slow consumer doesn't cause all the results to pile up in memory.
+    Exceptions raised by function are re-raised when the corresponding
+    result is reached.
+
+    Args:
+      function: callable taking a single item.
+      iterable: the items to process.
+      workers: int maximum number of concurrent calls. Values less than 2
+               process the items serially in the calling thread.
+    Yields:
+      function(item) for each item in iterable.
+    """
+    if workers < 2:
+        for item in iterable:
+            yield function(item)
+        return
+
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    completed = False
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            # caller stopped early or something raised; don't wait for
+            # outstanding work
+            pool.terminate()
+        pool.join()
+
+
 if __name__ == '__main__':
     print 'This is a library of support tools for the Munki Suite.'
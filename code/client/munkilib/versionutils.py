@@ -0,0 +1,120 @@
+# encoding: utf-8
+#
+# Copyright 2019 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+versionutils.py
+
+Version string functions. These are available from pkgutils; they live here
+so that tools that can't use PyObjC (makecatalogs, repoclean, the admin
+catalog index) can use them too.
+"""
+
+import re
+
+from distutils import version
+
+from .utils import Memoize
+
+
+def trim_version_string(version_string):
+    """Trims all lone trailing zeros in the version string after major/minor.
+
+    Examples:
+      10.0.0.0 -> 10.0
+      10.0.0.1 -> 10.0.0.1
+      10.0.0-abc1 -> 10.0.0-abc1
+      10.0.0-abc1.0 -> 10.0.0-abc1
+    """
+    if version_string is None or version_string == '':
+        return ''
+    version_parts = version_string.split('.')
+    # strip off all trailing 0's in the version, while over 2 parts.
+    while len(version_parts) > 2 and version_parts[-1] == '0':
+        del version_parts[-1]
+    return '.'.join(version_parts)
+
+
+@Memoize
+def version_key(version_string):
+    """Returns a tuple to sort or compare version strings by.
+    version_key(a) < version_key(b) exactly when
+    pkgutils.MunkiLooseVersion(a) < pkgutils.MunkiLooseVersion(b), so
+    "10.6" and "10.6.0" get the same key.
+    Keys are cached, so each version string is only parsed once. Use it
+    like: versions.sort(key=version_key, reverse=True)
+    """
+    if version_string is None:
+        # treat None like an empty string
+        version_string = ''
+    if isinstance(version_string, unicode):
+        # convert to string so version.LooseVersion doesn't choke
+        version_string = version_string.encode('UTF-8')
+    loose_version = version.LooseVersion()
+    loose_version.parse(str(version_string))
+    components = list(loose_version.version)
+    # MunkiLooseVersion pads the shorter of two versions with zeros before
+    # comparing; dropping trailing zeros instead gives the same ordering
+    # without needing to know the other version
+    while components and components[-1] == 0:
+        del components[-1]
+    return tuple(components)
+
+
+# pylint: disable=C0103
+def nameAndVersion(aString):
+    """
+    Splits a string into the name and version numbers:
+    'TextWrangler2.3b1' becomes ('TextWrangler', '2.3b1')
+    'AdobePhotoshopCS3-11.2.1' becomes ('AdobePhotoshopCS3', '11.2.1')
+    'MicrosoftOffice2008v12.2.1' becomes ('MicrosoftOffice2008', '12.2.1')
+    """
+    # first try regex
+    m = re.search(r'[0-9]+(\.[0-9]+)((\.|a|b|d|v)[0-9]+)+', aString)
+    if m:
+        vers = m.group(0)
+        name = aString[0:aString.find(vers)].rstrip(' .-_v')
+        return (name, vers)
+
+    # try another way
+    index = 0
+    for char in aString[::-1]:
+        if char in '0123456789._':
+            index -= 1
+        elif char in 'abdv':
+            partialVersion = aString[index:]
+            if set(partialVersion).intersection(set('abdv')):
+                # only one of 'abdv' allowed in the version
+                break
+            else:
+                index -= 1
+        else:
+            break
+
+    if index < 0:
+        possibleVersion = aString[index:]
+        # now check from the front of the possible version until we
+        # reach a digit (because we might have characters in '._abdv'
+        # at the start)
+        for char in possibleVersion:
+            if not char in '0123456789':
+                index += 1
+            else:
+                break
+        vers = aString[index:]
+        return (aString[0:index].rstrip(' .-_v'), vers)
+    else:
+        # no version number found,
+        # just return original string and empty string
+        return (aString, '')
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_catalogindex.py
+
+Unit tests for admin.catalogindex.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from munkilib.admin import catalogindex
+
+from ..data_scaffolds import MemoryRepo
+
+
+CATALOG = [
+    {'name': 'Firefox', 'version': '60.0',
+     'installer_item_location': 'apps/Firefox-60.0.dmg',
+     'installer_item_hash': 'aaa',
+     'installs': [{'type': 'application',
+                   'path': '/Applications/Firefox.app'}]},
+    {'name': 'Firefox', 'version': '61.0',
+     'installer_item_location': 'apps/Firefox-61.0.dmg',
+     'installer_item_hash': 'bbb'},
+    {'name': 'Firefox', 'version': '61.0.0',
+     'installer_item_location': 'apps/Firefox-61.0.0.dmg'},
+    {'name': 'FirefoxPlugin', 'version': '1.0', 'update_for': ['Firefox'],
+     'receipts': [{'packageid': 'org.example.plugin', 'version': '1.0'}]},
+    {'name': 'Profile', 'version': '1', 'PayloadIdentifier': 'org.example'},
+]
+
+
+class TestCatalogIndex(unittest.TestCase):
+    '''Test building, storing and reusing catalog indexes'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.saved_cache_dir = catalogindex.INDEX_CACHE_DIR
+        catalogindex.INDEX_CACHE_DIR = self.tempdir
+        catalogindex._INDEXES.clear()
+        self.repo = MemoryRepo()
+        self.repo.items['catalogs/all'] = plistlib.writePlistToString(CATALOG)
+        self.built = 0
+        self.saved_make_index = catalogindex.make_index
+
+        def counting_make_index(*args, **kwargs):
+            '''Counts the indexes built'''
+            self.built += 1
+            return self.saved_make_index(*args, **kwargs)
+        catalogindex.make_index = counting_make_index
+
+    def tearDown(self):
+        catalogindex.make_index = self.saved_make_index
+        catalogindex.INDEX_CACHE_DIR = self.saved_cache_dir
+        catalogindex._INDEXES.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_tables(self):
+        index = catalogindex.get_catalog_index(self.repo)
+        self.assertEqual(index['hashes'], {'aaa': [0], 'bbb': [1]})
+        self.assertEqual(index['installer_items'],
+                         {'Firefox.dmg': {'60.0': [0], '61.0': [1],
+                                          '61.0.0': [2]}})
+        self.assertEqual(index['applications'],
+                         {'/Applications/Firefox.app': {'60.0': [0]}})
+        self.assertEqual(index['receipts'],
+                         {'org.example.plugin': {'1.0': [3]}})
+        self.assertEqual(index['profiles'], {'org.example': {'1': [4]}})
+        # the first of equal newest versions is the latest
+        self.assertEqual(index['latest'],
+                         {'Firefox': 1, 'FirefoxPlugin': 3, 'Profile': 4})
+        self.assertEqual(index['names'], ['Firefox', 'Profile'])
+
+    def test_index_is_reused(self):
+        first = catalogindex.get_catalog_index(self.repo)
+        self.assertTrue(catalogindex.get_catalog_index(self.repo) is first)
+        # another process loads it from disk
+        catalogindex._INDEXES.clear()
+        self.assertEqual(catalogindex.get_catalog_index(self.repo), first)
+        self.assertEqual(self.built, 1)
+        # until the catalog changes
+        self.repo.items['catalogs/all'] = plistlib.writePlistToString(
+            CATALOG[:1])
+        index = catalogindex.get_catalog_index(self.repo)
+        self.assertEqual(len(index['items']), 1)
+        self.assertEqual(self.built, 2)
+
+    def test_errors(self):
+        self.assertRaises(catalogindex.CatalogReadError,
+                          catalogindex.get_catalog_index, self.repo, 'none')
+        self.repo.items['catalogs/bad'] = 'not a plist'
+        self.assertRaises(catalogindex.CatalogDecodeError,
+                          catalogindex.get_catalog_index, self.repo, 'bad')
+
+
+if __name__ == '__main__':
+    unittest.main()
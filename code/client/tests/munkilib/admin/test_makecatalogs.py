@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_makecatalogs.py
+
+Unit tests for admin.makecatalogslib.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cPickle
+import datetime
+import hashlib
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from munkilib import catalogdb
+from munkilib.admin import makecatalogslib
+
+from ..data_scaffolds import MemoryRepo
+
+
+def pkginfo_data(name, version, catalogs):
+    '''Returns a serialized pkginfo'''
+    return plistlib.writePlistToString({
+        'name': name,
+        'version': version,
+        'catalogs': catalogs,
+        'installer_item_location': '%s-%s.dmg' % (name, version),
+        '_metadata': {'created_by': 'test'},
+        'notes': 'admin notes',
+    })
+
+
+class TestIncrementalMakeCatalogs(unittest.TestCase):
+    '''Test makecatalogs with and without a pkginfo index'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = MemoryRepo()
+        for name, version, catalogs in [('Foo', '1.0', ['testing']),
+                                        ('Foo', '2.0', ['testing']),
+                                        ('Bar', '1.0', ['production'])]:
+            self.repo.items['pkgsinfo/%s-%s.plist' % (name, version)] = (
+                pkginfo_data(name, version, catalogs))
+            self.repo.items['pkgs/%s-%s.dmg' % (name, version)] = 'payload'
+        self.options = {'incremental': True,
+                        'index_path': os.path.join(self.tempdir, 'index')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def catalog(self, name):
+        return plistlib.readPlistFromString(
+            self.repo.items['catalogs/' + name])
+
+    def test_incremental_output_matches_full_run(self):
+        errors = makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertEqual(errors, [])
+        incremental = dict((key, value) for key, value
+                           in self.repo.items.items()
+                           if key.startswith('catalogs/'))
+        errors = makecatalogslib.makecatalogs(self.repo, {})
+        self.assertEqual(errors, [])
+        for key in incremental:
+            self.assertEqual(incremental[key], self.repo.items[key])
+        self.assertFalse('_metadata' in self.catalog('all')[0])
+        self.assertFalse('notes' in self.catalog('all')[0])
+
+    def test_unchanged_catalogs_are_not_rewritten(self):
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.repo.puts = []
+        self.repo.items['pkgsinfo/Bar-1.0.plist'] = pkginfo_data(
+            'Bar', '1.0', ['production', 'testing'])
+        errors = makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(self.repo.puts),
+                         ['catalogs/all', 'catalogs/production',
+                          'catalogs/testing'])
+        self.repo.puts = []
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertEqual(self.repo.puts, [])
+        self.assertEqual(len(self.catalog('testing')), 3)
+
+    def test_unchanged_etags_skip_reads(self):
+        def itemlist_with_metadata(kind, include_hashes=False):
+            return [(name, {'etag': self.repo.items[kind + '/' + name]})
+                    for name in self.repo.itemlist(kind)]
+        self.repo.itemlist_with_metadata = itemlist_with_metadata
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.repo.items['pkgsinfo/Bar-1.0.plist'] = pkginfo_data(
+            'Bar', '1.0', ['production', 'testing'])
+        self.repo.gets = []
+        errors = makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.repo.gets, ['pkgsinfo/Bar-1.0.plist'])
+        self.assertEqual(len(self.catalog('testing')), 3)
+
+    def test_removed_pkginfo_is_dropped_from_index(self):
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        del self.repo.items['pkgsinfo/Bar-1.0.plist']
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        index = makecatalogslib.load_index(self.options['index_path'])
+        self.assertFalse('pkgsinfo/Bar-1.0.plist' in index['pkgsinfo'])
+        self.assertFalse('catalogs/production' in self.repo.items)
+
+    def test_unreadable_index_starts_over(self):
+        fileref = open(self.options['index_path'], 'w')
+        fileref.write('garbage')
+        fileref.close()
+        index = makecatalogslib.load_index(self.options['index_path'])
+        self.assertEqual(index, makecatalogslib.new_index())
+
+
+class TestCatalogDB(unittest.TestCase):
+    '''Test writing precompiled catalog dbs'''
+
+    def setUp(self):
+        self.repo = MemoryRepo()
+        for name, version, catalogs in [('Foo', '1.0', ['testing']),
+                                        ('FooUpdate', '1.0', ['testing'])]:
+            self.repo.items['pkgsinfo/%s-%s.plist' % (name, version)] = (
+                pkginfo_data(name, version, catalogs))
+            self.repo.items['pkgs/%s-%s.dmg' % (name, version)] = 'payload'
+        pkginfo = plistlib.readPlistFromString(
+            self.repo.items['pkgsinfo/FooUpdate-1.0.plist'])
+        pkginfo['update_for'] = 'Foo'
+        pkginfo['force_install_after_date'] = datetime.datetime(2019, 6, 1)
+        self.repo.items['pkgsinfo/FooUpdate-1.0.plist'] = (
+            plistlib.writePlistToString(pkginfo))
+
+    def test_catalog_db_matches_catalog(self):
+        errors = makecatalogslib.makecatalogs(self.repo, {'catalog_db': True})
+        self.assertEqual(errors, [])
+        catalogdata = self.repo.items['catalogs/testing']
+        pkgdb = catalogdb.loads_catalog_db(
+            self.repo.items['catalogs/testing.db'],
+            catalogdb.catalog_hash(catalogdata))
+        self.assertEqual(
+            pkgdb, catalogdb.make_catalog_db(
+                plistlib.readPlistFromString(catalogdata)))
+        self.assertEqual(pkgdb['updaters'][0]['update_for'], ['Foo'])
+        self.assertEqual(pkgdb['updates'], {'Foo': ['FooUpdate']})
+        # the catalog itself is written as it was in the pkginfo
+        self.assertEqual(
+            plistlib.readPlistFromString(catalogdata)[1]['update_for'], 'Foo')
+
+    def test_catalog_db_must_match_catalog(self):
+        makecatalogslib.makecatalogs(self.repo, {'catalog_db': True})
+        self.assertRaises(
+            catalogdb.CatalogDBError, catalogdb.loads_catalog_db,
+            self.repo.items['catalogs/testing.db'],
+            catalogdb.catalog_hash(self.repo.items['catalogs/testing'] + ' '))
+
+    def test_catalog_db_refuses_other_classes(self):
+        self.assertRaises(
+            catalogdb.CatalogDBError, catalogdb.loads_catalog_db,
+            cPickle.dumps({'version': catalogdb.CATALOG_DB_FORMAT_VERSION,
+                           'catalog_sha256': 'x',
+                           'db': MemoryRepo()}, 2), 'x')
+
+    def test_catalog_dbs_are_kept_without_catalog_db(self):
+        makecatalogslib.makecatalogs(self.repo, {'catalog_db': True})
+        makecatalogslib.makecatalogs(self.repo, {})
+        self.assertEqual(self.repo.itemlist('catalogs'),
+                         ['all', 'all.db', 'testing', 'testing.db'])
+
+    def test_catalog_dbs_are_removed_with_their_catalog(self):
+        makecatalogslib.makecatalogs(self.repo, {'catalog_db': True})
+        for name in ['Foo', 'FooUpdate']:
+            pkginfo = plistlib.readPlistFromString(
+                self.repo.items['pkgsinfo/%s-1.0.plist' % name])
+            pkginfo['catalogs'] = ['production']
+            self.repo.items['pkgsinfo/%s-1.0.plist' % name] = (
+                plistlib.writePlistToString(pkginfo))
+        makecatalogslib.makecatalogs(self.repo, {})
+        self.assertEqual(self.repo.itemlist('catalogs'),
+                         ['all', 'all.db', 'production'])
+
+
+class TestParallelMakeCatalogs(unittest.TestCase):
+    '''Test that concurrent pkginfo ingestion gives the same catalogs'''
+
+    def setUp(self):
+        self.repo = MemoryRepo()
+        for index in range(50):
+            name = 'Item%02d' % (index % 7)
+            version = '1.%s' % index
+            self.repo.items['pkgsinfo/%s-%s.plist' % (name, version)] = (
+                pkginfo_data(name, version, ['catalog%s' % (index % 3)]))
+            if index % 5:
+                self.repo.items['pkgs/%s-%s.dmg' % (name, version)] = 'x'
+
+    def catalogs_and_errors(self, options):
+        errors = makecatalogslib.makecatalogs(self.repo, options)
+        catalogs = dict((key, value) for key, value in self.repo.items.items()
+                        if key.startswith('catalogs/'))
+        for key in catalogs:
+            del self.repo.items[key]
+        return catalogs, errors
+
+    def test_jobs_give_identical_output(self):
+        serial = self.catalogs_and_errors({})
+        parallel = self.catalogs_and_errors({'jobs': 8})
+        self.assertEqual(serial, parallel)
+        # the items missing their installer items are reported in order
+        self.assertEqual(len(serial[1]), 10)
+
+    def test_jobs_set_read_concurrency(self):
+        concurrencies = []
+        get_many = self.repo.get_many
+
+        def recording_get_many(resource_identifiers, concurrency=None):
+            '''Records the concurrency asked for'''
+            concurrencies.append(concurrency)
+            return get_many(resource_identifiers, concurrency=concurrency)
+
+        self.repo.get_many = recording_get_many
+        makecatalogslib.makecatalogs(self.repo, {})
+        makecatalogslib.makecatalogs(self.repo, {'jobs': 8})
+        # icons, then pkginfo items, for each run
+        self.assertEqual(concurrencies, [None, None, 8, 8])
+
+
+class TestUnreadableItems(unittest.TestCase):
+    '''Test that items a plugin fails to read are reported and skipped'''
+
+    def test_unexpected_plugin_errors_are_reported(self):
+        repo = MemoryRepo()
+        for name in ['Foo', 'Bar']:
+            repo.items['pkgsinfo/%s-1.0.plist' % name] = (
+                pkginfo_data(name, '1.0', ['testing']))
+            repo.items['pkgs/%s-1.0.dmg' % name] = 'payload'
+        repo.items['icons/Foo.png'] = 'foo icon'
+        get = repo.get
+
+        def failing_get(resource_identifier):
+            '''Fails the way a third-party plugin might'''
+            if 'Foo' in resource_identifier:
+                raise ValueError('plugin bug')
+            return get(resource_identifier)
+
+        repo.get = failing_get
+        errors = makecatalogslib.makecatalogs(repo, {})
+        self.assertEqual(len([error for error in errors
+                              if 'plugin bug' in error]), 2)
+        self.assertEqual(
+            [item['name'] for item in plistlib.readPlistFromString(
+                repo.items['catalogs/testing'])], ['Bar'])
+
+
+class TestIconHashes(unittest.TestCase):
+    '''Test incremental icon hashing'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = MemoryRepo(etags=True)
+        self.repo.items['icons/Foo.png'] = 'foo icon'
+        self.repo.items['icons/Bar.png'] = 'bar icon'
+        self.options = {'incremental': True, 'jobs': 4,
+                        'index_path': os.path.join(self.tempdir, 'index')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def icon_hashes(self):
+        return plistlib.readPlistFromString(
+            self.repo.items['icons/_icon_hashes.plist'])
+
+    def test_only_changed_icons_are_read(self):
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertEqual(self.icon_hashes(), {
+            'Foo.png': hashlib.sha256('foo icon').hexdigest(),
+            'Bar.png': hashlib.sha256('bar icon').hexdigest()})
+        self.repo.items['icons/Foo.png'] = 'new foo icon'
+        self.repo.gets = []
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertTrue('icons/Foo.png' in self.repo.gets)
+        self.assertFalse('icons/Bar.png' in self.repo.gets)
+        self.assertEqual(self.icon_hashes()['Foo.png'],
+                         hashlib.sha256('new foo icon').hexdigest())
+
+    def test_unchanged_icon_hashes_are_not_rewritten(self):
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.repo.puts = []
+        makecatalogslib.makecatalogs(self.repo, self.options)
+        self.assertFalse('icons/_icon_hashes.plist' in self.repo.puts)
+        # nor without the index
+        makecatalogslib.makecatalogs(self.repo, {})
+        self.assertFalse('icons/_icon_hashes.plist' in self.repo.puts)
+
+
+class TestVerifyPkginfo(unittest.TestCase):
+    '''Test verify_pkginfo with an indexed pkgs list'''
+
+    def setUp(self):
+        self.pkgs_index = makecatalogslib.PkgsIndex(
+            ['pkgs/apps/Foo-1.0.dmg', 'pkgs/apps/Bar-1.0.dmg'])
+
+    def verify(self, location):
+        errors = []
+        result = makecatalogslib.verify_pkginfo(
+            'Foo.plist', {'installer_item_location': location},
+            self.pkgs_index, errors)
+        return result, errors
+
+    def test_exact_match(self):
+        self.assertEqual(self.verify('apps/Foo-1.0.dmg'), (True, []))
+
+    def test_case_differs(self):
+        result, errors = self.verify('Apps/foo-1.0.dmg')
+        self.assertTrue(result)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('pkgs/apps/Foo-1.0.dmg' in errors[0])
+
+    def test_missing(self):
+        result, errors = self.verify('apps/Baz-1.0.dmg')
+        self.assertFalse(result)
+        self.assertEqual(
+            errors, ['WARNING: Foo.plist refers to missing installer item: '
+                     'apps/Baz-1.0.dmg'])
+
+    def test_plain_list(self):
+        errors = []
+        self.assertTrue(makecatalogslib.verify_pkginfo(
+            'Foo.plist', {'installer_item_location': 'apps/Bar-1.0.dmg'},
+            ['pkgs/apps/Bar-1.0.dmg'], errors))
+
+
+if __name__ == '__main__':
+    unittest.main()
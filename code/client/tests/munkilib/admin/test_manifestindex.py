@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_manifestindex.py
+
+Unit tests for admin.manifestindex.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from munkilib.admin import manifestindex
+
+from ..data_scaffolds import MemoryRepo
+
+
+def add_manifest(repo, name, manifest):
+    '''Stores manifest in repo under name'''
+    repo.items['manifests/' + name] = plistlib.writePlistToString(manifest)
+
+
+class TestManifestIndex(unittest.TestCase):
+    '''Test the manifest index and its reverse maps'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = MemoryRepo(etags=True)
+        add_manifest(self.repo, 'site_default', {
+            'catalogs': ['production'],
+            'managed_installs': ['Firefox', 'GoogleChrome']})
+        add_manifest(self.repo, 'lab', {
+            'catalogs': ['production'],
+            'included_manifests': ['site_default'],
+            'managed_installs': ['Firefox'],
+            'optional_installs': ['FireAlarm']})
+        add_manifest(self.repo, 'loop', {
+            'catalogs': ['production'],
+            'included_manifests': ['loop']})
+        self.index_path = os.path.join(self.tempdir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_find(self):
+        index = manifestindex.ManifestIndex(self.repo)
+        self.assertEqual(index.refresh(), [])
+        self.assertEqual(
+            index.find('fire', section='managed_installs'),
+            [('lab', 'managed_installs', 'Firefox'),
+             ('site_default', 'managed_installs', 'Firefox')])
+        self.assertEqual(len(index.find('FIRE')), 3)
+        self.assertEqual(
+            index.manifests_containing('Firefox'),
+            [('lab', 'managed_installs'),
+             ('site_default', 'managed_installs')])
+        self.assertEqual(index.including_manifests('site_default'), ['lab'])
+
+    def test_expand(self):
+        index = manifestindex.ManifestIndex(self.repo)
+        index.refresh()
+        expanded = index.expand('lab')
+        self.assertEqual(
+            expanded['included_manifests'][0]['site_default'][
+                'managed_installs'], ['Firefox', 'GoogleChrome'])
+        # the indexed manifest isn't changed
+        self.assertEqual(index.get('lab')['included_manifests'],
+                         ['site_default'])
+        # a manifest that includes itself doesn't recurse forever
+        self.assertEqual(index.expand('loop')['included_manifests'],
+                         [{'loop': None}])
+        self.assertEqual(index.expand('missing'), None)
+
+    def test_only_changed_manifests_are_read(self):
+        index = manifestindex.ManifestIndex(self.repo, self.index_path)
+        index.refresh()
+        self.assertEqual(len(self.repo.gets), 3)
+        add_manifest(self.repo, 'lab', {'catalogs': ['testing']})
+        del self.repo.items['manifests/loop']
+        self.repo.gets = []
+        # a new session picks up the stored index
+        index = manifestindex.ManifestIndex(self.repo, self.index_path)
+        self.assertEqual(index.refresh(), [])
+        self.assertEqual(self.repo.gets, ['manifests/lab'])
+        self.assertEqual(index.names, ['lab', 'site_default'])
+        self.assertEqual(index.including_manifests('site_default'), [])
+
+    def test_unreadable_manifest(self):
+        self.repo.items['manifests/broken'] = 'not a plist'
+        index = manifestindex.ManifestIndex(self.repo)
+        errors = index.refresh()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('manifests/broken' in errors[0])
+        self.assertEqual(index.get('broken'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
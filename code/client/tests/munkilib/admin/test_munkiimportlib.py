@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_munkiimportlib.py
+
+Unit tests for batch importing with admin.munkiimportlib, and for copying
+several files to a FileRepo (and one at a time to a GitFileRepo).
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import plistlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from munkilib import munkirepo
+from munkilib.admin import catalogindex
+from munkilib.admin import munkiimportlib
+from munkilib.admin import pkginfolib
+from munkilib.admin.common import AttributeDict
+from munkilib.munkirepo import FileRepo
+from munkilib.munkirepo import GitFileRepo
+
+from ..data_scaffolds import MemoryRepo
+
+
+def fake_makepkginfo(installer_item, dummy_options):
+    '''Returns pkginfo for installer_item, which is at
+    <hash>/<name>-<version>.dmg'''
+    name, version = os.path.splitext(
+        os.path.basename(installer_item))[0].split('-')
+    return {'name': name,
+            'version': version,
+            'installer_item_hash': os.path.basename(
+                os.path.dirname(installer_item)),
+            'catalogs': ['testing']}
+
+
+class TestUniquePaths(unittest.TestCase):
+    '''Test naming items in the repo'''
+
+    def setUp(self):
+        self.pref = munkiimportlib.pref
+        munkiimportlib.pref = lambda key: None
+
+    def tearDown(self):
+        munkiimportlib.pref = self.pref
+
+    def test_unique_item_path(self):
+        self.assertEqual(
+            munkiimportlib.unique_item_path('/tmp/Foo.dmg', '1.0', 'apps', []),
+            'pkgs/apps/Foo-1.0.dmg')
+        self.assertEqual(
+            munkiimportlib.unique_item_path(
+                '/tmp/Foo-1.0.dmg', '1.0', '', ['pkgs/Foo-1.0.dmg',
+                                                'pkgs/Foo-1.0__1.dmg']),
+            'pkgs/Foo-1.0__2.dmg')
+
+    def test_unique_pkginfo_path(self):
+        pkginfo = {'name': 'Foo', 'version': '1.0'}
+        self.assertEqual(
+            munkiimportlib.unique_pkginfo_path(pkginfo, 'apps', []),
+            'pkgsinfo/apps/Foo-1.0')
+        self.assertEqual(
+            munkiimportlib.unique_pkginfo_path(
+                pkginfo, 'apps', ['pkgsinfo/apps/Foo-1.0']),
+            'pkgsinfo/apps/Foo-1.0__1')
+
+
+class TestImportItems(unittest.TestCase):
+    '''Test importing several items at once'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = MemoryRepo()
+        self.repo.items['catalogs/all'] = plistlib.writePlistToString(
+            [{'name': 'Bar', 'version': '1.0', 'installer_item_hash': 'bbb',
+              'installer_item_location': 'Bar-1.0.dmg'}])
+        self.repo.items['pkgs/Bar-1.0.dmg'] = 'existing'
+        self.repo.items['pkgsinfo/Bar-1.0'] = 'existing'
+        self.options = AttributeDict({'subdirectory': ''})
+        self.makepkginfo = pkginfolib.makepkginfo
+        pkginfolib.makepkginfo = fake_makepkginfo
+        self.pref = munkiimportlib.pref
+        munkiimportlib.pref = lambda key: None
+        self.cache_dir = catalogindex.INDEX_CACHE_DIR
+        catalogindex.INDEX_CACHE_DIR = os.path.join(self.tempdir, 'cache')
+        catalogindex._INDEXES.clear()
+
+    def tearDown(self):
+        pkginfolib.makepkginfo = self.makepkginfo
+        munkiimportlib.pref = self.pref
+        catalogindex.INDEX_CACHE_DIR = self.cache_dir
+        catalogindex._INDEXES.clear()
+        shutil.rmtree(self.tempdir)
+
+    def installer_item(self, itemhash, name):
+        '''Returns the path of a (fake) installer item for
+        fake_makepkginfo'''
+        return os.path.join(self.tempdir, itemhash, name)
+
+    def saved_pkginfo(self, pkginfo_path):
+        '''Returns the pkginfo saved at pkginfo_path'''
+        return plistlib.readPlistFromString(self.repo.items[pkginfo_path])
+
+    def test_names_within_batch_are_unique(self):
+        # different items with the same name and version
+        items = [self.installer_item('aaa', 'Bar-1.0.dmg'),
+                 self.installer_item('ccc', 'Bar-1.0.dmg'),
+                 self.installer_item('ddd', 'Bar-1.0.dmg')]
+        imported, errors = munkiimportlib.import_items(
+            self.repo, items, self.options, jobs=2)
+        self.assertEqual(errors, [])
+        self.assertEqual(imported, [(items[0], 'pkgsinfo/Bar-1.0__1'),
+                                    (items[1], 'pkgsinfo/Bar-1.0__2'),
+                                    (items[2], 'pkgsinfo/Bar-1.0__3')])
+        for index, item in enumerate(items):
+            pkginfo = self.saved_pkginfo('pkgsinfo/Bar-1.0__%s' % (index + 1))
+            self.assertEqual(pkginfo['installer_item_location'],
+                             'Bar-1.0__%s.dmg' % (index + 1))
+            self.assertEqual(
+                self.repo.items['pkgs/' + pkginfo['installer_item_location']],
+                'payload of ' + item)
+        self.assertEqual(self.repo.items['pkgs/Bar-1.0.dmg'], 'existing')
+
+    def test_identical_items_are_skipped(self):
+        items = [self.installer_item('bbb', 'Bar-2.0.dmg'),
+                 self.installer_item('aaa', 'Foo-1.0.dmg'),
+                 self.installer_item('aaa', 'Foo-1.1.dmg')]
+        messages = []
+        imported, errors = munkiimportlib.import_items(
+            self.repo, items, self.options, output_fn=messages.append)
+        self.assertEqual(errors, [])
+        self.assertEqual(imported, [(items[1], 'pkgsinfo/Foo-1.0')])
+        self.assertEqual(self.repo.itemlist('pkgs'),
+                         ['Bar-1.0.dmg', 'Foo-1.0.dmg'])
+        skipped = [message for message in messages
+                   if message.startswith('Skipping')]
+        self.assertEqual(len(skipped), 2)
+        self.assertTrue('Bar-1.0' in skipped[0])
+        self.assertTrue(items[1] in skipped[1])
+
+    def test_partial_copy_failure(self):
+        items = [self.installer_item('aaa', 'Foo-1.0.dmg'),
+                 self.installer_item('ccc', 'Baz-1.0.dmg')]
+        self.repo.fail_copies.add(items[0])
+        imported, errors = munkiimportlib.import_items(
+            self.repo, items, self.options, jobs=2)
+        self.assertEqual(imported, [(items[1], 'pkgsinfo/Baz-1.0')])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(items[0] in errors[0])
+        self.assertEqual(self.repo.itemlist('pkgsinfo'),
+                         ['Bar-1.0', 'Baz-1.0'])
+
+    def test_pkginfo_failure(self):
+        def makepkginfo(installer_item, options):
+            '''Fails for Foo'''
+            if 'Foo' in installer_item:
+                raise pkginfolib.PkgInfoGenerationError('not a package')
+            return fake_makepkginfo(installer_item, options)
+        pkginfolib.makepkginfo = makepkginfo
+        items = [self.installer_item('aaa', 'Foo-1.0.dmg'),
+                 self.installer_item('ccc', 'Baz-1.0.dmg')]
+        imported, errors = munkiimportlib.import_items(
+            self.repo, items, self.options, jobs=2)
+        self.assertEqual(imported, [(items[1], 'pkgsinfo/Baz-1.0')])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('not a package' in errors[0])
+
+
+class TestFileRepoPutMany(unittest.TestCase):
+    '''Test copying several local files to a FileRepo'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'repo')
+        os.mkdir(self.root)
+        self.repo = FileRepo.FileRepo('file://' + self.root)
+        self.sources = {}
+        for name in ['Foo.dmg', 'Bar.dmg']:
+            path = os.path.join(self.tempdir, name)
+            fileref = open(path, 'w')
+            fileref.write(name)
+            fileref.close()
+            self.sources[name] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_many_from_local_files(self):
+        failures = self.repo.put_many_from_local_files(
+            {'pkgs/apps/Foo.dmg': self.sources['Foo.dmg'],
+             'pkgs/Bar.dmg': self.sources['Bar.dmg'],
+             'pkgs/Missing.dmg': os.path.join(self.tempdir, 'Missing.dmg')})
+        self.assertEqual(failures.keys(), ['pkgs/Missing.dmg'])
+        self.assertTrue(isinstance(failures['pkgs/Missing.dmg'],
+                                   munkirepo.RepoError))
+        self.assertEqual(self.repo.get('pkgs/apps/Foo.dmg'), 'Foo.dmg')
+        self.assertEqual(self.repo.get('pkgs/Bar.dmg'), 'Bar.dmg')
+        self.assertEqual(sorted(self.repo.itemlist('pkgs')),
+                         ['Bar.dmg', 'apps/Foo.dmg'])
+
+
+
+class CountingGitFileRepo(GitFileRepo.GitFileRepo):
+    '''A GitFileRepo that records how many copies are made at once,
+    instead of copying and committing'''
+
+    def __init__(self, baseurl):
+        super(CountingGitFileRepo, self).__init__(baseurl)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+        self.copied = []
+
+    def put_from_local_file(self, resource_identifier, local_file_path):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+            self.copied.append(resource_identifier)
+
+
+class TestGitFileRepoPutMany(unittest.TestCase):
+    '''Test that a GitFileRepo copies local files one at a time'''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = CountingGitFileRepo('file://' + self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_many_from_local_files_is_serial(self):
+        path_by_identifier = dict(
+            ('pkgs/Item%s.dmg' % number, '/tmp/Item%s.dmg' % number)
+            for number in range(8))
+        self.assertEqual(self.repo.put_many_from_local_files(
+            path_by_identifier, concurrency=4), {})
+        self.assertEqual(self.repo.most_running, 1)
+        self.assertEqual(self.repo.copied, sorted(path_by_identifier))
+
+
+if __name__ == '__main__':
+    unittest.main()
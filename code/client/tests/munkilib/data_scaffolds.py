@@ -1,3 +1,8 @@
+import hashlib
+
+from munkilib import munkirepo
+
+
 def getRunningProcessesMock():
     return [
         '/sbin/launchd',
@@ -156,3 +161,54 @@ def getRunningProcessesMock():
         '/usr/sbin/spindump',
         '/bin/ps'
     ]
+
+
+class MemoryRepo(munkirepo.Repo):
+    '''A minimal in-memory repo for testing. Calls to get() and put() are
+    recorded in gets and puts. If etags is True, itemlist_with_metadata()
+    gives each item an etag made from its content. Copying any of the local
+    files in fail_copies fails.'''
+
+    def __init__(self, etags=False):
+        super(MemoryRepo, self).__init__('memory://test')
+        self.baseurl = 'memory://test'
+        self.etags = etags
+        self.items = {}
+        self.gets = []
+        self.puts = []
+        self.fail_copies = set()
+
+    def itemlist(self, kind):
+        prefix = kind + '/'
+        return sorted(key[len(prefix):] for key in self.items
+                      if key.startswith(prefix))
+
+    def itemlist_with_metadata(self, kind, include_hashes=False):
+        if not self.etags:
+            return super(MemoryRepo, self).itemlist_with_metadata(
+                kind, include_hashes=include_hashes)
+        return [(name, {'etag': hashlib.md5(
+            self.items[kind + '/' + name]).hexdigest()})
+                for name in self.itemlist(kind)]
+
+    def get(self, resource_identifier):
+        self.gets.append(resource_identifier)
+        try:
+            return self.items[resource_identifier]
+        except KeyError:
+            raise munkirepo.RepoError('%s not found' % resource_identifier)
+
+    def put(self, resource_identifier, content):
+        self.puts.append(resource_identifier)
+        self.items[resource_identifier] = content
+
+    def put_from_local_file(self, resource_identifier, local_file_path):
+        if local_file_path in self.fail_copies:
+            raise munkirepo.RepoError('copy failed')
+        self.put(resource_identifier, 'payload of ' + local_file_path)
+
+    def delete(self, resource_identifier):
+        try:
+            del self.items[resource_identifier]
+        except KeyError:
+            raise munkirepo.RepoError('%s not found' % resource_identifier)
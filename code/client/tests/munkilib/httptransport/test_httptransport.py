@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_httptransport.py
+
+Unit tests for httptransport, run against a local HTTP server.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+from munkilib import httptransport
+
+
+CONTENT = ''.join(chr(index % 256) for index in range(300 * 1024))
+ETAG = '"abc123"'
+LAST_MODIFIED = 'Tue, 01 Jan 2019 00:00:00 GMT'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves CONTENT at /file, with support for conditional and range
+    requests, plus some redirects and an authenticated URL'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_content(self, status, body, headers=None):
+        '''Sends a response with body'''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        '''Handles a GET request'''
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == '/redirect':
+            self.send_content(302, '', {'Location': '/file'})
+        elif self.path == '/redirect-to-http':
+            self.send_content(
+                302, '', {'Location': 'http://127.0.0.1:%s/file'
+                                      % self.server.server_port})
+        elif self.path == '/redirect-to-other-host':
+            self.send_content(
+                302, '', {'Location': 'http://localhost:%s/file'
+                                      % self.server.server_port})
+        elif self.path == '/auth':
+            expected = 'Basic ' + base64.b64encode('user:secret')
+            if self.headers.get('Authorization') == expected:
+                self.send_content(200, 'authorized')
+            else:
+                self.send_content(
+                    401, 'no', {'WWW-Authenticate': 'Basic realm="test"'})
+        elif self.path == '/file':
+            validators = {'ETag': self.server.etag,
+                          'Last-Modified': LAST_MODIFIED}
+            if self.headers.get('If-None-Match') == self.server.etag:
+                self.send_content(304, '', validators)
+            elif self.headers.get('Range'):
+                start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+                headers = dict(validators)
+                headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                    start, len(CONTENT) - 1, len(CONTENT))
+                self.send_content(206, CONTENT[start:], headers)
+            else:
+                self.send_content(200, CONTENT, validators)
+        else:
+            self.send_content(404, 'not found')
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A local HTTP server that counts connections and records requests'''
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.connections = 0
+        self.requests = []
+        self.etag = ETAG
+
+
+class TestHTTPTransfer(unittest.TestCase):
+    '''Tests for httptransport.HTTPTransfer'''
+
+    def setUp(self):
+        self.server = Server()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.pool = httptransport.ConnectionPool()
+        self.tempdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tempdir, 'file')
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def get(self, path, **options):
+        '''Runs a transfer of path to self.destination and returns it'''
+        options.setdefault('url', self.base_url + path)
+        options.setdefault('file', self.destination)
+        options['connection_pool'] = self.pool
+        transfer = httptransport.HTTPTransfer(options)
+        transfer.start()
+        while not transfer.isDone():
+            pass
+        return transfer
+
+    def read_destination(self):
+        '''Returns the content of self.destination'''
+        fileref = open(self.destination, 'rb')
+        try:
+            return fileref.read()
+        finally:
+            fileref.close()
+
+    def test_download(self):
+        transfer = self.get('/file')
+        self.assertEqual(transfer.error, None)
+        self.assertEqual(transfer.status, 200)
+        self.assertEqual(transfer.percentComplete, 100)
+        self.assertEqual(transfer.headers['etag'], ETAG)
+        self.assertEqual(self.read_destination(), CONTENT)
+        self.assertEqual(transfer.sha256.hexdigest(),
+                         hashlib.sha256(CONTENT).hexdigest())
+        stored = transfer.getStoredHeaders()
+        self.assertEqual(stored['etag'], ETAG)
+        self.assertEqual(stored['last-modified'], LAST_MODIFIED)
+        # a complete download has nothing to resume
+        self.assertFalse('expected-length' in stored)
+
+    def test_connections_are_reused(self):
+        for dummy in range(3):
+            transfer = self.get('/file')
+            self.assertEqual(transfer.status, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_not_found(self):
+        transfer = self.get('/missing')
+        self.assertEqual(transfer.error, None)
+        self.assertEqual(transfer.status, 404)
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_only_if_changed(self):
+        self.get('/file')
+        transfer = self.get('/file', download_only_if_changed=True)
+        self.assertEqual(transfer.status, 304)
+        dummy_path, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('if-none-match'), ETAG)
+        self.assertEqual(headers.get('if-modified-since'), LAST_MODIFIED)
+        self.assertEqual(self.read_destination(), CONTENT)
+
+    def test_resume(self):
+        self.get('/file')
+        # leave a partial download with the data Gurl would have stored
+        transfer = httptransport.HTTPTransfer({'file': self.destination})
+        transfer.storeHeaders_({'etag': ETAG, 'last-modified': LAST_MODIFIED,
+                                'expected-length': len(CONTENT)})
+        fileref = open(self.destination, 'r+b')
+        fileref.truncate(1000)
+        fileref.close()
+
+        transfer = self.get('/file', can_resume=True)
+        self.assertEqual(transfer.error, None)
+        self.assertEqual(transfer.status, 206)
+        dummy_path, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('range'), 'bytes=1000-')
+        self.assertEqual(self.read_destination(), CONTENT)
+        # the hash covers the part downloaded before resuming
+        self.assertEqual(transfer.sha256.hexdigest(),
+                         hashlib.sha256(CONTENT).hexdigest())
+
+    def test_resume_when_file_changed_on_server(self):
+        self.get('/file')
+        transfer = httptransport.HTTPTransfer({'file': self.destination})
+        transfer.storeHeaders_({'etag': ETAG, 'last-modified': LAST_MODIFIED,
+                                'expected-length': len(CONTENT)})
+        fileref = open(self.destination, 'r+b')
+        fileref.truncate(1000)
+        fileref.write('x' * 1000)
+        fileref.close()
+        self.server.etag = '"changed"'
+
+        transfer = self.get('/file', can_resume=True)
+        self.assertEqual(transfer.error, None)
+        self.assertEqual(transfer.status, 200)
+        self.assertEqual(self.read_destination(), CONTENT)
+
+    def test_redirects(self):
+        transfer = self.get('/redirect', follow_redirects='none')
+        self.assertEqual(transfer.status, 302)
+        self.assertEqual(transfer.redirection[0][0], self.base_url + '/file')
+        self.assertFalse(os.path.exists(self.destination))
+
+        transfer = self.get('/redirect-to-http', follow_redirects='https')
+        self.assertEqual(transfer.status, 302)
+
+        transfer = self.get('/redirect', follow_redirects='all')
+        self.assertEqual(transfer.status, 200)
+        self.assertEqual(self.read_destination(), CONTENT)
+
+    def test_basic_auth(self):
+        transfer = self.get('/auth')
+        self.assertEqual(transfer.status, 401)
+        transfer = self.get('/auth', username='user', password='secret')
+        self.assertEqual(transfer.status, 200)
+        self.assertEqual(self.read_destination(), 'authorized')
+
+    def test_additional_headers(self):
+        self.get('/file', additional_headers={'X-Munki-Test': 'yes'})
+        dummy_path, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('x-munki-test'), 'yes')
+
+    def test_no_credentials_after_redirect_to_other_host(self):
+        transfer = self.get(
+            '/redirect-to-other-host', follow_redirects='all',
+            additional_headers={'X-Munki-Test': 'yes',
+                                'Authorization': 'Basic c2VjcmV0',
+                                'User-Agent': 'munki-test'})
+        self.assertEqual(transfer.status, 200)
+        dummy_path, headers = self.server.requests[0]
+        self.assertEqual(headers.get('x-munki-test'), 'yes')
+        self.assertEqual(headers.get('authorization'), 'Basic c2VjcmV0')
+        dummy_path, headers = self.server.requests[-1]
+        self.assertFalse('x-munki-test' in headers)
+        self.assertFalse('authorization' in headers)
+        self.assertEqual(headers.get('user-agent'), 'munki-test')
+
+    def test_credentials_kept_after_redirect_to_same_host(self):
+        self.get('/redirect', follow_redirects='all',
+                 additional_headers={'X-Munki-Test': 'yes'})
+        dummy_path, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('x-munki-test'), 'yes')
+
+    def test_connection_refused(self):
+        # find a port nothing is listening on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        transfer = self.get('/file', url='http://127.0.0.1:%s/file' % port)
+        self.assertEqual(transfer.error.code(),
+                         httptransport.NSURLErrorCannotConnectToHost)
+
+
+if __name__ == '__main__':
+    unittest.main()
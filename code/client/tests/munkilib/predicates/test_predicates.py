@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_predicates.py
+
+Unit tests for the pure-Python predicate evaluator.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from munkilib import predicates
+
+
+INFO = {
+    'arch': 'x86_64',
+    'hostname': 'lab-mac-01.example.com',
+    'machine_model': 'MacBookPro15,1',
+    'machine_type': 'laptop',
+    'os_vers': '10.14.6',
+    'os_vers_major': 10,
+    'os_vers_minor': 14,
+    'catalogs': ['testing', 'production'],
+    'ipv4_address': ['10.0.1.20', '192.168.1.5'],
+    'date': datetime.datetime(2019, 6, 1, 12, 0, 0),
+    'applications': [{'bundleid': 'org.mozilla.firefox', 'version': '68.0'},
+                     {'bundleid': 'com.google.Chrome', 'version': '76.0'}],
+    'department': u'Caf\xe9',
+}
+
+
+class TestEvaluate(unittest.TestCase):
+    """Test predicates.evaluate with predicates like those in manifests."""
+
+    def assertTrue_(self, predicate_string):
+        self.assertTrue(predicates.evaluate(predicate_string, INFO),
+                        '%s should be true' % predicate_string)
+
+    def assertFalse_(self, predicate_string):
+        self.assertFalse(predicates.evaluate(predicate_string, INFO),
+                         '%s should be false' % predicate_string)
+
+    def test_equality(self):
+        self.assertTrue_('machine_type == "laptop"')
+        self.assertTrue_("arch = 'x86_64'")
+        self.assertFalse_('machine_type == "desktop"')
+        self.assertTrue_('machine_type != "desktop"')
+        self.assertTrue_('machine_type <> "desktop"')
+        self.assertTrue_('os_vers_minor == 14')
+
+    def test_ordering(self):
+        self.assertTrue_('os_vers_minor >= 13')
+        self.assertTrue_('os_vers_minor > 13 AND os_vers_minor < 15')
+        self.assertFalse_('os_vers_minor <= 13')
+        self.assertTrue_('os_vers_minor => 14')
+        self.assertFalse_('missing_key > 1')
+
+    def test_string_operators(self):
+        self.assertTrue_('hostname BEGINSWITH "lab-"')
+        self.assertTrue_('hostname ENDSWITH ".example.com"')
+        self.assertTrue_('machine_model CONTAINS "Book"')
+        self.assertFalse_('machine_model CONTAINS "book"')
+        self.assertTrue_('machine_model CONTAINS[c] "book"')
+        self.assertTrue_('hostname LIKE "lab-*-01.*"')
+        self.assertTrue_('hostname MATCHES "lab-mac-[0-9]+\\\\..*"')
+
+    def test_modifiers(self):
+        self.assertTrue_('department ==[d] "Cafe"')
+        self.assertTrue_('department ==[cd] "CAFE"')
+        self.assertFalse_('department == "Cafe"')
+
+    def test_in(self):
+        self.assertTrue_('"testing" IN catalogs')
+        self.assertTrue_('catalogs CONTAINS "production"')
+        self.assertTrue_('os_vers_minor IN {13, 14}')
+        self.assertFalse_('machine_type IN {"desktop", "server"}')
+        self.assertTrue_('"mac" IN hostname')
+
+    def test_any(self):
+        self.assertTrue_('ANY ipv4_address BEGINSWITH "10.0."')
+        self.assertFalse_('ANY ipv4_address BEGINSWITH "172."')
+        self.assertTrue_('ALL ipv4_address CONTAINS "."')
+        self.assertTrue_('NONE ipv4_address == "127.0.0.1"')
+        self.assertTrue_(
+            'ANY applications.bundleid == "org.mozilla.firefox"')
+        self.assertTrue_('SOME catalogs == "testing"')
+
+    def test_compound(self):
+        self.assertTrue_('NOT machine_type == "desktop"')
+        self.assertTrue_('!(machine_type == "desktop")')
+        self.assertTrue_(
+            '(machine_type == "desktop" OR os_vers_minor == 14) '
+            'AND arch == "x86_64"')
+        self.assertTrue_('machine_type == "desktop" || arch == "x86_64"')
+        self.assertFalse_('machine_type == "laptop" && arch == "i386"')
+        self.assertTrue_('TRUEPREDICATE')
+        self.assertFalse_('FALSEPREDICATE')
+
+    def test_dates(self):
+        self.assertTrue_('date > CAST("2019-01-01T00:00:00Z", "NSDate")')
+        self.assertFalse_('date > CAST("2020-01-01T00:00:00Z", "NSDate")')
+
+    def test_constants(self):
+        info = {'enabled': True, 'name': None}
+        self.assertTrue(predicates.evaluate('enabled == TRUE', info))
+        self.assertTrue(predicates.evaluate('enabled == YES', info))
+        self.assertTrue(predicates.evaluate('name == nil', info))
+
+    def test_parse_errors(self):
+        for predicate_string in ['machine_type ==', 'machine_type "laptop"',
+                                 '(arch == "x86_64"', 'arch ~ "x86_64"']:
+            self.assertRaises(predicates.PredicateError,
+                              predicates.evaluate, predicate_string, INFO)
+
+    def test_compiled_predicates_are_cached(self):
+        tree = predicates.compile_predicate('arch == "x86_64"')
+        self.assertTrue(predicates.compile_predicate('arch == "x86_64"')
+                        is tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_versionutils.py
+
+Unit tests for versionutils.version_key.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from distutils.version import LooseVersion
+
+from munkilib.versionutils import version_key
+
+
+class TestVersionKey(unittest.TestCase):
+    """Test that version_key orders versions like MunkiLooseVersion."""
+
+    def test_trailing_zeros_are_equal(self):
+        self.assertEqual(version_key('10.6'), version_key('10.6.0'))
+        self.assertEqual(version_key('10.6'), version_key(u'10.6.0.0'))
+
+    def test_ordering_matches_padded_comparison(self):
+        def padded_cmp(version_a, version_b):
+            # how MunkiLooseVersion compares versions
+            list_a = LooseVersion(version_a).version
+            list_b = LooseVersion(version_b).version
+            length = max(len(list_a), len(list_b))
+            return cmp(list_a + [0] * (length - len(list_a)),
+                       list_b + [0] * (length - len(list_b)))
+
+        versions = ['1.0', '10.0', '1.0.1', '1.0b2', '2', '1.0.0.1',
+                    '1.0a10', '1.0a9', '1.0.0', '10.0.0.0.1', '1.0-1']
+        for version_a in versions:
+            for version_b in versions:
+                self.assertEqual(
+                    cmp(version_key(version_a), version_key(version_b)),
+                    padded_cmp(version_a, version_b),
+                    '%s vs %s' % (version_a, version_b))
+
+    def test_empty_versions_sort_lowest(self):
+        self.assertEqual(
+            sorted(['1.0', None, '0.1', ''], key=version_key, reverse=True),
+            ['1.0', '0.1', None, ''])
+
+    def test_numbers_are_accepted(self):
+        self.assertEqual(version_key(10.6), version_key('10.6'))
+
+
+if __name__ == '__main__':
+    unittest.main()